@@ -35,8 +35,10 @@ mkdir -m 750 -p %{buildroot}/var/lib/jens/bare/common
 mkdir -m 750 -p %{buildroot}/var/lib/jens/clone/modules
 mkdir -m 750 -p %{buildroot}/var/lib/jens/clone/hostgroups
 mkdir -m 750 -p %{buildroot}/var/lib/jens/clone/common
-mkdir -m 750 -p %{buildroot}/var/lib/jens/cache/environments
+mkdir -m 750 -p %{buildroot}/var/lib/jens/cache
 mkdir -m 750 -p %{buildroot}/var/lib/jens/environments
+mkdir -m 750 -p %{buildroot}/var/lib/jens/layers
+mkdir -m 750 -p %{buildroot}/var/lib/jens/commits
 mkdir -m 750 -p %{buildroot}/var/lib/jens/metadata
 mkdir -m 750 -p %{buildroot}/var/log/jens/
 mkdir -m 750 -p %{buildroot}/var/lock/jens/
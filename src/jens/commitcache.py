@@ -0,0 +1,183 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+import os
+import stat
+import fcntl
+import logging
+import pickle
+import shutil
+import time
+import tempfile
+
+import jens.git as git
+
+from jens.errors import JensRepositoriesError
+
+# Checkouts of commits never change, so they're exported once to
+# COMMITCACHE_DIR/<sha> as read-only trees and shared by all the pins
+# (clones linking to them) across repositories and environments.
+#
+# The index keeps, per commit, its size on disk, the pins using it and
+# when the last pin was released. Entries without pins are only removed
+# when the cache goes over budget, least recently released first.
+
+# The index lock is only held for the bookkeeping. Commits are exported
+# to a temporary directory that is renamed into place afterwards, so
+# exporting a big tree doesn't block everybody else. If somebody else
+# exported the same commit meanwhile, the copy is thrown away.
+def acquire_commit(settings, bare_path, sha, pin):
+    entry_path = _get_entry_path(settings, sha)
+    with _IndexLock(settings) as index:
+        if _is_cached(index, sha, entry_path):
+            logging.debug("Commit '%s' found in cache" % sha)
+            _pin(index, sha, pin)
+            return entry_path
+    logging.debug("Exporting commit '%s' to %s" % (sha, entry_path))
+    temporary_path, size = _export(settings, bare_path, sha)
+    try:
+        with _IndexLock(settings) as index:
+            if not _is_cached(index, sha, entry_path):
+                if os.path.exists(entry_path):
+                    _remove_entry(entry_path)
+                os.rename(temporary_path, entry_path)
+                index[sha] = {'size': size, 'pins': set(), 'released': None}
+            else:
+                logging.debug("Commit '%s' was exported meanwhile" % sha)
+            _pin(index, sha, pin)
+    except OSError, error:
+        raise JensRepositoriesError("Unable to export commit '%s' (%s)" % \
+            (sha, error))
+    finally:
+        if os.path.exists(temporary_path):
+            _remove_entry(temporary_path)
+    return entry_path
+
+def release_commit(settings, pin):
+    sha = os.path.basename(os.readlink(pin))
+    with _IndexLock(settings) as index:
+        if sha in index:
+            index[sha]['pins'].discard(pin)
+            if not index[sha]['pins']:
+                logging.debug("Commit '%s' is not pinned anymore" % sha)
+                index[sha]['released'] = time.time()
+
+def is_cached_commit(settings, path):
+    if not settings.COMMITCACHE_ENABLED or not os.path.islink(path):
+        return False
+    # The link may be relative and the directory not be canonical
+    target = os.path.join(os.path.dirname(path), os.readlink(path))
+    return os.path.dirname(os.path.realpath(target)) == \
+        os.path.realpath(settings.COMMITCACHE_DIR)
+
+def evict_commits(settings):
+    budget = settings.COMMITCACHE_BUDGET * 1024 * 1024
+    with _IndexLock(settings) as index:
+        used = sum([entry['size'] for entry in index.itervalues()])
+        logging.info("Commit cache using %d bytes out of %d" % (used, budget))
+        released = sorted([(entry['released'], sha)
+            for sha, entry in index.iteritems() if not entry['pins']])
+        for released_at, sha in released:
+            if used <= budget:
+                break
+            logging.info("Evicting commit '%s' from cache" % sha)
+            try:
+                _remove_entry(_get_entry_path(settings, sha))
+            except OSError, error:
+                logging.error("Unable to evict commit '%s' (%s)" % (sha, error))
+                continue
+            used -= index.pop(sha)['size']
+
+def remove_commit_cache(settings):
+    with _IndexLock(settings) as index:
+        for entry in os.listdir(settings.COMMITCACHE_DIR):
+            path = "%s/%s" % (settings.COMMITCACHE_DIR, entry)
+            if os.path.isdir(path):
+                _remove_entry(path)
+        index.clear()
+
+def _is_cached(index, sha, entry_path):
+    return sha in index and os.path.isdir(entry_path)
+
+def _pin(index, sha, pin):
+    index[sha]['pins'].add(pin)
+    index[sha]['released'] = None
+
+# Returns the temporary directory the commit was exported to and its
+# size
+def _export(settings, bare_path, sha):
+    try:
+        temporary_path = tempfile.mkdtemp(dir=settings.COMMITCACHE_DIR,
+            prefix=".%s-" % sha)
+    except OSError, error:
+        raise JensRepositoriesError("Unable to export commit '%s' (%s)" % \
+            (sha, error))
+    try:
+        try:
+            git.export(bare_path, sha, temporary_path, bare=True)
+            return temporary_path, _seal(temporary_path)
+        except OSError, error:
+            raise JensRepositoriesError("Unable to export commit '%s' (%s)" % \
+                (sha, error))
+    except:
+        _remove_entry(temporary_path)
+        raise
+
+# Makes the tree read-only and returns its size
+def _seal(path):
+    size = 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            file_path = os.path.join(root, name)
+            stats = os.lstat(file_path)
+            size += stats.st_size
+            if not stat.S_ISLNK(stats.st_mode):
+                os.chmod(file_path, stat.S_IMODE(stats.st_mode) & \
+                    ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        os.chmod(root, 0555)
+    return size
+
+def _remove_entry(path):
+    for root, dirs, files in os.walk(path):
+        os.chmod(root, 0755)
+    shutil.rmtree(path)
+
+def _get_entry_path(settings, sha):
+    return "%s/%s" % (settings.COMMITCACHE_DIR, sha)
+
+class _IndexLock(object):
+    def __init__(self, settings):
+        self.index_path = settings.COMMITCACHE_DIR + "/.index"
+        self.lock_path = settings.COMMITCACHE_DIR + "/.lock"
+
+    def __enter__(self):
+        try:
+            self.lockfile = open(self.lock_path, "w")
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        except IOError, error:
+            raise JensRepositoriesError("Unable to lock commit cache (%s)" % \
+                error)
+        try:
+            with open(self.index_path, "rb") as index_file:
+                self.index = pickle.load(index_file)
+        except (IOError, EOFError, pickle.PickleError):
+            self.index = {}
+        return self.index
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None:
+                temporary_path = "%s.tmp" % self.index_path
+                with open(temporary_path, "wb") as index_file:
+                    pickle.dump(self.index, index_file,
+                        pickle.HIGHEST_PROTOCOL)
+                os.rename(temporary_path, self.index_path)
+        except (IOError, OSError, pickle.PickleError), error:
+            raise JensRepositoriesError("Unable to write commit cache index (%s)" % \
+                error)
+        finally:
+            self.lockfile.close()
@@ -19,6 +19,19 @@ repositorymetadata = string(default='/var/lib/jens/metadata/repository/repositor
 cachedir = string(default='/var/lib/jens/cache')
 hashprefix = string(default='commit/')
 directory_environments = boolean(default=False)
+shared_layers = boolean(default=False)
+layersdir = string(default='/var/lib/jens/layers')
+code_ids = boolean(default=False)
+journal = boolean(default=False)
+pipeline = boolean(default=False)
+fastpath = boolean(default=False)
+coalesce = boolean(default=False)
+[git]
+depth = integer(default=0)
+narrowrefspecs = boolean(default=False)
+bootstrapstep = integer(default=0)
+objectpools = boolean(default=False)
+reflinks = boolean(default=False)
 [lock]
 type = option('DISABLED', 'FILE', 'ETCD', default='FILE')
 name = string(default='jens')
@@ -28,4 +41,21 @@ lockdir = string(default='/var/lock/jens')
 servers = list(default=list("127.0.0.1:4001"))
 acqtimeout = integer(default=1)
 initialttl = integer(default=60)
+[shards]
+type = option('DISABLED', 'LOCAL', 'ETCD', default='DISABLED')
+count = integer(min=1, default=8)
+localdir = string(default='/var/lib/jens/shards')
+ttl = integer(default=600)
+[notifications]
+type = option('DISABLED', 'PUPPETSERVER', default='DISABLED')
+[commitcache]
+enabled = boolean(default=False)
+dir = string(default='/var/lib/jens/commits')
+budget = integer(default=1024)
+[puppetserver]
+url = string(default='https://localhost:8140/puppet-admin-api/v1/environment-cache')
+sslcert = string(default=None)
+sslkey = string(default=None)
+cacert = string(default=None)
+timeout = integer(default=5)
 """
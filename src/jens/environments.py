@@ -11,19 +11,37 @@ import yaml
 import shutil
 import re
 import math
+import time
+import hashlib
+from multiprocessing import Pool, cpu_count
 
-from jens.git import hash_object
+from jens.git import hash_objects
+from jens.git import get_head
 from jens.decorators import timed
 from jens.errors import JensEnvironmentsError
+from jens.errors import JensGitError
+from jens.errors import JensNotificationError
+from jens.errors import JensJournalError
+from jens.notifications import JensNotifierFactory
+from jens.environmentscache import get_environments_cache
+from jens.environmentscache import persist_environments_cache
+from jens.refsindex import read_refs_index, persist_refs_index
+from jens.journal import JensJournalFactory
 from jens.tools import refname_to_dirname
 from jens.tools import aggregate_deltas
 
 DIRECTORY_ENVIRONMENTS_CONF_FILENAME = "environment.conf"
+CODE_ID_FILENAME = ".code_id"
 
 @timed
-def refresh_environments(settings, lock, repositories_deltas, inventory):
-    logging.debug("Calculating delta...")
-    delta = _calculate_delta(settings)
+def refresh_environments(settings, lock, repositories_deltas, inventory,
+        pipeline=None):
+    if pipeline is None:
+        cache, delta = _prepare(settings)
+        processed = {}
+    else:
+        cache, delta = pipeline.cache, pipeline.delta
+        processed = pipeline.finish()
     logging.info("New environments: %s" % delta['new'])
     logging.info("Existing and changed environments: %s" % delta['changed'])
     logging.debug("Existing but not changed environments: %s" % delta['notchanged'])
@@ -36,108 +54,315 @@ def refresh_environments(settings, lock, repositories_deltas, inventory):
        (len(delta['notchanged']) * (0.2*total_new + 0.1*total_deleted)) +
        (len(delta['deleted']) * 0.1))) + 2)
 
+    if _shared_layers_enabled(settings):
+        logging.info("Refreshing shared layers...")
+        _refresh_layers(settings, repositories_deltas, inventory)
+
+    changed = set()
     logging.info("Creating new environments...")
-    _create_new_environments(settings, delta['new'], inventory)
+    pending, results = _split_processed(delta['new'], processed)
+    results.extend(_create_new_environments(settings, pending, inventory))
+    changed.update(_update_cache(settings, cache, results, delta['hashes']))
     logging.info("Purging deleted environments...")
-    _purge_deleted_environments(settings, delta['deleted'])
+    pending, results = _split_processed(delta['deleted'], processed)
+    results.extend(_purge_deleted_environments(settings, pending))
+    changed.update(_update_cache(settings, cache, results, delta['hashes']))
     logging.info("Recreating changed environments...")
-    _recreate_changed_environments(settings, delta['changed'], inventory)
+    pending, results = _split_processed(delta['changed'], processed)
+    results.extend(_recreate_changed_environments(settings, pending,
+        inventory))
+    changed.update(_update_cache(settings, cache, results, delta['hashes']))
     logging.info("Refreshing not changed environments...")
-    _refresh_notchanged_environments(settings, delta['notchanged'],
-        repositories_deltas)
+    changed.update(_report_errors(_refresh_notchanged_environments(settings,
+        delta['notchanged'], repositories_deltas,
+        _find_users_of_updated_refs(settings, repositories_deltas))))
+
+    logging.info("Environments whose content changed: %s" % sorted(changed))
+    if settings.CODE_IDS:
+        logging.info("Updating code IDs...")
+        _update_code_ids(settings, changed, delta['notchanged'], inventory)
+    try:
+        JensNotifierFactory.makeNotifier(settings).notify(changed)
+    except JensNotificationError, error:
+        logging.error("Failed to notify changed environments (%s)" % error)
+    return changed
+
+def _prepare(settings):
+    cache = get_environments_cache(settings)
+    journal = JensJournalFactory.makeJournal(settings, "environments")
+    _recover_journal(settings, journal, cache)
+    logging.debug("Calculating delta...")
+    return (cache, _calculate_delta(settings, cache))
+
+def _split_processed(environments, processed):
+    return ([environment for environment in environments
+        if environment not in processed],
+        [processed[environment] for environment in environments
+        if environment in processed])
+
+# Lets environments be generated while the repositories are still being
+# refreshed. Its repository_processed method is meant to be the listener
+# of refresh_repositories. Deleted environments are purged right away
+# and new or changed environments without a default branch are
+# (re)created as soon as the repositories they override and the common
+# ones are ready. The rest (everything with a default branch needs all
+# the repositories) is left to refresh_environments, that also gathers
+# the results of what was done here.
+class EnvironmentsPipeline(object):
+    def __init__(self, settings):
+        self.settings = settings
+        self.cache, self.delta = _prepare(settings)
+        self.pool = Pool(processes=int(math.ceil(cpu_count()*1.5)))
+        self.jobs = {}
+        self.done = set()
+        self.waiting = {}
+        for environment in self.delta['deleted']:
+            self._dispatch(_purge_deleted_environment, environment, None)
+        for kind in ('new', 'changed'):
+            for environment in self.delta[kind]:
+                dependencies = self._get_dependencies(environment)
+                if dependencies is not None:
+                    self.waiting[environment] = (kind, dependencies)
+
+    def repository_processed(self, partition, name, inventory):
+        self.done.add((partition, name))
+        for environment, (kind, dependencies) in self.waiting.items():
+            if dependencies.issubset(self.done):
+                logging.info("Repositories needed by '%s' are ready" % \
+                    environment)
+                del self.waiting[environment]
+                self._dispatch(_create_new_environment if kind == 'new' \
+                    else _recreate_changed_environment, environment,
+                    self._get_inventory_view(dependencies, inventory))
+
+    # Waits for the environments being processed and returns the results
+    def finish(self):
+        self.pool.close()
+        self.pool.join()
+        return dict([(environment, job.get())
+            for environment, job in self.jobs.iteritems()])
+
+    def _dispatch(self, function, environment, inventory):
+        logging.debug("Dispatching environment '%s'" % environment)
+        self.jobs[environment] = self.pool.apply_async(function,
+            ({'settings': self.settings, 'environment': environment,
+            'inventory': inventory},))
 
-def _refresh_notchanged_environments(settings, environments, repositories_deltas):
-    for environment in environments:
-        logging.debug("Refreshing environment '%s'..." % environment)
+    # Returns None if the environment has to wait for all the repositories
+    def _get_dependencies(self, environment):
         try:
-            definition = read_environment_definition(settings, environment)
-        except JensEnvironmentsError, error:
-            logging.error("Unable to read and parse '%s' definition (%s). Skipping" % \
-                    (environment, error))
-            return
+            definition = read_environment_definition(self.settings,
+                environment)
+        except JensEnvironmentsError:
+            return None # Reported later on
+        if definition is None or definition.get('default', None) is not None:
+            return None
+        dependencies = set([('common', None)])
+        for partition, elements in \
+                (definition.get('overrides', None) or {}).iteritems():
+            if partition in ("modules", "hostgroups", "common") and \
+                    isinstance(elements, dict):
+                dependencies.update([(partition, element)
+                    for element in elements])
+        return dependencies
 
-        if definition.get('default', None) is None:
-            logging.debug("Environment '%s' won't get new modules (no default)" % environment)
-        else:
-            for module in repositories_deltas['modules']['new']:
-                try:
-                    _link_module(settings, module, environment, definition)
-                except JensEnvironmentsError, error:
-                    logging.error("Failed to link module '%s' in enviroment '%s' (%s)" % \
-                        (module, environment, error))
-
-        for module in repositories_deltas['modules']['deleted']:
-            logging.debug("Deleting module '%s' from environment '%s'" %
-                (module, environment))
+    # The inventory keeps changing while the repositories are refreshed,
+    # so the environment only gets the bits it needs, that won't.
+    def _get_inventory_view(self, dependencies, inventory):
+        view = {'modules': {}, 'hostgroups': {}, 'common': {}}
+        for partition, element in dependencies:
+            if element is not None and element in inventory[partition]:
+                view[partition][element] = list(inventory[partition][element])
+        return view
+
+# If no modules or hostgroups were added or deleted, there's nothing
+# to link or unlink and, thanks to the refs index, which environments
+# changed is known without reading their definitions.
+def _refresh_notchanged_environments(settings, environments, repositories_deltas,
+        users):
+    if not any([repositories_deltas[partition][kind]
+            for partition in ("modules", "hostgroups")
+            for kind in ("new", "deleted")]):
+        return [_result(environment, changed=environment in users)
+            for environment in environments]
+    data = [{'settings': settings, 'environment': environment,
+        'repositories_deltas': repositories_deltas,
+        'uses_updated_refs': environment in users}
+        for environment in environments]
+    return _run_in_pool(_refresh_notchanged_environment, data)
+
+def _refresh_notchanged_environment(data):
+    settings = data['settings']
+    environment = data['environment']
+    repositories_deltas = data['repositories_deltas']
+    errors = []
+    changed = data['uses_updated_refs']
+    logging.debug("Refreshing environment '%s'..." % environment)
+    try:
+        definition = read_environment_definition(settings, environment)
+    except JensEnvironmentsError, error:
+        errors.append("Unable to read and parse '%s' definition (%s). Skipping" % \
+                (environment, error))
+        return _result(environment, errors)
+
+    if definition.get('default', None) is None:
+        logging.debug("Environment '%s' won't get new modules (no default)" % environment)
+    else:
+        # Repositories quarantined when the inventory was regenerated
+        # are new again but may still be linked
+        for module in repositories_deltas['modules']['new']:
+            changed = True
             _unlink_module(settings, module, environment)
+            try:
+                _link_module(settings, module, environment, definition)
+            except JensEnvironmentsError, error:
+                errors.append("Failed to link module '%s' in enviroment '%s' (%s)" % \
+                    (module, environment, error))
 
-        if definition.get('default', None) is None:
-            logging.debug("Environment '%s' won't get new hostgroups (no default)" % environment)
-        else:
-            for hostgroup in repositories_deltas['hostgroups']['new']:
-                try:
-                    _link_hostgroup(settings, hostgroup, environment, definition)
-                except JensEnvironmentsError, error:
-                    logging.error("Failed to link hostgroup '%s' in enviroment '%s' (%s)" % \
-                        (hostgroup, environment, error))
-
-        for hostgroup in repositories_deltas['hostgroups']['deleted']:
-            logging.debug("Deleting hostgroup '%s' from environment '%s'" %
-                (hostgroup, environment))
+    for module in repositories_deltas['modules']['deleted']:
+        logging.debug("Deleting module '%s' from environment '%s'" %
+            (module, environment))
+        if _unlink_module(settings, module, environment):
+            changed = True
+
+    if definition.get('default', None) is None:
+        logging.debug("Environment '%s' won't get new hostgroups (no default)" % environment)
+    else:
+        for hostgroup in repositories_deltas['hostgroups']['new']:
+            changed = True
             _unlink_hostgroup(settings, hostgroup, environment)
+            try:
+                _link_hostgroup(settings, hostgroup, environment, definition)
+            except JensEnvironmentsError, error:
+                errors.append("Failed to link hostgroup '%s' in enviroment '%s' (%s)" % \
+                    (hostgroup, environment, error))
+
+    for hostgroup in repositories_deltas['hostgroups']['deleted']:
+        logging.debug("Deleting hostgroup '%s' from environment '%s'" %
+            (hostgroup, environment))
+        if _unlink_hostgroup(settings, hostgroup, environment):
+            changed = True
+
+    # The shared layer might have lost something as well
+    if _is_layered(settings, definition) and \
+            (repositories_deltas['modules']['deleted'] or
+            repositories_deltas['hostgroups']['deleted']):
+        changed = True
+
+    return _result(environment, errors, changed)
+
+# Environments linking any of the refs whose clones have been created,
+# updated or removed during the refresh of the repositories.
+def _find_users_of_updated_refs(settings, repositories_deltas):
+    index = read_refs_index(settings)
+    users = set()
+    for partition in ("modules", "hostgroups", "common"):
+        updated_refs = repositories_deltas[partition].get('updated_refs', {})
+        for element, refs in updated_refs.iteritems():
+            for refname in refs:
+                users.update(index.users_of(settings, partition,
+                    element, refname))
+    return users
 
 def _recreate_changed_environments(settings, environments, inventory):
-    for environment in environments:
-        logging.info("Recreating environment '%s'" % environment)
-        _purge_deleted_environment(settings, environment)
-        _create_new_environment(settings, environment, inventory)
+    data = [{'settings': settings, 'environment': environment,
+        'inventory': inventory} for environment in environments]
+    return _run_in_pool(_recreate_changed_environment, data)
+
+def _recreate_changed_environment(data):
+    environment = data['environment']
+    logging.info("Recreating environment '%s'" % environment)
+    _purge_deleted_environment(data)
+    result = _create_new_environment(data)
+    result.update({'changed': True, 'purged': True})
+    return result
 
 def _purge_deleted_environments(settings, environments):
-    for environment in environments:
-        _purge_deleted_environment(settings, environment)
+    data = [{'settings': settings, 'environment': environment}
+        for environment in environments]
+    return _run_in_pool(_purge_deleted_environment, data)
 
-def _purge_deleted_environment(settings, environment):
+def _purge_deleted_environment(data):
+    settings = data['settings']
+    environment = data['environment']
     logging.info("Deleting environment '%s'" % environment)
     env_basepath = "%s/%s" % (settings.ENVIRONMENTSDIR, environment)
+    journal = JensJournalFactory.makeJournal(settings, "environments")
+    try:
+        entry = journal.begin('purge', environment=environment)
+    except JensJournalError, error:
+        return _result(environment, ["Unable to delete environment '%s' (%s)" % \
+            (environment, error)])
     shutil.rmtree(env_basepath)
+    journal.commit(entry)
     logging.info("Deleted '%s'" % env_basepath)
-    _remove_environment_annotation(settings, environment)
+    return _result(environment, changed=True, purged=True)
 
 def _create_new_environments(settings, environments, inventory):
-    for environment in environments:
-        _create_new_environment(settings, environment, inventory)
+    data = [{'settings': settings, 'environment': environment,
+        'inventory': inventory} for environment in environments]
+    return _run_in_pool(_create_new_environment, data)
 
-def _create_new_environment(settings, environment, inventory):
+def _create_new_environment(data):
+    settings = data['settings']
+    environment = data['environment']
+    inventory = data['inventory']
+    errors = []
     logging.info("Creating new environment '%s'" % environment)
 
     if re.match(r"^\w+$", environment) is None:
-        logging.error("Environment name '%s' is invalid. Skipping" % environment)
-        return
+        errors.append("Environment name '%s' is invalid. Skipping" % environment)
+        return _result(environment, errors)
 
     try:
         definition = read_environment_definition(settings, environment)
     except JensEnvironmentsError, error:
-        logging.error("Unable to read and parse '%s' definition (%s). Skipping" % \
+        errors.append("Unable to read and parse '%s' definition (%s). Skipping" % \
             (environment, error))
-        return
+        return _result(environment, errors)
 
     if definition is None:
-        logging.error("Environment '%s' is empty" % environment)
-        return
+        errors.append("Environment '%s' is empty" % environment)
+        return _result(environment, errors)
 
     logging.debug("Creating directory structure...")
     env_basepath = "%s/%s" % (settings.ENVIRONMENTSDIR, environment)
+    journal = JensJournalFactory.makeJournal(settings, "environments")
+    try:
+        entry = journal.begin('create', environment=environment)
+    except JensJournalError, error:
+        errors.append("Unable to create environment '%s' (%s). Skipping" % \
+            (environment, error))
+        return _result(environment, errors)
+    # Leftovers of a run that died before updating the cache
+    if os.path.isdir(env_basepath):
+        logging.warn("Removing leftovers of environment '%s'" % environment)
+        shutil.rmtree(env_basepath)
     os.mkdir(env_basepath)
     for directory in ("modules", "hostgroups", "hieradata"):
         os.mkdir("%s/%s" % (env_basepath, directory))
 
-    hieradata_directories = ("module_names", "hostgroups", "fqdns")
-    for directory in hieradata_directories:
-        os.mkdir("%s/hieradata/%s" % (env_basepath, directory))
+    hieradata_directories = (("module_names", "modules"),
+        ("hostgroups", "hostgroups"), ("fqdns", "hostgroups"))
+    layered = _is_layered(settings, definition)
+    for directory, partition in hieradata_directories:
+        path = "%s/hieradata/%s" % (env_basepath, directory)
+        # Without overrides for the partition, all the data comes
+        # from the shared layer.
+        if layered and not definition.get('overrides', {}).get(partition):
+            try:
+                _symlink("%s/hieradata/%s" % (_generate_layer_path(settings,
+                    definition['default']), directory), path)
+            except JensEnvironmentsError, error:
+                errors.append("Failed to link shared layer in enviroment '%s' (%s)" % \
+                    (environment, error))
+        else:
+            os.mkdir(path)
 
     logging.info("Processing modules...")
     modules = inventory['modules'].keys()
-    if not 'default' in definition:
+    if not 'default' in definition or \
+            os.path.islink("%s/hieradata/module_names" % env_basepath):
         try:
             necessary_modules = definition['overrides']['modules'].keys()
         except KeyError:
@@ -147,12 +372,13 @@ def _create_new_environment(settings, environment, inventory):
         try:
             _link_module(settings, module, environment, definition)
         except JensEnvironmentsError, error:
-            logging.error("Failed to link module '%s' in enviroment '%s' (%s)" % \
+            errors.append("Failed to link module '%s' in enviroment '%s' (%s)" % \
                 (module, environment, error))
 
     logging.info("Processing hostgroups...")
     hostgroups = inventory['hostgroups'].keys()
-    if not 'default' in definition:
+    if not 'default' in definition or \
+            os.path.islink("%s/hieradata/hostgroups" % env_basepath):
         try:
             necessary_hostgroups = definition['overrides']['hostgroups'].keys()
         except KeyError:
@@ -162,31 +388,64 @@ def _create_new_environment(settings, environment, inventory):
         try:
             _link_hostgroup(settings, hostgroup, environment, definition)
         except JensEnvironmentsError, error:
-            logging.error("Failed to link hostgroup '%s' in enviroment '%s' (%s)" % \
+            errors.append("Failed to link hostgroup '%s' in enviroment '%s' (%s)" % \
                 (hostgroup, environment, error))
 
     logging.info("Processing site...")
     try:
         _link_site(settings, environment, definition)
     except JensEnvironmentsError, error:
-        logging.error("Failed to link site in enviroment '%s' (%s)" % \
+        errors.append("Failed to link site in enviroment '%s' (%s)" % \
             (environment, error))
 
     logging.info("Processing common Hiera data...")
     try:
         _link_common_hieradata(settings, environment, definition)
     except JensEnvironmentsError, error:
-        logging.error("Failed to link common hieradata in enviroment '%s' (%s)" % \
+        errors.append("Failed to link common hieradata in enviroment '%s' (%s)" % \
             (environment, error))
 
     if settings.DIRECTORY_ENVIRONMENTS:
         try:
-            _add_configuration_file(settings, environment)
+            _add_configuration_file(settings, environment, definition)
         except JensEnvironmentsError, error:
-            logging.error("Failed to generate config file for environment '%s' (%s)" % \
+            errors.append("Failed to generate config file for environment '%s' (%s)" % \
                 (environment, error))
 
-    _annotate_environment(settings, environment)
+    journal.commit(entry)
+    return _result(environment, errors, True,
+        refs=_resolve_refs(settings, definition))
+
+# Environments are independent of each other, so all the per-environment
+# work is spread across a pool of workers. Workers don't log errors
+# themselves but return them so they can be reported all together.
+def _run_in_pool(function, data):
+    if not data:
+        return [] # Seems that passing [] to pool.map makes .join never return
+    pool = Pool(processes=int(math.ceil(cpu_count()*1.5)))
+    results = pool.map(function, data)
+    pool.close()
+    pool.join()
+    return results
+
+def _result(environment, errors=None, changed=False, purged=False, refs=None):
+    return {'environment': environment, 'errors': errors or [],
+        'changed': changed, 'purged': purged, 'refs': refs}
+
+def _report_errors(results):
+    failed = []
+    changed = set()
+    for result in results:
+        for error in result['errors']:
+            logging.error(error)
+        if result['errors']:
+            failed.append(result['environment'])
+        if result['changed']:
+            changed.add(result['environment'])
+    if failed:
+        logging.error("%d environment(s) processed with errors: %s" % \
+            (len(failed), ", ".join(sorted(failed))))
+    return changed
 
 def read_environment_definition(settings, environment):
     try:
@@ -215,25 +474,30 @@ def _link_module(settings, module, environment, definition):
     # 1. Module's code directory
     # LINK_NAME: $environment/modules/$module
     # TARGET: $clonedir/modules/$module/$branch/code
-    target = "%s/modules/%s/%s/code" % \
-        (settings.CLONEDIR, module, branch)
-    link_name = _generate_module_env_code_path(settings,
-        module, environment)
-    target = os.path.relpath(target,
-        os.path.abspath(os.path.join(link_name, os.pardir)))
-    logging.debug("Linking %s to %s" % (link_name, target))
-    try:
-        os.symlink(target, link_name)
-    except OSError, error:
-        raise JensEnvironmentsError(error)
+    if overridden or not _is_layered(settings, definition):
+        target = "%s/modules/%s/%s/code" % \
+            (settings.CLONEDIR, module, branch)
+        link_name = _generate_module_env_code_path(settings,
+            module, environment)
+        target = os.path.relpath(target,
+            os.path.abspath(os.path.join(link_name, os.pardir)))
+        logging.debug("Linking %s to %s" % (link_name, target))
+        try:
+            os.symlink(target, link_name)
+        except OSError, error:
+            raise JensEnvironmentsError(error)
 
     # 2. Module's data directory
     # LINK_NAME: $environment/hieradata/module_names/$module
     # TARGET: $clonedir/modules/$module/$branch/data
-    target = "%s/modules/%s/%s/data" % \
-        (settings.CLONEDIR, module, branch)
+    #      or $layersdir/$default/hieradata/module_names/$module
+    target = _generate_data_target(settings, definition, overridden,
+        "%s/modules/%s/%s/data" % (settings.CLONEDIR, module, branch),
+        "hieradata/module_names/%s" % module)
     link_name = _generate_module_env_hieradata_path(settings,
         module, environment)
+    if _is_in_shared_layer(link_name):
+        return
     target = os.path.relpath(target, \
         os.path.abspath(os.path.join(link_name, os.pardir)))
     logging.debug("Linking %s to %s" % (link_name, target))
@@ -249,26 +513,32 @@ def _link_hostgroup(settings, hostgroup, environment, definition):
     # 1. Hostgroup's code directory
     # LINK_NAME: $environment/hostgroups/hg_$hostgroup
     # TARGET: $clonedir/hostgroups/$hostgroup/$branch/code
-    target = "%s/hostgroups/%s/%s/code" % \
-        (settings.CLONEDIR, hostgroup, branch)
-    link_name = _generate_hostgroup_env_code_path(settings,
-        hostgroup, environment)
-    target = os.path.relpath(target,
-        os.path.abspath(os.path.join(link_name, os.pardir)))
-    logging.debug("Linking %s to %s" % (link_name, target))
-    try:
-        os.symlink(target, link_name)
-    except OSError, error:
-        raise JensEnvironmentsError(error)
+    if overridden or not _is_layered(settings, definition):
+        target = "%s/hostgroups/%s/%s/code" % \
+            (settings.CLONEDIR, hostgroup, branch)
+        link_name = _generate_hostgroup_env_code_path(settings,
+            hostgroup, environment)
+        target = os.path.relpath(target,
+            os.path.abspath(os.path.join(link_name, os.pardir)))
+        logging.debug("Linking %s to %s" % (link_name, target))
+        try:
+            os.symlink(target, link_name)
+        except OSError, error:
+            raise JensEnvironmentsError(error)
 
     # 2. Hostgroup's hostgroup data directory
     # LINK_NAME: $environment/hostgroups/hieratata/hostgroups/$hostgroup
     # TARGET: $clonedir/hostgroups/$hostgroup/$branch/data/hostgroup
-    target = "%s/hostgroups/%s/%s/data/hostgroup" % \
-        (settings.CLONEDIR, hostgroup, branch)
+    #      or $layersdir/$default/hieradata/hostgroups/$hostgroup
+    target = _generate_data_target(settings, definition, overridden,
+        "%s/hostgroups/%s/%s/data/hostgroup" % \
+        (settings.CLONEDIR, hostgroup, branch),
+        "hieradata/hostgroups/%s" % hostgroup)
     link_name = \
         _generate_hostgroup_env_hieradata_hostgroup_path(
         settings, hostgroup, environment)
+    if _is_in_shared_layer(link_name):
+        return
     target = os.path.relpath(target, \
         os.path.abspath(os.path.join(link_name, os.pardir)))
     logging.debug("Linking %s to %s" % (link_name, target))
@@ -280,8 +550,11 @@ def _link_hostgroup(settings, hostgroup, environment, definition):
     # 3. Hostgroup's FQDNs data directory
     # LINK_NAME: $environment/hostgroups/hieratata/fqdns/$hostgroup
     # TARGET: $clonedir/hostgroups/$hostgroup/$branch/data/fqdns
-    target = "%s/hostgroups/%s/%s/data/fqdns" % \
-        (settings.CLONEDIR, hostgroup, branch)
+    #      or $layersdir/$default/hieradata/fqdns/$hostgroup
+    target = _generate_data_target(settings, definition, overridden,
+        "%s/hostgroups/%s/%s/data/fqdns" % \
+        (settings.CLONEDIR, hostgroup, branch),
+        "hieradata/fqdns/%s" % hostgroup)
     link_name = \
         _generate_hostgroup_env_hieradata_fqdns_path(
         settings, hostgroup, environment)
@@ -294,6 +567,7 @@ def _link_hostgroup(settings, hostgroup, environment, definition):
         raise JensEnvironmentsError(error)
 
 def _unlink_module(settings, module, environment):
+    removed = False
     # 1. Module's code directory
     # LINK_NAME: $environment/modules/$module
     link_name = _generate_module_env_code_path(settings,
@@ -301,16 +575,21 @@ def _unlink_module(settings, module, environment):
     logging.debug("Making sure link '%s' does not exist" % link_name)
     if os.path.islink(link_name):
         os.unlink(link_name)
+        removed = True
 
     # 2. Module's data directory
     # LINK_NAME: $environment/hieradata/module_names/$module
     link_name = _generate_module_env_hieradata_path(settings,
         module, environment)
     logging.debug("Making sure link '%s' does not exist" % link_name)
-    if os.path.islink(link_name):
+    if os.path.islink(link_name) and not _is_in_shared_layer(link_name):
         os.unlink(link_name)
+        removed = True
+
+    return removed
 
 def _unlink_hostgroup(settings, hostgroup, environment):
+    removed = False
     # 1. Hostgroup's code directory
     # LINK_NAME: $environment/hostgroups/hg_$hostgroup
     link_name = _generate_hostgroup_env_code_path(settings,
@@ -318,6 +597,7 @@ def _unlink_hostgroup(settings, hostgroup, environment):
     logging.debug("Making sure link '%s' does not exist" % link_name)
     if os.path.islink(link_name):
         os.unlink(link_name)
+        removed = True
 
     # 2. Hostgroup's hostgroup data directory
     # LINK_NAME: $environment/hostgroups/hieratata/hostgroups/$hostgroup
@@ -325,8 +605,9 @@ def _unlink_hostgroup(settings, hostgroup, environment):
         _generate_hostgroup_env_hieradata_hostgroup_path(
         settings, hostgroup, environment)
     logging.debug("Making sure link '%s' does not exist" % link_name)
-    if os.path.islink(link_name):
+    if os.path.islink(link_name) and not _is_in_shared_layer(link_name):
         os.unlink(link_name)
+        removed = True
 
     # 3. Hostgroup's FQDNs data directory
     # LINK_NAME: $environment/hostgroups/hieratata/fqdns/$hostgroup
@@ -334,8 +615,11 @@ def _unlink_hostgroup(settings, hostgroup, environment):
         _generate_hostgroup_env_hieradata_fqdns_path(
         settings, hostgroup, environment)
     logging.debug("Making sure link '%s' does not exist" % link_name)
-    if os.path.islink(link_name):
+    if os.path.islink(link_name) and not _is_in_shared_layer(link_name):
         os.unlink(link_name)
+        removed = True
+
+    return removed
 
 def _generate_module_env_code_path(settings, module, environment):
     return "%s/%s/modules/%s" % \
@@ -357,56 +641,151 @@ def _generate_hostgroup_env_hieradata_fqdns_path(settings, hostgroup, environmen
     return "%s/%s/hieradata/fqdns/%s" % \
         (settings.ENVIRONMENTSDIR, environment, hostgroup)
 
-def _annotate_environment(settings, environment):
-    hash_cache_file = open(settings.CACHEDIR + "/environments/%s" % \
-            environment, "w+")
-    environment_definition = settings.ENV_METADATADIR + "/%s.yaml" % \
-            environment
-    hash_value = hash_object(environment_definition)
-    logging.debug("New cached hash for environment '%s' is '%s'" % \
-        (environment, hash_value))
-    # TODO: Add error handling here, if the cache can't be saved
-    # basically the environment will be regenerated in the next
-    # run (which is fine, but must be logged at INFO level)
-    hash_cache_file.write(hash_value)
-    hash_cache_file.close()
-
-def _remove_environment_annotation(settings, environment):
-    logging.debug("Removing cached hash for environment '%s'" % environment)
-    hash_cache_file = settings.CACHEDIR + "/environments/%s" % environment
+# Environments that have been purged are removed from the cache and
+# the ones that have been built are annotated with the hash of the
+# definition they were built from, so they're not rebuilt in the next
+# run unless the definition changes.
+def _update_cache(settings, cache, results, hashes):
+    changed = _report_errors(results)
+    for result in results:
+        environment = result['environment']
+        if result['purged']:
+            logging.debug("Removing cached hash for environment '%s'" % \
+                environment)
+            cache.pop(environment, None)
+        if result['refs'] is not None:
+            logging.debug("New cached hash for environment '%s' is '%s'" % \
+                (environment, hashes[environment]))
+            cache[environment] = {'hash': hashes[environment],
+                'refs': result['refs'], 'timestamp': time.time()}
+    if results:
+        # If the cache can't be saved the environments will be
+        # regenerated in the next run, which is fine.
+        try:
+            persist_environments_cache(settings, cache)
+            journal = JensJournalFactory.makeJournal(settings, "environments")
+            journal.checkpoint()
+        except (JensEnvironmentsError, JensJournalError), error:
+            logging.error("Failed to save the environments cache (%s)" % error)
+    return changed
+
+# Environments whose creation was interrupted are removed, so they're
+# created again from scratch, and interrupted purges are completed.
+# Either way they're dropped from the cache, which was not updated.
+def _recover_journal(settings, journal, cache):
+    entries = journal.pending()
+    if not entries:
+        return
+    logging.info("Recovering %d operation(s) of an interrupted run..." % \
+        len(entries))
+    for entry in entries:
+        if entry['operation'] == 'create' and entry['committed']:
+            continue
+        environment = entry['environment']
+        logging.debug("Rolling back %s of environment '%s'" % \
+            (entry['operation'], environment))
+        env_basepath = "%s/%s" % (settings.ENVIRONMENTSDIR, environment)
+        try:
+            if os.path.isdir(env_basepath):
+                shutil.rmtree(env_basepath)
+        except OSError, error:
+            logging.error("Unable to recover environment '%s' (%s)" % \
+                (environment, error))
+            continue
+        cache.pop(environment, None)
     try:
-        os.remove(hash_cache_file)
-    # This shouldn't ever happen unless someone deleted the file or
-    # changed its permissions externally
-    except OSError, error:
-        logging.error("Couldn't remove cached hash for environemnt '%s'" %
-            environment)
+        persist_environments_cache(settings, cache)
+        journal.checkpoint()
+    except (JensEnvironmentsError, JensJournalError), error:
+        logging.error("Failed to save the environments cache (%s)" % error)
+
+def _resolve_refs(settings, definition):
+    refs = {'default': None, 'overrides': {}}
+    if definition.get('default', None) is not None:
+        refs['default'] = refname_to_dirname(settings, definition['default'])
+    for partition, overrides in definition.get('overrides', {}).iteritems():
+        if partition in ("modules", "hostgroups", "common") and \
+                isinstance(overrides, dict):
+            refs['overrides'][partition] = dict([(element,
+                refname_to_dirname(settings, ref))
+                for element, ref in overrides.iteritems()])
+    return refs
+
+# Only the definitions that changed since the last time are read and,
+# if the metadata didn't move at all, not even that.
+def update_refs_index(settings):
+    index = read_refs_index(settings)
+    head = _get_metadata_head(settings)
+    if head is not None and index.head == head and not index.unreadable:
+        logging.debug("Environments metadata didn't change since %s" % head)
+        return index
+    names = sorted(get_names_of_declared_environments(settings))
+    hashes = dict(zip(names, hash_objects(
+        [settings.ENV_METADATADIR + "/%s.yaml" % name for name in names])))
+    modified = index.head != head or bool(index.unreadable)
+    index.head = head
+    index.unreadable = set()
+    for environment in set(index.environments).difference(names):
+        logging.debug("Removing '%s' from the refs index" % environment)
+        index.remove(environment)
+        modified = True
+    for environment in names:
+        if index.get_hash(environment) == hashes[environment]:
+            continue
+        modified = True
+        index.remove(environment)
+        try:
+            definition = read_environment_definition(settings, environment)
+        except JensEnvironmentsError, error:
+            # Not indexed, so it's retried (and reported) in the next run
+            logging.error("Unable to process '%s' definition. Skipping" % \
+                environment)
+            index.unreadable.add(environment)
+            continue
+        logging.debug("Indexing refs of '%s'" % environment)
+        index.add(settings, environment, hashes[environment], definition)
+    if modified:
+        try:
+            persist_refs_index(settings, index)
+        except JensEnvironmentsError, error:
+            logging.error(error)
+    return index
+
+def _get_metadata_head(settings):
+    try:
+        return get_head(settings.ENV_METADATADIR)
+    except JensGitError:
+        return None
 
 def get_names_of_declared_environments(settings):
     environments = os.listdir(settings.ENV_METADATADIR)
     environments = filter(lambda x: re.match("^.+?\.yaml$", x), environments)
     return map(lambda x: re.sub("\.yaml$", "", x), environments)
 
-def _calculate_delta(settings):
+def _calculate_delta(settings, cache):
     delta = {'notchanged': [], 'changed': []}
-    current_envs = set(os.listdir(settings.CACHEDIR + "/environments"))
+    current_envs = set(cache.keys())
     updated_envs = set(get_names_of_declared_environments(settings))
 
     delta['new'] = updated_envs.difference(current_envs)
     delta['deleted'] = current_envs.difference(updated_envs)
 
+    # The hashes are already in the refs index if it was built from the
+    # current metadata. The rest of the definitions are hashed at once.
+    index = read_refs_index(settings)
+    head = _get_metadata_head(settings)
+    delta['hashes'] = {}
+    if head is not None and index.head == head:
+        delta['hashes'] = dict([(name, index.get_hash(name))
+            for name in updated_envs if index.get_hash(name) is not None])
+    names = sorted(updated_envs.difference(delta['hashes']))
+    delta['hashes'].update(zip(names, hash_objects(
+        [settings.ENV_METADATADIR + "/%s.yaml" % name for name in names])))
+
     existing = updated_envs.intersection(current_envs)
 
     for environment in existing:
-        # TODO: Cache file should always be there, but check just in case
-        # and count it as changed if missing so the cache is generated again.
-        hash_cache_file = open(settings.CACHEDIR + "/environments/%s" %
-            environment)
-        old_hash = hash_cache_file.read()
-        hash_cache_file.close()
-        new_hash = hash_object(settings.ENV_METADATADIR + "/%s.yaml" %
-            environment)
-        if old_hash == new_hash:
+        if cache[environment]['hash'] == delta['hashes'][environment]:
             delta['notchanged'].append(environment)
         else:
             delta['changed'].append(environment)
@@ -462,16 +841,220 @@ def _link_common_hieradata(settings, environment, definition):
         except OSError, error:
             raise JensEnvironmentsError(error)
 
-def _add_configuration_file(settings, environment):
-    conf_file_path = "%s/%s/%s" % \
-        (settings.ENVIRONMENTSDIR, environment,
-        DIRECTORY_ENVIRONMENTS_CONF_FILENAME)
-    conf = """modulepath = modules:hostgroups
+def _add_configuration_file(settings, environment, definition):
+    env_basepath = "%s/%s" % (settings.ENVIRONMENTSDIR, environment)
+    conf_file_path = "%s/%s" % \
+        (env_basepath, DIRECTORY_ENVIRONMENTS_CONF_FILENAME)
+    modulepath = ["modules", "hostgroups"]
+    # Overrides take precedence as they come first
+    if _is_layered(settings, definition):
+        layer_path = os.path.relpath(_generate_layer_path(settings,
+            definition['default']), env_basepath)
+        modulepath.extend(["%s/modules" % layer_path,
+            "%s/hostgroups" % layer_path])
+    conf = """modulepath = %s
 manifest = site/site.pp
-"""
+""" % ":".join(modulepath)
     try:
         with open(conf_file_path, 'w') as conf_file:
             conf_file.write(conf)
     except IOError:
         raise JensEnvironmentsError("Unable to open %s for writing" % \
             conf_file_path)
+
+# Shared layers: when directory environments are enabled, every default
+# branch gets a single tree ($layersdir/$branch) containing links to all
+# the modules and hostgroups. Environments having a default only contain
+# their overrides and use the layer via the modulepath. The Hiera data
+# directories of a partition are links to the layer as well unless the
+# environment overrides something in it. If so, the directory only has
+# links to the clones of the overrides and to the layer's entries.
+
+def _shared_layers_enabled(settings):
+    return settings.DIRECTORY_ENVIRONMENTS and settings.SHARED_LAYERS
+
+def _is_layered(settings, definition):
+    return _shared_layers_enabled(settings) and \
+        definition.get('default', None) is not None
+
+def _is_in_shared_layer(link_name):
+    return os.path.islink(os.path.dirname(link_name))
+
+# Data of what isn't overridden is taken from the layer's entry
+def _generate_data_target(settings, definition, overridden, clone_target,
+        layer_entry):
+    if overridden or not _is_layered(settings, definition):
+        return clone_target
+    return "%s/%s" % (_generate_layer_path(settings, definition['default']),
+        layer_entry)
+
+def _generate_layer_path(settings, default):
+    return "%s/%s" % (settings.LAYERSDIR,
+        refname_to_dirname(settings, default))
+
+# The defaults in use are taken from the refs index, that is up to date
+# after refreshing the repositories, so no definitions have to be read.
+# Unreadable ones aren't indexed and are reported when processed.
+def _refresh_layers(settings, repositories_deltas, inventory):
+    needed = set()
+    for entry in update_refs_index(settings).environments.itervalues():
+        if entry['default'] is not None:
+            needed.add(refname_to_dirname(settings, entry['default']))
+    current = set(os.listdir(settings.LAYERSDIR))
+
+    for layer in current.difference(needed):
+        logging.info("Deleting shared layer '%s'" % layer)
+        shutil.rmtree("%s/%s" % (settings.LAYERSDIR, layer))
+
+    for layer in current.intersection(needed):
+        logging.debug("Refreshing shared layer '%s'" % layer)
+        for partition in ("modules", "hostgroups"):
+            for element in repositories_deltas[partition]['new']:
+                _unlink_layer_element(settings, partition, element, layer)
+                _link_layer_element(settings, partition, element, layer)
+            for element in repositories_deltas[partition]['deleted']:
+                _unlink_layer_element(settings, partition, element, layer)
+
+    for layer in needed.difference(current):
+        logging.info("Creating shared layer '%s'" % layer)
+        layer_path = "%s/%s" % (settings.LAYERSDIR, layer)
+        for directory in ("modules", "hostgroups", "hieradata/module_names",
+                "hieradata/hostgroups", "hieradata/fqdns"):
+            os.makedirs("%s/%s" % (layer_path, directory))
+        for partition in ("modules", "hostgroups"):
+            for element in inventory[partition].keys():
+                _link_layer_element(settings, partition, element, layer)
+
+def _generate_layer_links(settings, partition, element, layer):
+    layer_path = "%s/%s" % (settings.LAYERSDIR, layer)
+    clone_path = "%s/%s/%s/%s" % \
+        (settings.CLONEDIR, partition, element, layer)
+    if partition == 'modules':
+        return [("%s/modules/%s" % (layer_path, element),
+                "%s/code" % clone_path),
+            ("%s/hieradata/module_names/%s" % (layer_path, element),
+                "%s/data" % clone_path)]
+    return [("%s/hostgroups/hg_%s" % (layer_path, element),
+            "%s/code" % clone_path),
+        ("%s/hieradata/hostgroups/%s" % (layer_path, element),
+            "%s/data/hostgroup" % clone_path),
+        ("%s/hieradata/fqdns/%s" % (layer_path, element),
+            "%s/data/fqdns" % clone_path)]
+
+def _link_layer_element(settings, partition, element, layer):
+    for link_name, target in \
+            _generate_layer_links(settings, partition, element, layer):
+        try:
+            _symlink(target, link_name)
+        except JensEnvironmentsError, error:
+            logging.error("Failed to link %s '%s' in shared layer '%s' (%s)" % \
+                (partition, element, layer, error))
+
+def _unlink_layer_element(settings, partition, element, layer):
+    for link_name, target in \
+            _generate_layer_links(settings, partition, element, layer):
+        logging.debug("Making sure link '%s' does not exist" % link_name)
+        if os.path.islink(link_name):
+            os.unlink(link_name)
+
+def _symlink(target, link_name):
+    target = os.path.relpath(target, \
+        os.path.abspath(os.path.join(link_name, os.pardir)))
+    logging.debug("Linking %s to %s" % (link_name, target))
+    try:
+        os.symlink(target, link_name)
+    except OSError, error:
+        raise JensEnvironmentsError(error)
+
+# Code IDs: a fingerprint of all the code and data an environment is
+# made of, calculated from the commits its links point to. It's written
+# in the environment so it can be read cheaply (see jens-code-id).
+
+def read_code_id(settings, environment):
+    path = "%s/%s/%s" % (settings.ENVIRONMENTSDIR, environment,
+        CODE_ID_FILENAME)
+    try:
+        with open(path, 'r') as code_id_file:
+            return code_id_file.read().strip()
+    except IOError:
+        raise JensEnvironmentsError("Unable to read the code ID of '%s'" % \
+            environment)
+
+def _update_code_ids(settings, changed, notchanged, inventory):
+    # Not changed environments may lack the code ID if they were
+    # created before enabling the feature
+    environments = [environment for environment in notchanged
+        if not os.path.isfile("%s/%s/%s" % (settings.ENVIRONMENTSDIR,
+        environment, CODE_ID_FILENAME))]
+    environments.extend([environment for environment in changed
+        if os.path.isdir("%s/%s" % (settings.ENVIRONMENTSDIR, environment))])
+    if not environments:
+        return set()
+    heads = _get_clone_heads(settings, inventory)
+    data = [{'settings': settings, 'environment': environment,
+        'inventory': inventory, 'heads': heads}
+        for environment in environments]
+    return _report_errors(_run_in_pool(_update_code_id, data))
+
+# What every clone points to, read once for all the environments. Links
+# to broken clones are still content, so they're there as None.
+def _get_clone_heads(settings, inventory):
+    heads = {}
+    for partition in ("modules", "hostgroups", "common"):
+        for element in inventory[partition].keys():
+            element_path = "%s/%s/%s" % (settings.CLONEDIR, partition, element)
+            try:
+                dirnames = os.listdir(element_path)
+            except OSError:
+                continue
+            for dirname in dirnames:
+                clone_path = "%s/%s" % (element_path, dirname)
+                try:
+                    if os.path.islink(clone_path):
+                        # Commits are expanded under their full hash
+                        heads[clone_path] = os.path.basename(
+                            os.path.realpath(clone_path)).lstrip(".")
+                    else:
+                        heads[clone_path] = get_head(clone_path)
+                except JensGitError:
+                    heads[clone_path] = None
+    return heads
+
+def _update_code_id(data):
+    settings = data['settings']
+    environment = data['environment']
+    inventory = data['inventory']
+    heads = data['heads']
+    try:
+        definition = read_environment_definition(settings, environment)
+    except JensEnvironmentsError, error:
+        return _result(environment,
+            ["Unable to calculate code ID of '%s' (%s)" % (environment, error)])
+
+    components = []
+    for partition in ("modules", "hostgroups", "common"):
+        elements = inventory[partition].keys()
+        if partition != 'common' and definition.get('default', None) is None:
+            elements = set(elements).intersection(
+                definition.get('overrides', {}).get(partition, {}).keys())
+        for element in elements:
+            branch, overridden = _resolve_branch(settings, partition,
+                element, definition)
+            clone_path = "%s/%s/%s/%s" % \
+                (settings.CLONEDIR, partition, element, branch)
+            components.append("%s/%s %s %s" % \
+                (partition, element, branch, heads.get(clone_path)))
+
+    code_id = hashlib.sha1("\n".join(sorted(components))).hexdigest()
+    logging.debug("Code ID of environment '%s' is '%s'" % \
+        (environment, code_id))
+    path = "%s/%s/%s" % (settings.ENVIRONMENTSDIR, environment,
+        CODE_ID_FILENAME)
+    # Replaced at once, readers never see it half-written
+    try:
+        with open("%s.tmp" % path, 'w') as code_id_file:
+            code_id_file.write(code_id)
+        os.rename("%s.tmp" % path, path)
+    except (IOError, OSError):
+        return _result(environment, ["Unable to write %s" % path])
+    return _result(environment)
@@ -0,0 +1,95 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+import os
+import logging
+import pickle
+import shutil
+import tempfile
+
+from jens.errors import JensEnvironmentsError
+
+# The cache is a dictionary keyed by environment name. Every entry
+# contains the hash of the definition the environment was built from
+# ('hash'), the refs it was resolved to ('refs') and when it was built
+# ('timestamp'). It's written as a whole, atomically.
+
+def get_environments_cache(settings):
+    logging.info("Fetching environments cache...")
+    _migrate_legacy_cache(settings)
+    try:
+        return _read_cache_from_disk(settings)
+    except (IOError, EOFError, pickle.PickleError):
+        logging.warn("Environments cache not found or corrupt, starting afresh...")
+        return {}
+
+def read_environments_cache(settings):
+    if os.path.isdir(_get_legacy_cache_path(settings)):
+        return _read_legacy_cache(settings)
+    try:
+        return _read_cache_from_disk(settings)
+    except (IOError, EOFError, pickle.PickleError):
+        return {}
+
+def persist_environments_cache(settings, cache):
+    logging.info("Persisting environments cache...")
+    cache_file_path = _get_cache_path(settings)
+    try:
+        fd, temporary_path = tempfile.mkstemp(dir=settings.CACHEDIR,
+            prefix=".environments-")
+        with os.fdopen(fd, "wb") as cache_file:
+            pickle.dump(cache, cache_file, pickle.HIGHEST_PROTOCOL)
+            cache_file.flush()
+            os.fsync(cache_file.fileno())
+        logging.debug("Writing environments cache to %s" % cache_file_path)
+        os.rename(temporary_path, cache_file_path)
+    except (IOError, OSError, pickle.PickleError), error:
+        raise JensEnvironmentsError("Unable to write environments cache to disk (%s)" % \
+            error)
+
+def remove_environments_cache(settings):
+    cache_file_path = _get_cache_path(settings)
+    if os.path.exists(cache_file_path):
+        os.remove(cache_file_path)
+    legacy_path = _get_legacy_cache_path(settings)
+    if os.path.isdir(legacy_path):
+        shutil.rmtree(legacy_path)
+
+def _get_cache_path(settings):
+    return settings.CACHEDIR + "/environments.cache"
+
+def _get_legacy_cache_path(settings):
+    return settings.CACHEDIR + "/environments"
+
+def _read_cache_from_disk(settings):
+    with open(_get_cache_path(settings), "rb") as cache_file:
+        return pickle.load(cache_file)
+
+# Versions prior to the consolidated cache used a file per environment
+# containing only the hash of its definition.
+def _read_legacy_cache(settings):
+    cache = {}
+    legacy_path = _get_legacy_cache_path(settings)
+    for environment in os.listdir(legacy_path):
+        path = "%s/%s" % (legacy_path, environment)
+        with open(path, "r") as hash_cache_file:
+            cache[environment] = {'hash': hash_cache_file.read(),
+                'refs': None, 'timestamp': os.stat(path).st_mtime}
+    return cache
+
+def _migrate_legacy_cache(settings):
+    legacy_path = _get_legacy_cache_path(settings)
+    if not os.path.isdir(legacy_path):
+        return
+    if not os.path.exists(_get_cache_path(settings)):
+        logging.info("Migrating environments cache from %s..." % legacy_path)
+        try:
+            persist_environments_cache(settings, _read_legacy_cache(settings))
+        except (IOError, OSError), error:
+            raise JensEnvironmentsError("Unable to migrate environments cache (%s)" % \
+                error)
+    shutil.rmtree(legacy_path)
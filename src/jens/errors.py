@@ -25,3 +25,12 @@ class JensLockError(JensError):
 
 class JensLockExistsError(JensLockError):
     pass
+
+class JensNotificationError(JensError):
+    pass
+
+class JensJournalError(JensError):
+    pass
+
+class JensShardsError(JensError):
+    pass
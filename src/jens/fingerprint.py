@@ -0,0 +1,178 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+import os
+import math
+import logging
+import pickle
+import hashlib
+from multiprocessing import cpu_count, Value
+from multiprocessing.pool import ThreadPool
+
+import jens.git as git
+from jens.errors import JensGitError, JensRepositoriesError
+from jens.repossnapshot import get_repositories_definition
+from jens.journal import has_recoverable_journal
+
+# A fingerprint is what the remotes advertise (the heads of the metadata
+# repositories, of every bare's remote and of the remotes of declared
+# repositories that don't have a bare yet), the configuration and the
+# state of the clones. It's taken at the beginning of every run and
+# recorded once the run is over if it didn't report any error and the
+# local copies caught up with it. If the next run gets the same
+# fingerprint there's nothing to do.
+
+PARTITIONS = ("modules", "hostgroups", "common")
+
+# Returns None if any of the remotes can't be listed
+def take_fingerprint(settings, config_file_path):
+    logging.debug("Taking fingerprint of metadata and remotes...")
+    try:
+        with open(config_file_path, "rb") as config_file:
+            config = hashlib.sha1(config_file.read()).hexdigest()
+    except IOError, error:
+        logging.debug("Unable to read %s (%s)" % (config_file_path, error))
+        return None
+    try:
+        snapshot, changes = get_repositories_definition(settings)
+    except JensRepositoriesError, error:
+        logging.debug("Unable to read repositories definition (%s)" % error)
+        return None
+    targets = [(path, "origin", False) for path in _get_metadata_paths(settings)]
+    missing = []
+    for partition in PARTITIONS:
+        base_path = settings.BAREDIR + "/%s" % partition
+        names = os.listdir(base_path)
+        targets.extend([("%s/%s" % (base_path, name), "origin", True)
+            for name in sorted(names)])
+        # Whatever couldn't be cloned is retried if its remote changes
+        for name, url in sorted(snapshot['definition'][partition].iteritems()):
+            if name not in names:
+                missing.append(("%s/%s" % (partition, name), url))
+    targets.extend([(None, url, False) for key, url in missing])
+    pool = ThreadPool(processes=int(math.ceil(cpu_count()*1.5)))
+    try:
+        heads = pool.map(_list_heads, targets)
+    finally:
+        pool.close()
+        pool.join()
+    if None in heads:
+        return None
+    paths = [path for path, remote, bare in targets if path is not None]
+    return {'config': config,
+        'heads': dict(zip(paths, heads)),
+        'missing': dict(zip([key for key, url in missing],
+            heads[len(paths):])),
+        'clones': _get_clones_state(settings)}
+
+def matches_last_run(settings, fingerprint):
+    if _has_pending_journals(settings):
+        logging.debug("There are operations to recover, can't skip the run")
+        return False
+    try:
+        with open(_get_fingerprint_path(settings), "rb") as fingerprint_file:
+            return pickle.load(fingerprint_file) == fingerprint
+    except (IOError, EOFError, pickle.PickleError):
+        return False
+
+# The fingerprint is only recorded if all the local copies point to what
+# the remotes advertised, otherwise something failed or changed in the
+# meantime and the next run can't be skipped. The clones are the ones
+# the run left behind, so the next run only matches if they're intact.
+def record_fingerprint(settings, fingerprint):
+    fingerprint_path = _get_fingerprint_path(settings)
+    if not _is_up_to_date(settings, fingerprint):
+        logging.info("Local copies differ from the remotes, not recording fingerprint")
+        remove_fingerprint(settings)
+        return
+    logging.debug("Recording fingerprint in %s" % fingerprint_path)
+    fingerprint = dict(fingerprint, clones=_get_clones_state(settings))
+    temporary_path = "%s.tmp" % fingerprint_path
+    try:
+        with open(temporary_path, "wb") as fingerprint_file:
+            pickle.dump(fingerprint, fingerprint_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary_path, fingerprint_path)
+    except (IOError, OSError, pickle.PickleError), error:
+        logging.error("Unable to record fingerprint (%s)" % error)
+
+def remove_fingerprint(settings):
+    fingerprint_path = _get_fingerprint_path(settings)
+    if os.path.exists(fingerprint_path):
+        os.remove(fingerprint_path)
+
+# Counts the errors logged, including the ones logged by the processes
+# forked meanwhile, so the fingerprint is only recorded after a clean
+# run.
+class JensErrorsCounter(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.errors = Value('i', 0)
+
+    def emit(self, record):
+        with self.errors.get_lock():
+            self.errors.value += 1
+
+    def count(self):
+        return self.errors.value
+
+def _list_heads(target):
+    path, remote, bare = target
+    try:
+        return git.ls_remote(path, remote=remote, bare=bare)
+    except JensGitError, error:
+        logging.debug("Unable to list heads of %s (%s)" % \
+            (path or remote, error))
+        return None
+
+# Where every clone points to: its HEAD or, for links, their target
+def _get_clones_state(settings):
+    state = {}
+    for partition in PARTITIONS:
+        base_path = settings.CLONEDIR + "/%s" % partition
+        for name in os.listdir(base_path):
+            clones_path = "%s/%s" % (base_path, name)
+            if name.startswith(".") or not os.path.isdir(clones_path):
+                continue
+            for clone in os.listdir(clones_path):
+                clone_path = "%s/%s" % (clones_path, clone)
+                if os.path.islink(clone_path):
+                    state[clone_path] = os.readlink(clone_path)
+                    continue
+                try:
+                    state[clone_path] = git.get_head(clone_path)
+                except JensGitError:
+                    state[clone_path] = None
+    return state
+
+# Narrowed bares only have some of the branches the remote has, so only
+# those are compared.
+def _is_up_to_date(settings, fingerprint):
+    for path, heads in fingerprint['heads'].iteritems():
+        try:
+            if path in _get_metadata_paths(settings):
+                if git.get_head(path) != heads.get('master', None):
+                    return False
+                continue
+            refs = git.get_refs(path)
+        except JensGitError:
+            return False
+        if not settings.GIT_NARROWREFSPECS and set(refs) != set(heads):
+            return False
+        for refname, sha in refs.iteritems():
+            if heads.get(refname, None) != sha:
+                return False
+    return True
+
+def _has_pending_journals(settings):
+    return any([has_recoverable_journal(settings, name)
+        for name in ("repositories", "environments")])
+
+def _get_metadata_paths(settings):
+    return [settings.ENV_METADATADIR, settings.REPO_METADATADIR]
+
+def _get_fingerprint_path(settings):
+    return settings.CACHEDIR + "/fingerprint"
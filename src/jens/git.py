@@ -26,6 +26,15 @@ def hash_object(path):
     out, rc = _git(["hash-object", path])
     return out.strip()
 
+def hash_objects(paths):
+    logging.debug("Hashing %d objects" % len(paths))
+    hashes = []
+    # Keep the command line within a sane length
+    for index in range(0, len(paths), 500):
+        out, rc = _git(["hash-object"] + paths[index:index+500])
+        hashes.extend(out.split())
+    return hashes
+
 def gc(repository_path, aggressive=False, bare=False):
     logging.debug("Collecting garbage in %s" % repository_path)
     args = ["gc", "--quiet"]
@@ -35,11 +44,16 @@ def gc(repository_path, aggressive=False, bare=False):
         args.append("--aggressive")
     _git(args, gitdir=repository_path, timeout=GIT_GC_TIMEOUT)
 
-def clone(repository_path, url, bare=False, shared=False, branch=None):
+def clone(repository_path, url, bare=False, shared=False, branch=None,
+        depth=None, reference=None):
     logging.debug("Cloning from %s to %s" % (url, repository_path))
     args = ["clone", "--no-hardlinks"]
     if bare is True:
         args.extend(["--bare", "--mirror"])
+    if depth is not None:
+        args.extend(["--depth", str(depth), "--no-single-branch"])
+    if reference is not None:
+        args.extend(["--reference", reference])
     if shared is True:
         args.append("--shared")
     if branch is not None:
@@ -47,22 +61,98 @@ def clone(repository_path, url, bare=False, shared=False, branch=None):
     args.extend([url, repository_path])
     _git(args, timeout=GIT_CLONE_TIMEOUT)
 
-def fetch(repository_path, bare=False, prune=False):
+def init(repository_path, bare=False):
+    logging.debug("Initializing repository in %s" % repository_path)
+    args = ["init", "--quiet"]
+    if bare is True:
+        args.append("--bare")
+    args.append(repository_path)
+    _git(args)
+
+def fetch(repository_path, bare=False, prune=False, depth=None,
+        remote="origin", refspecs=None):
     logging.debug("Fetching new refs in %s" % repository_path)
     args = ["fetch", "--no-tags"]
     if prune is True:
         args.extend(["--prune"])
+    if depth is not None:
+        args.extend(["--depth", str(depth)])
     if bare is False:
         repository_path = "%s/.git" % repository_path
-    args.extend(["origin"])
+    args.append(remote)
+    args.extend(refspecs or [])
     _git(args, gitdir=repository_path, timeout=GIT_FETCH_TIMEOUT)
 
+# Fetches 'depth' more commits of history or all of it if no depth
+# is given
+def deepen(repository_path, depth=None, bare=False):
+    logging.debug("Deepening %s (%s)" % (repository_path, depth or "all"))
+    args = ["fetch", "--no-tags"]
+    if depth is None:
+        args.append("--unshallow")
+    else:
+        args.append("--deepen=%d" % depth)
+    if bare is False:
+        repository_path = "%s/.git" % repository_path
+    args.extend(["origin"])
+    _git(args, gitdir=repository_path, timeout=GIT_CLONE_TIMEOUT)
+
+def add_alternate(repository_path, objects_path, bare=False):
+    if bare is False:
+        repository_path = "%s/.git" % repository_path
+    alternates_path = "%s/objects/info/alternates" % repository_path
+    try:
+        if os.path.isfile(alternates_path):
+            if objects_path in open(alternates_path).read().split():
+                return False
+        logging.debug("Adding %s as alternate of %s" % \
+            (objects_path, repository_path))
+        with open(alternates_path, "a") as alternates:
+            alternates.write("%s\n" % objects_path)
+        return True
+    except IOError, error:
+        raise JensGitError("Unable to add alternate to %s (%s)" % \
+            (repository_path, error))
+
+# Removes the lock files left by Git processes that were killed
+# mid-flight. Only to be called when nobody else uses the repository.
+def remove_stale_locks(repository_path, bare=False):
+    if bare is False:
+        repository_path = "%s/.git" % repository_path
+    removed = []
+    for root, dirs, files in os.walk(repository_path):
+        if root == repository_path and "objects" in dirs:
+            dirs.remove("objects")
+        for name in files:
+            if name.endswith(".lock"):
+                path = os.path.join(root, name)
+                logging.debug("Removing stale lock %s" % path)
+                try:
+                    os.remove(path)
+                except OSError, error:
+                    raise JensGitError("Unable to remove %s (%s)" % \
+                        (path, error))
+                removed.append(os.path.relpath(path, repository_path))
+    return removed
+
+def is_shallow(repository_path, bare=False):
+    if bare is False:
+        repository_path = "%s/.git" % repository_path
+    return os.path.isfile("%s/shallow" % repository_path)
+
 def merge(repository_path, branchname):
     logging.debug("Merging in %s with origin/%s" % (repository_path, branchname))
     gitdir="%s/.git" % repository_path
     _git(["merge", "origin/%s" % branchname],
         gitdir=gitdir, gitworkingtree=repository_path)
 
+def checkout(repository_path, branchname, start_point):
+    logging.debug("Checking out %s in %s as %s" % \
+        (start_point, repository_path, branchname))
+    gitdir = "%s/.git" % repository_path
+    _git(["checkout", "--quiet", "-B", branchname, start_point],
+        gitdir=gitdir, gitworkingtree=repository_path)
+
 def reset(repository_path, treeish, hard=False):
     logging.debug("Resetting %s to %s" % (repository_path, treeish))
     gitdir = "%s/.git" % repository_path
@@ -72,6 +162,83 @@ def reset(repository_path, treeish, hard=False):
     args.append(treeish)
     _git(args, gitdir=gitdir, gitworkingtree=repository_path)
 
+def rev_parse(repository_path, treeish, bare=False):
+    logging.debug("Resolving %s in %s" % (treeish, repository_path))
+    if bare is False:
+        repository_path = "%s/.git" % repository_path
+    out, returncode = _git(["rev-parse", "--verify", "%s^{commit}" % treeish],
+        gitdir=repository_path)
+    return out.strip()
+
+# Checks out the tree of a commit without touching the repository's
+# index nor creating a repository in the destination.
+def export(repository_path, treeish, destination, bare=False):
+    logging.debug("Exporting %s from %s to %s" % \
+        (treeish, repository_path, destination))
+    if bare is False:
+        repository_path = "%s/.git" % repository_path
+    indexfile = "%s/.jens-index-%d" % (os.path.dirname(destination), os.getpid())
+    try:
+        _git(["read-tree", treeish], gitdir=repository_path,
+            indexfile=indexfile)
+        _git(["checkout-index", "--all", "--force"], gitdir=repository_path,
+            gitworkingtree=destination, indexfile=indexfile)
+    finally:
+        if os.path.exists(indexfile):
+            os.remove(indexfile)
+
+# Returns the branches available in a remote. If no repository is
+# given the remote has to be a URL.
+def ls_remote(repository_path, remote="origin", bare=False):
+    logging.debug("Listing branches of %s" % remote)
+    if repository_path is not None and bare is False:
+        repository_path = "%s/.git" % repository_path
+    out, returncode = _git(["ls-remote", "--heads", remote],
+        gitdir=repository_path, timeout=GIT_FETCH_TIMEOUT)
+    result = {}
+    for ref in out.strip().split('\n'):
+        if not ref:
+            continue
+        sha, name = ref.split("\t")
+        result[name[len("refs/heads/"):]] = sha
+    return result
+
+# Replaces all the values of a (multivar) configuration key
+def set_config(repository_path, key, values, bare=False):
+    logging.debug("Setting %s to %s in %s" % (key, values, repository_path))
+    if bare is False:
+        repository_path = "%s/.git" % repository_path
+    _git(["config", "--unset-all", key], gitdir=repository_path,
+        allowed_returncodes=[5])
+    for value in values:
+        _git(["config", "--add", key, value], gitdir=repository_path)
+
+def get_config(repository_path, key, bare=False):
+    if bare is False:
+        repository_path = "%s/.git" % repository_path
+    out, returncode = _git(["config", "--get-all", key],
+        gitdir=repository_path, allowed_returncodes=[1])
+    return out.split('\n')[:-1] if returncode == 0 else []
+
+def get_all_refs(repository_path, bare=False):
+    if bare is False:
+        repository_path = "%s/.git" % repository_path
+    out, returncode = _git(["for-each-ref", "--format=%(refname)"],
+        gitdir=repository_path)
+    return out.split()
+
+def delete_ref(repository_path, refname, bare=False):
+    logging.debug("Deleting %s from %s" % (refname, repository_path))
+    if bare is False:
+        repository_path = "%s/.git" % repository_path
+    _git(["update-ref", "-d", refname], gitdir=repository_path)
+
+def update_ref(repository_path, refname, sha, bare=False):
+    logging.debug("Pointing %s to %s in %s" % (refname, sha, repository_path))
+    if bare is False:
+        repository_path = "%s/.git" % repository_path
+    _git(["update-ref", refname, sha], gitdir=repository_path)
+
 def get_refs(repository_path):
     out, returncode = _git(["show-ref", "--heads"], gitdir=repository_path)
     result = {}
@@ -81,8 +248,30 @@ def get_refs(repository_path):
         result[name] = sha
     return result
 
+# Reads where HEAD points to straight from the repository to save
+# spawning a process per repository. rev-parse is the last resort.
+def get_head(repository_path, bare=False):
+    gitdir = repository_path if bare else "%s/.git" % repository_path
+    if not os.path.isdir(gitdir):
+        raise JensGitError("%s is not a Git repository" % repository_path)
+    try:
+        head = open("%s/HEAD" % gitdir).read().strip()
+        if not head.startswith("ref: "):
+            return head
+        refname = head[len("ref: "):]
+        if os.path.isfile("%s/%s" % (gitdir, refname)):
+            return open("%s/%s" % (gitdir, refname)).read().strip()
+        for line in open("%s/packed-refs" % gitdir):
+            if line.rstrip("\n").endswith(" %s" % refname):
+                return line.split(" ")[0]
+    except IOError:
+        pass
+    out, returncode = _git(["rev-parse", "HEAD"], gitdir=gitdir)
+    return out.strip()
+
 def _git(args, gitdir=None, gitworkingtree=None,
-        timeout=GIT_DEFAULT_SOFT_TIMEOUT):
+        timeout=GIT_DEFAULT_SOFT_TIMEOUT, indexfile=None,
+        allowed_returncodes=None):
     env = os.environ.copy()
     if gitdir is not None:
         logging.debug("Setting GIT_DIR to %s" % gitdir)
@@ -90,12 +279,15 @@ def _git(args, gitdir=None, gitworkingtree=None,
     if gitworkingtree is not None:
         logging.debug("Setting GIT_WORK_TREE to %s" % gitworkingtree)
         env['GIT_WORK_TREE'] = gitworkingtree
+    if indexfile is not None:
+        logging.debug("Setting GIT_INDEX_FILE to %s" % indexfile)
+        env['GIT_INDEX_FILE'] = indexfile
     env['GIT_HTTP_LOW_SPEED_TIME'] = str(timeout)
     env['GIT_HTTP_LOW_SPEED_LIMIT'] = "2000"
     args = [GITBINPATH] + args
     logging.debug("Executing git %s" % args)
     (returncode, stdout, stderr) = _exec(args, env, timeout)
-    if returncode != 0:
+    if returncode != 0 and returncode not in (allowed_returncodes or []):
         raise JensGitError("Couldn't execute git %s (%s)" % \
             (args, stderr.strip()))
     return (stdout, returncode)
@@ -0,0 +1,153 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+import os
+import json
+import uuid
+import errno
+import socket
+import logging
+
+from jens.errors import JensJournalError
+
+# Operations that modify the filesystem are recorded before starting
+# (begin) and once finished (commit) so, if a run is interrupted, the
+# next one knows which ones have to be rolled back or replayed. Entries
+# are appended (and synced) by the workers concurrently, one line each.
+# The journal is emptied (checkpoint) once the state it protects has
+# been persisted.
+#
+# Every run (the workers write to the journal of the process they were
+# forked from) has its own journal, named after the host and the PID,
+# as other nodes may be working on the same repositories meanwhile.
+# Only the journals of runs of this host that are dead are recovered,
+# the ones of other hosts are left to them.
+
+HOSTNAME = socket.gethostname()
+PID = os.getpid()
+
+class JensJournalFactory(object):
+    @staticmethod
+    def makeJournal(settings, name):
+        if settings.JOURNAL:
+            return JensJournal(settings, name)
+        return JensDumbJournal(settings, name)
+
+def has_recoverable_journal(settings, name):
+    journal = JensJournal(settings, name)
+    return os.path.exists(journal.path) or bool(journal.get_orphans())
+
+class JensJournal(object):
+    def __init__(self, settings, name):
+        self.cachedir = settings.CACHEDIR
+        self.name = name
+        self.path = "%s/journal.%s.%s.%d" % (self.cachedir, name,
+            HOSTNAME, PID)
+        self.recovered = []
+
+    def begin(self, operation, **details):
+        entry_id = uuid.uuid4().hex
+        details.update({'type': 'begin', 'id': entry_id,
+            'operation': operation})
+        self._append(details)
+        return entry_id
+
+    def commit(self, entry_id):
+        self._append({'type': 'commit', 'id': entry_id})
+
+    # Returns the operations that were started by this run or by dead
+    # ones of this host, in order, flagging whether they finished or not
+    def pending(self):
+        entries = []
+        committed = set()
+        self.recovered = self.get_orphans()
+        for path in [self.path] + self.recovered:
+            try:
+                journal_file = open(path, "r")
+            except IOError:
+                continue
+            with journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be incomplete
+                        logging.warn("Ignoring corrupt journal entry in %s" \
+                            % path)
+                        continue
+                    if entry['type'] == 'begin':
+                        entries.append(entry)
+                    else:
+                        committed.add(entry['id'])
+        for entry in entries:
+            entry['committed'] = entry['id'] in committed
+        return entries
+
+    def checkpoint(self):
+        for path in [self.path] + self.recovered:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError, error:
+                raise JensJournalError("Unable to empty journal %s (%s)" % \
+                    (path, error))
+        self.recovered = []
+
+    # Journals left by runs of this host that aren't alive anymore,
+    # including the one shared by all of them before it was per run
+    def get_orphans(self):
+        orphans = []
+        legacy = "journal.%s" % self.name
+        prefix = "%s.%s." % (legacy, HOSTNAME)
+        try:
+            filenames = os.listdir(self.cachedir)
+        except OSError:
+            return []
+        for filename in sorted(filenames):
+            if filename == legacy:
+                orphans.append("%s/%s" % (self.cachedir, filename))
+            elif filename.startswith(prefix):
+                try:
+                    pid = int(filename[len(prefix):])
+                except ValueError:
+                    continue
+                if pid != PID and not _is_alive(pid):
+                    orphans.append("%s/%s" % (self.cachedir, filename))
+        return orphans
+
+    def _append(self, entry):
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0640)
+            try:
+                os.write(fd, json.dumps(entry) + "\n")
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError, error:
+            raise JensJournalError("Unable to write to journal %s (%s)" % \
+                (self.path, error))
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, error:
+        return error.errno != errno.ESRCH
+    return True
+
+class JensDumbJournal(JensJournal):
+    def begin(self, operation, **details):
+        return None
+
+    def commit(self, entry_id):
+        pass
+
+    def pending(self):
+        return []
+
+    def checkpoint(self):
+        pass
@@ -5,38 +5,89 @@
 # granted to it by virtue of its status as Intergovernmental Organization
 # or submit itself to any jurisdiction.
 
+import os
+import socket
 import logging
 import time
+import fcntl
 from urllib3.exceptions import TimeoutError
 
 from jens.errors import JensLockError, JensLockExistsError
 
+# Locks are hierarchical. Below the global one (LOCK_NAME) there's one
+# per partition and, below those, one per repository. Any of them can
+# be taken in shared or exclusive mode but, before taking one, all its
+# ancestors have to be held at least in shared mode. That way jens-gc
+# and jens-update (which hold the global lock shared) can work on
+# different repositories at the same time, whereas jens-reset (which
+# takes it exclusively) waits for both. jens-update also takes the
+# 'update' lock exclusively so only one run happens at a time.
+#
+# In etcd the global lock is a python-etcd lock that is only held
+# briefly to register sharers (under LOCK_NAME.shared) or, exclusively,
+# for as long as needed once the sharers are gone. The locks below it
+# are plain keys: /<name>/owner for the exclusive holder and
+# /<name>/shared/* for the sharers. All of them have a TTL, so they go
+# away if their holder dies, and renewing the global lock renews the
+# ones below it held by the same process too.
+
 class JensLockFactory(object):
     @staticmethod
-    def makeLock(settings, tries=1, waittime=10):
+    def makeLock(settings, tries=1, waittime=10, shared=False, resource=()):
         if settings.LOCK_TYPE == 'FILE':
-            return JensFileLock(settings, tries, waittime)
+            return JensFileLock(settings, tries, waittime, shared, resource)
         elif settings.LOCK_TYPE == 'ETCD':
+            if resource:
+                return JensEtcdResourceLock(settings, tries, waittime,
+                    shared, resource)
+            if shared:
+                return JensEtcdSharedLock(settings, tries, waittime)
             return JensEtcdLock(settings, tries, waittime)
         elif settings.LOCK_TYPE == 'DISABLED':
-            logging.warn("Danger zone: no locking has been configured!")
-            return JensDumbLock(settings, tries, waittime)
+            if not resource:
+                logging.warn("Danger zone: no locking has been configured!")
+            return JensDumbLock(settings, tries, waittime, shared, resource)
         else: # Shouldn't ever happen, config is validated
             raise JensLockError("Unknown lock type '%s'", settings.LOCK_TYPE)
 
+    @staticmethod
+    def makePartitionLock(settings, partition, tries=1, waittime=10,
+            shared=False):
+        return JensLockFactory.makeLock(settings, tries, waittime, shared,
+            (partition,))
+
+    @staticmethod
+    def makeRepositoryLock(settings, partition, name, tries=1, waittime=10,
+            shared=False):
+        return JensLockFactory.makeLock(settings, tries, waittime, shared,
+            (partition, name))
+
+    # Next to the repositories of the partition, as any of them can
+    # write to it (see jens.objectpools)
+    @staticmethod
+    def makePoolLock(settings, partition, tries=1, waittime=10):
+        return JensLockFactory.makeLock(settings, tries, waittime, False,
+            (partition, ".pool"))
+
 class JensLock(object):
-    def __init__(self, settings, tries, waittime):
+    def __init__(self, settings, tries, waittime, shared=False, resource=()):
         self.settings = settings
         self.tries = tries
         self.waittime = waittime
+        self.shared = shared
+        self.resource = tuple(resource)
+        self.name = ".".join((settings.LOCK_NAME,) + self.resource)
+        # Only the global lock is worth the noise
+        self.log = logging.debug if self.resource else logging.info
 
     def __enter__(self):
         for attempt in range(1, self.tries+1):
-            logging.info("Obtaining lock '%s' (attempt: %d)..." %
-                (self.settings.LOCK_NAME, attempt))
+            self.log("Obtaining lock '%s' (mode: %s, attempt: %d)..." %
+                (self.name, "shared" if self.shared else "exclusive",
+                attempt))
             try:
                 self.obtain_lock()
-                logging.debug("Lock acquired")
+                logging.debug("Lock '%s' acquired" % self.name)
                 return self
             except JensLockExistsError, error:
                 if attempt == self.tries:
@@ -47,15 +98,15 @@ class JensLock(object):
                     time.sleep(self.waittime)
 
     def __exit__(self, type, value, traceback):
-        logging.info("Releasing lock '%s'..." % self.settings.LOCK_NAME)
+        self.log("Releasing lock '%s'..." % self.name)
         self.release_lock()
 
     def renew(self, ttl=10):
         if ttl <= 0:
             logging.warn("Invalid new TTL, resetting to 1 by default")
             ttl = 1
-        logging.info("Setting '%s' lock TTL to %d secs..." % \
-            (self.settings.LOCK_NAME, ttl))
+        self.log("Setting '%s' lock TTL to %d secs..." % \
+            (self.name, ttl))
         self.renew_lock(ttl)
 
 class JensFileLock(JensLock):
@@ -66,22 +117,27 @@ class JensFileLock(JensLock):
         except IOError, error:
             raise JensLockError("Can't open lock file for writing (%s)" % error)
 
-        import fcntl
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
         try:
-            fcntl.flock(self.lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(self.lockfile, mode | fcntl.LOCK_NB)
         except IOError, error:
-            raise JensLockExistsError("Lock already taken")
+            self.lockfile.close()
+            raise JensLockExistsError("Lock '%s' already taken" % self.name)
 
+    # Locks below the global one are taken and released many times by
+    # the same process, so they can't wait until it finishes.
     def release_lock(self):
-        # Nothing to do, the OS will close the FDs after finishing.
-        pass
+        try:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+        finally:
+            self.lockfile.close()
 
     def renew_lock(self, ttl):
         # Nothing to do, local lock
         pass
 
     def __get_lock_file_path(self):
-        return self.settings.FILELOCK_LOCKDIR + "/%s" % self.settings.LOCK_NAME
+        return self.settings.FILELOCK_LOCKDIR + "/%s" % self.name
 
 class JensDumbLock(JensLock):
     def obtain_lock(self):
@@ -94,25 +150,38 @@ class JensDumbLock(JensLock):
         pass
 
 class JensEtcdLock(JensLock):
-    def __init__(self, settings, tries, waittime):
+    def __init__(self, settings, tries, waittime, shared=False, resource=()):
         try:
-            super(JensEtcdLock, self).__init__(settings, tries, waittime)
+            super(JensEtcdLock, self).__init__(settings, tries, waittime,
+                shared, resource)
             import etcd
             self.etcd = etcd
         except ImportError:
             raise JensLockError("python-etcd not installed")
+        self.sharers_key = "/%s.shared" % settings.LOCK_NAME
 
     def obtain_lock(self):
+        self.acquire_exclusive()
+        # Nodes holding it shared have to finish first
+        deadline = time.time() + self.settings.ETCD_ACQTIMEOUT
+        try:
+            while self.get_sharers():
+                if time.time() >= deadline:
+                    raise JensLockExistsError("Lock '%s' is shared by %s" % \
+                        (self.name, ", ".join(self.get_sharers())))
+                time.sleep(1)
+        except:
+            self.release_lock()
+            raise
+
+    def acquire_exclusive(self):
         from urllib3.exceptions import TimeoutError
-        servers = map(lambda x: x.split(':'), self.settings.ETCD_SERVERS)
-        servers = map(lambda x: (x[0], int(x[1]) if len(x) > 1 else 4001), servers)
-        logging.debug("Etcd servers: %s", servers)
         try:
-            client = self.etcd.Client(host=tuple(servers), allow_redirect=True,
-                allow_reconnect=True)
+            self.client = make_etcd_client(self.settings, self.etcd)
+            client = self.client
             logging.debug("Current leader: %s" % client.leader)
             logging.debug("Machines in the cluster: %s" % client.machines)
-            self.lock = client.get_lock('/%s' % self.settings.LOCK_NAME,
+            self.lock = client.get_lock('/%s' % self.name,
                 ttl=self.settings.ETCD_INITIALTTL)
             self.lock.acquire(timeout=self.settings.ETCD_ACQTIMEOUT)
         except TimeoutError:
@@ -139,3 +208,144 @@ class JensEtcdLock(JensLock):
             raise JensLockError("The connection timed out when renewing the lock")
         except self.etcd.EtcdException, error:
             raise JensLockError("Etcd lock renewal failed: '%s'" % error)
+        JensEtcdResourceLock.renew_held(ttl)
+
+    def get_sharers(self):
+        try:
+            directory = self.client.read(self.sharers_key, recursive=True)
+        except self.etcd.EtcdKeyNotFound:
+            return []
+        except self.etcd.EtcdException, error:
+            raise JensLockError("Unable to read sharers of '%s' (%s)" % \
+                (self.name, error))
+        return [leaf.key.split("/")[-1] for leaf in directory.leaves
+            if not leaf.dir]
+
+# Registered with a TTL, so it goes away if the node dies
+class JensEtcdSharedLock(JensEtcdLock):
+    def __init__(self, settings, tries, waittime, shared=True, resource=()):
+        super(JensEtcdSharedLock, self).__init__(settings, tries, waittime,
+            shared, resource)
+        self.key = "%s/%s:%d:%x" % (self.sharers_key, socket.gethostname(),
+            os.getpid(), id(self))
+
+    def obtain_lock(self):
+        self.acquire_exclusive()
+        try:
+            self.client.write(self.key, self.name,
+                ttl=self.settings.ETCD_INITIALTTL)
+        except self.etcd.EtcdException, error:
+            raise JensLockError("Unable to share lock '%s' (%s)" % \
+                (self.name, error))
+        finally:
+            JensEtcdLock.release_lock(self)
+
+    def release_lock(self):
+        try:
+            self.client.delete(self.key)
+        except self.etcd.EtcdKeyNotFound:
+            pass # Expired
+        except self.etcd.EtcdException, error:
+            raise JensLockError("Unable to release lock '%s' (%s)" % \
+                (self.name, error))
+
+    def renew_lock(self, ttl, timeout=3):
+        try:
+            self.client.write(self.key, self.name, ttl=ttl, prevExist=True)
+        except self.etcd.EtcdException, error:
+            raise JensLockError("Etcd lock renewal failed: '%s'" % error)
+        JensEtcdResourceLock.renew_held(ttl)
+
+# Non-blocking, like flocks. Exclusive holders write the owner key and
+# sharers their own key, then check whether the other kind is there,
+# backing off if so. Whatever order the writes happen in, at least one
+# of two contenders sees the other.
+class JensEtcdResourceLock(JensLock):
+    # Held by this process and the TTL they're renewed to
+    held = set()
+    ttl = None
+
+    def __init__(self, settings, tries, waittime, shared=False, resource=()):
+        super(JensEtcdResourceLock, self).__init__(settings, tries, waittime,
+            shared, resource)
+        try:
+            import etcd
+            self.etcd = etcd
+        except ImportError:
+            raise JensLockError("python-etcd not installed")
+        self.token = "%s:%d:%x" % (socket.gethostname(), os.getpid(), id(self))
+        self.owner_key = "/%s/owner" % self.name
+        self.sharers_key = "/%s/shared" % self.name
+        self.key = "%s/%s" % (self.sharers_key, self.token) \
+            if shared else self.owner_key
+
+    @classmethod
+    def renew_held(cls, ttl):
+        cls.ttl = ttl
+        for lock in list(cls.held):
+            lock.renew_lock(ttl)
+
+    def obtain_lock(self):
+        ttl = JensEtcdResourceLock.ttl or self.settings.ETCD_INITIALTTL
+        try:
+            self.client = make_etcd_client(self.settings, self.etcd)
+            try:
+                self.client.write(self.key, self.token, ttl=ttl,
+                    prevExist=False)
+            except self.etcd.EtcdAlreadyExist:
+                raise JensLockExistsError("Lock '%s' already taken" % \
+                    self.name)
+            if self.shared:
+                taken = self.__is_owned()
+            else:
+                taken = len(self.__get_sharers()) > 0
+            if taken:
+                self.__delete()
+                raise JensLockExistsError("Lock '%s' already taken" % \
+                    self.name)
+        except self.etcd.EtcdException, error:
+            raise JensLockError("Etcd locking failed: '%s'" % error)
+        JensEtcdResourceLock.held.add(self)
+
+    def release_lock(self):
+        JensEtcdResourceLock.held.discard(self)
+        try:
+            self.__delete()
+        except self.etcd.EtcdException, error:
+            raise JensLockError("Etcd locking failed: '%s'" % error)
+
+    def renew_lock(self, ttl):
+        try:
+            self.client.write(self.key, self.token, ttl=ttl,
+                prevValue=self.token)
+        except self.etcd.EtcdKeyNotFound:
+            raise JensLockError("Lock '%s' expired" % self.name)
+        except self.etcd.EtcdException, error:
+            raise JensLockError("Etcd lock renewal failed: '%s'" % error)
+
+    def __delete(self):
+        try:
+            self.client.delete(self.key, prevValue=self.token)
+        except (self.etcd.EtcdKeyNotFound, self.etcd.EtcdCompareFailed):
+            pass # Expired
+
+    def __is_owned(self):
+        try:
+            self.client.read(self.owner_key)
+            return True
+        except self.etcd.EtcdKeyNotFound:
+            return False
+
+    def __get_sharers(self):
+        try:
+            directory = self.client.read(self.sharers_key, recursive=True)
+        except self.etcd.EtcdKeyNotFound:
+            return []
+        return [leaf.key for leaf in directory.leaves if not leaf.dir]
+
+def make_etcd_client(settings, etcd):
+    servers = map(lambda x: x.split(':'), settings.ETCD_SERVERS)
+    servers = map(lambda x: (x[0], int(x[1]) if len(x) > 1 else 4001), servers)
+    logging.debug("Etcd servers: %s", servers)
+    return etcd.Client(host=tuple(servers), allow_redirect=True,
+        allow_reconnect=True)
@@ -7,21 +7,38 @@
 
 import os
 import logging
+from multiprocessing.pool import ThreadPool
 
 import jens.git as git
 from jens.errors import JensError, JensGitError
 from jens.git import GIT_CLONE_TIMEOUT, GIT_FETCH_TIMEOUT
 
+# Both metadata repositories are refreshed at the same time. Returns
+# their HEADs before and after the refresh, keyed by 'environments'
+# and 'repositories'.
 def refresh_metadata(settings, lock):
-    lock.renew(2 * GIT_FETCH_TIMEOUT)
-    _refresh_environments(settings)
-    _refresh_repositories(settings)
+    lock.renew(GIT_FETCH_TIMEOUT)
+    pool = ThreadPool(processes=2)
+    try:
+        jobs = [(name, pool.apply_async(function, (settings,)))
+            for name, function in (('environments', _refresh_environments),
+            ('repositories', _refresh_repositories))]
+        heads = dict([(name, job.get()) for name, job in jobs])
+    finally:
+        pool.close()
+        pool.join()
+    for name, (before, after) in sorted(heads.iteritems()):
+        if before == after:
+            logging.info("No changes in %s metadata (%s)" % (name, after))
+        else:
+            logging.info("%s metadata moved from %s to %s" % \
+                (name.capitalize(), before, after))
+    return heads
 
 def validate_directories(settings):
     directories = [settings.BAREDIR,
         settings.CLONEDIR,
         settings.CACHEDIR,
-        settings.CACHEDIR + "/environments",
         settings.REPO_METADATADIR,
         settings.ENV_METADATADIR]
 
@@ -32,6 +49,12 @@ def validate_directories(settings):
     for directory in directories:
         _validate_directory(directory)
 
+    if settings.DIRECTORY_ENVIRONMENTS and settings.SHARED_LAYERS:
+        _validate_directory(settings.LAYERSDIR)
+
+    if settings.COMMITCACHE_ENABLED:
+        _validate_directory(settings.COMMITCACHE_DIR)
+
     if settings.LOCK_TYPE == 'FILE':
         _validate_directory(settings.FILELOCK_LOCKDIR)
 
@@ -55,8 +78,10 @@ def _refresh_environments(settings):
     logging.debug("Refreshing environment metadata...")
     path = settings.ENV_METADATADIR
     try:
+        before = git.get_head(path)
         git.fetch(path)
         git.reset(path, "origin/master", hard=True)
+        return (before, git.get_head(path))
     except JensGitError, error:
         raise JensError("Couldn't refresh environments metadata (%s)" % error)
 
@@ -64,7 +89,9 @@ def _refresh_repositories(settings):
     logging.debug("Refreshing repositories metadata...")
     path = settings.REPO_METADATADIR
     try:
+        before = git.get_head(path)
         git.fetch(path)
         git.reset(path, "origin/master", hard=True)
+        return (before, git.get_head(path))
     except JensGitError, error:
         raise JensError("Couldn't refresh repositories metadata (%s)" % error)
@@ -0,0 +1,73 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+import logging
+import urllib
+import urllib3
+
+from jens.errors import JensNotificationError
+
+class JensNotifierFactory(object):
+    @staticmethod
+    def makeNotifier(settings):
+        if settings.NOTIFICATIONS_TYPE == 'PUPPETSERVER':
+            return JensPuppetServerNotifier(settings)
+        elif settings.NOTIFICATIONS_TYPE == 'DISABLED':
+            return JensDumbNotifier(settings)
+        else: # Shouldn't ever happen, config is validated
+            raise JensNotificationError("Unknown notifier type '%s'" % \
+                settings.NOTIFICATIONS_TYPE)
+
+class JensNotifier(object):
+    def __init__(self, settings):
+        self.settings = settings
+
+    def notify(self, environments):
+        if not environments:
+            logging.debug("No environments changed, nothing to notify")
+            return
+        logging.info("Notifying changes in %d environment(s)..." % \
+            len(environments))
+        self.notify_changes(sorted(environments))
+
+class JensDumbNotifier(JensNotifier):
+    def notify_changes(self, environments):
+        pass
+
+# Flushes only the environments that have changed from the Puppet
+# Server's environment cache (puppet-admin-api/v1/environment-cache)
+class JensPuppetServerNotifier(JensNotifier):
+    def __init__(self, settings):
+        super(JensPuppetServerNotifier, self).__init__(settings)
+        kwargs = {'timeout': urllib3.Timeout(total=settings.PUPPETSERVER_TIMEOUT),
+            'retries': False}
+        if settings.PUPPETSERVER_SSLCERT is not None:
+            kwargs['cert_file'] = settings.PUPPETSERVER_SSLCERT
+            kwargs['key_file'] = settings.PUPPETSERVER_SSLKEY
+        if settings.PUPPETSERVER_CACERT is not None:
+            kwargs['cert_reqs'] = 'CERT_REQUIRED'
+            kwargs['ca_certs'] = settings.PUPPETSERVER_CACERT
+        self.http = urllib3.PoolManager(**kwargs)
+
+    def notify_changes(self, environments):
+        failed = []
+        for environment in environments:
+            url = "%s?%s" % (self.settings.PUPPETSERVER_URL,
+                urllib.urlencode({'environment': environment}))
+            logging.debug("Flushing environment cache (DELETE %s)" % url)
+            try:
+                response = self.http.request('DELETE', url)
+            except urllib3.exceptions.HTTPError, error:
+                logging.debug("Request failed (%s)" % error)
+                failed.append(environment)
+                continue
+            if response.status not in (200, 204):
+                logging.debug("Request failed (HTTP %d)" % response.status)
+                failed.append(environment)
+        if failed:
+            raise JensNotificationError("Couldn't flush the cache of %s" % \
+                ", ".join(failed))
@@ -0,0 +1,68 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+import os
+import logging
+
+import jens.git as git
+
+# Bares of the same partition can share objects through a pool, a bare
+# repository in BAREDIR/.pools/<partition> that all of them use as
+# alternate. The refs of every member are copied to the pool under
+# refs/members/<name>/ so garbage collecting the pool never drops
+# objects that a member still needs.
+
+def get_pool_path(settings, partition):
+    return settings.BAREDIR + "/.pools/%s" % partition
+
+def ensure_pool(settings, partition):
+    pool_path = get_pool_path(settings, partition)
+    if not os.path.isdir(pool_path):
+        logging.info("Creating object pool for %s in %s" % \
+            (partition, pool_path))
+        git.init(pool_path, bare=True)
+    return pool_path
+
+# Returns whether the bare wasn't a member yet
+def join_pool(settings, partition, bare_path):
+    pool_path = ensure_pool(settings, partition)
+    return git.add_alternate(bare_path, "%s/objects" % pool_path, bare=True)
+
+def is_pool_member(settings, partition, bare_path):
+    alternates_path = "%s/objects/info/alternates" % bare_path
+    try:
+        return "%s/objects" % get_pool_path(settings, partition) in \
+            open(alternates_path).read().split()
+    except IOError:
+        return False
+
+def sync_pool(settings, partition, name, bare_path):
+    logging.debug("Copying refs of %s/%s to the object pool" % \
+        (partition, name))
+    git.fetch(get_pool_path(settings, partition), bare=True, prune=True,
+        remote=bare_path,
+        refspecs=["+refs/heads/*:refs/members/%s/heads/*" % name])
+
+def leave_pool(settings, partition, name):
+    pool_path = get_pool_path(settings, partition)
+    if not os.path.isdir(pool_path):
+        return
+    logging.debug("Removing refs of %s/%s from the object pool" % \
+        (partition, name))
+    prefix = "refs/members/%s/" % name
+    for refname in git.get_all_refs(pool_path, bare=True):
+        if refname.startswith(prefix):
+            git.delete_ref(pool_path, refname, bare=True)
+
+# Refs of all the members are refreshed first so everything that is
+# reachable from any of them is kept.
+def gc_pool(settings, partition, aggressive=False):
+    pool_path = get_pool_path(settings, partition)
+    base_path = settings.BAREDIR + "/%s" % partition
+    for name in os.listdir(base_path):
+        sync_pool(settings, partition, name, "%s/%s" % (base_path, name))
+    git.gc(pool_path, aggressive=aggressive, bare=True)
@@ -0,0 +1,40 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+import os
+import fcntl
+import shutil
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+# Copies a tree sharing the data blocks with the original (XFS, btrfs...)
+# Raises IOError if the filesystem doesn't support it.
+def reflink_tree(source, destination):
+    os.mkdir(destination)
+    for root, dirs, files in os.walk(source):
+        target_root = os.path.normpath(os.path.join(destination,
+            os.path.relpath(root, source)))
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target)
+            elif os.path.isdir(path):
+                os.mkdir(target)
+                shutil.copymode(path, target)
+            else:
+                reflink(path, target)
+
+# Modes and times are preserved so the index of a copied
+# checkout doesn't consider all the files as modified.
+def reflink(source, destination):
+    with open(source, 'rb') as source_file:
+        with open(destination, 'wb') as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE,
+                source_file.fileno())
+    shutil.copystat(source, destination)
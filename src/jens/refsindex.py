@@ -0,0 +1,143 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+import os
+import logging
+import pickle
+import tempfile
+
+from jens.errors import JensEnvironmentsError
+from jens.tools import ref_is_commit
+from jens.tools import refname_to_dirname
+
+# Reverse index of the refs used by every environment, so knowing which
+# environments use a given ref doesn't require reading all the
+# definitions. It's kept in CACHEDIR/refs.index and updated by
+# environments.update_refs_index, that only reads again the definitions
+# whose hash changed.
+
+class RefsIndex(object):
+    def __init__(self):
+        # HEAD of the environments metadata the index was built from
+        self.head = None
+        # Environments whose definition couldn't be read
+        self.unreadable = set()
+        # Environment -> {'hash', 'default', 'overrides', 'keys'}
+        self.environments = {}
+        # (partition, element, dirname) -> environments overriding it
+        self.overriders = {}
+        # (partition, element) -> environments overriding it at all
+        self.overridden = {}
+        # (scope, dirname) -> environments using it as default. Scope is
+        # None for all the partitions or 'common' for environments
+        # without default, that get 'master' for that partition.
+        self.defaults = {}
+
+    def add(self, settings, environment, digest, definition):
+        self.remove(environment)
+        default, scope = None, None
+        if 'default' not in definition:
+            default, scope = 'master', 'common'
+        elif definition['default'] is not None:
+            default = definition['default']
+        overrides = {}
+        for partition, elements in \
+                (definition.get('overrides', None) or {}).iteritems():
+            if partition in ("modules", "hostgroups", "common") and \
+                    isinstance(elements, dict):
+                overrides[partition] = dict(elements)
+        # Where the environment is indexed, to remove it later on
+        keys = []
+        if default is not None:
+            keys.append(('defaults', (scope, _to_dirname(settings, default))))
+        for partition, elements in overrides.iteritems():
+            for element, ref in elements.iteritems():
+                keys.append(('overriders',
+                    (partition, element, _to_dirname(settings, ref))))
+                keys.append(('overridden', (partition, element)))
+        for name, key in keys:
+            getattr(self, name).setdefault(key, set()).add(environment)
+        self.environments[environment] = {'hash': digest,
+            'default': default if scope is None else None,
+            'overrides': overrides, 'keys': keys}
+
+    def remove(self, environment):
+        entry = self.environments.pop(environment, None)
+        if entry is None:
+            return
+        for name, key in entry['keys']:
+            mapping = getattr(self, name)
+            environments = mapping.get(key, set())
+            environments.discard(environment)
+            if not environments:
+                mapping.pop(key, None)
+
+    def get_hash(self, environment):
+        entry = self.environments.get(environment, None)
+        return entry['hash'] if entry is not None else None
+
+    # Environments whose clone of element (in partition) is the one of
+    # refname, either because it's overridden to it or by default.
+    def users_of(self, settings, partition, element, refname):
+        dirname = _to_dirname(settings, refname)
+        users = set(self.overriders.get((partition, element, dirname), ()))
+        defaulted = set(self.defaults.get((None, dirname), ()))
+        if partition == 'common':
+            defaulted.update(self.defaults.get(('common', dirname), ()))
+        return users.union(defaulted.difference(
+            self.overridden.get((partition, element), ())))
+
+    def refs_of(self, environment):
+        entry = self.environments.get(environment, None)
+        if entry is None:
+            return None
+        return {'default': entry['default'], 'overrides': entry['overrides']}
+
+    # Refs needed by overrides, per partition and element. Overrides to
+    # commits are case-insensitive so they're lowercased.
+    def get_overrides(self, settings):
+        overrides = {'modules': {}, 'hostgroups': {}, 'common': {}}
+        for entry in self.environments.itervalues():
+            for partition, elements in entry['overrides'].iteritems():
+                for element, ref in elements.iteritems():
+                    if ref_is_commit(settings, ref):
+                        ref = ref.lower()
+                    refs = overrides[partition].setdefault(element, [])
+                    if ref not in refs:
+                        refs.append(ref)
+        return overrides
+
+def read_refs_index(settings):
+    try:
+        with open(_get_index_path(settings), "rb") as index_file:
+            return pickle.load(index_file)
+    except (IOError, EOFError, pickle.PickleError):
+        return RefsIndex()
+
+def persist_refs_index(settings, index):
+    logging.debug("Persisting refs index...")
+    try:
+        fd, temporary_path = tempfile.mkstemp(dir=settings.CACHEDIR,
+            prefix=".refs-")
+        with os.fdopen(fd, "wb") as index_file:
+            pickle.dump(index, index_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary_path, _get_index_path(settings))
+    except (IOError, OSError, pickle.PickleError), error:
+        raise JensEnvironmentsError("Unable to write refs index to disk (%s)" % \
+            error)
+
+def remove_refs_index(settings):
+    if os.path.exists(_get_index_path(settings)):
+        os.remove(_get_index_path(settings))
+
+def _get_index_path(settings):
+    return settings.CACHEDIR + "/refs.index"
+
+# Commits are case-insensitive
+def _to_dirname(settings, refname):
+    dirname = refname_to_dirname(settings, refname)
+    return dirname.lower() if dirname.startswith(".") else dirname
@@ -5,138 +5,412 @@
 # granted to it by virtue of its status as Intergovernmental Organization
 # or submit itself to any jurisdiction.
 
-import yaml
 import os
 import logging
 import shutil
 import math
-from multiprocessing import Pool, cpu_count, Manager
+import pickle
+import hashlib
+import tempfile
+from multiprocessing import Pool, cpu_count
 
 import jens.git as git
 
 from jens.errors import JensRepositoriesError
 from jens.errors import JensGitError
+from jens.errors import JensJournalError
+from jens.errors import JensLockError
 from jens.decorators import timed
 from jens.reposinventory import get_inventory, persist_inventory
 from jens.reposinventory import get_desired_inventory
+from jens.repossnapshot import get_repositories_definition
+from jens.repossnapshot import persist_repositories_snapshot
 from jens.tools import ref_is_commit
 from jens.tools import refname_to_dirname
 from jens.git import GIT_CLONE_TIMEOUT, GIT_FETCH_TIMEOUT
+from jens.commitcache import acquire_commit, release_commit
+from jens.commitcache import is_cached_commit, evict_commits
+from jens.objectpools import ensure_pool, join_pool, is_pool_member
+from jens.objectpools import sync_pool, leave_pool
+from jens.reflinks import reflink_tree
+from jens.journal import JensJournalFactory
+from jens.locks import JensLockFactory
+from jens.refsindex import read_refs_index
+from jens.shards import shard_of, store_shard_results
+
+MAX_DEEPEN_ATTEMPTS = 3
+# Where narrowed bares keep the commits pinned by overrides and what
+# they were last narrowed to
+PINS_PREFIX = "refs/pins/"
+NARROWED_KEY = "jens.narrowed"
+PARTITION_LOCK_TRIES = 30
+POOL_LOCK_TRIES = 60
 
 @timed
-def refresh_repositories(settings, lock):
-    try:
-        logging.debug("Reading metadata from %s" % settings.REPO_METADATA)
-        definition = yaml.load(open(settings.REPO_METADATA, 'r'))
-    except Exception, error: #fixme
-        raise JensRepositoriesError("Unable to parse %s" % \
-               settings.REPO_METADATA)
+# The listener, if any, is called as soon as every repository has been
+# processed (with the name of the repository) and once all the
+# partition is done (with None), so later stages can start early.
+# Prefetched are the results of refresh_shards, if any.
+def refresh_repositories(settings, lock, listener=None, prefetched=None):
+    snapshot, changes = get_repositories_definition(settings)
+    definition = {'repositories': snapshot['definition']}
 
     inventory = get_inventory(settings)
+    journal = JensJournalFactory.makeJournal(settings, "repositories")
+    _recover_journal(settings, journal, inventory)
     desired = get_desired_inventory(settings)
     deltas = {}
+    unsettled = {}
 
     logging.debug("Initial inventory: %s" % inventory)
     logging.debug("Needed from overrides: %s" % desired)
 
-    for partition in ("modules", "hostgroups", "common"):
-        logging.info("Refreshing bare repositories (%s)" % partition)
-        logging.debug("Calculating '%s' delta..." % partition)
-        delta = _calculate_delta(settings,
-            definition['repositories'][partition],
-            inventory[partition])
-        logging.info("New repositories: %s" % delta['new'])
-        logging.debug("Existing repositories: %s" % delta['existing'])
-        logging.info("Deleted repositories: %s" % delta['deleted'])
+    # If a partition can't be locked, what was done in the previous ones
+    # is kept anyway
+    try:
+        # Common goes first as all the environments need it
+        for partition in ("common", "modules", "hostgroups"):
+            # Shared, so repositories can be GC'ed meanwhile but not
+            # the object pool of the partition
+            with JensLockFactory.makePartitionLock(settings, partition,
+                    tries=PARTITION_LOCK_TRIES, waittime=10, shared=True):
+                logging.info("Refreshing bare repositories (%s)" % partition)
+                logging.debug("Calculating '%s' delta..." % partition)
+                delta = _calculate_delta(settings,
+                    definition['repositories'][partition],
+                    inventory[partition])
+                logging.info("New repositories: %s" % delta['new'])
+                logging.debug("Existing repositories: %s" % delta['existing'])
+                logging.info("Deleted repositories: %s" % delta['deleted'])
 
-        lock.renew((len(delta['new']) * GIT_CLONE_TIMEOUT) + \
-            (len(delta['existing']) * GIT_FETCH_TIMEOUT) + \
-            len(delta['deleted']))
+                lock.renew((len(delta['new']) * GIT_CLONE_TIMEOUT) + \
+                    (len(delta['existing']) * GIT_FETCH_TIMEOUT) + \
+                    len(delta['deleted']))
 
-        logging.info("Cloning and expanding NEW bare repositories...")
-        delta['new'] = _create_new_repositories(settings, delta['new'],
-            partition, definition, inventory[partition], desired[partition])
+                logging.info("Cloning and expanding NEW bare repositories...")
+                new = delta['new']
+                delta['new'] = _create_new_repositories(settings, new,
+                    partition, definition, inventory[partition],
+                    desired[partition])
+                _notify_processed(listener, partition, new, inventory)
 
-        logging.info("Expanding EXISTING bare repositories...")
-        _refresh_repositories(settings, delta['existing'], partition,
-            inventory[partition], desired[partition])
+                moved = dict([(name, url) for name, url in
+                    changes[partition]['moved'].iteritems()
+                    if name in delta['existing']])
+                if moved:
+                    logging.info("Updating remotes of MOVED repositories...")
+                    unsettled[partition] = _update_remotes(settings,
+                        partition, moved)
 
-        logging.info("Purging REMOVED bare repositories...")
-        _purge_repositories(settings, delta['deleted'], partition,
-            inventory[partition])
+                logging.info("Expanding EXISTING bare repositories...")
+                # Shards fetched from the old URL of moved repositories
+                refreshed = dict([(name, result) for name, result in
+                    (prefetched or {}).get(partition, {}).iteritems()
+                    if name not in moved])
+                unread = (prefetched or {}).get('unread', ())
+                unknown = set([name for name in delta['existing']
+                    if shard_of(settings, partition, name) in unread])
+                results = _refresh_repositories(settings,
+                    delta['existing'], partition, inventory[partition],
+                    desired[partition], lambda name: _notify_processed(listener,
+                        partition, [name], inventory), refreshed, unknown)
+                delta['updated_refs'] = dict([(name, updated)
+                    for name, (updated, record) in results.iteritems()
+                    if updated])
 
-        deltas[partition] = delta
+                logging.info("Purging REMOVED bare repositories...")
+                # Repositories that couldn't be locked are purged next time
+                delta['deleted'] = _purge_repositories(settings,
+                    delta['deleted'], partition, inventory[partition])
+                _purge_staging_repositories(settings, partition,
+                    definition['repositories'][partition])
+                _notify_processed(listener, partition, delta['deleted'],
+                    inventory)
+                _notify_processed(listener, partition, [None], inventory)
 
-    persist_inventory(settings, inventory)
-    logging.debug("Final inventory: %s" % inventory)
+                deltas[partition] = delta
+    finally:
+        logging.info("Repositories whose clones changed: %s" % \
+            inventory.dirty())
+        persist_inventory(settings, inventory)
+    journal.checkpoint()
+    try:
+        persist_repositories_snapshot(settings, snapshot, unsettled)
+    except JensRepositoriesError, error:
+        logging.error(error)
+
+    if settings.COMMITCACHE_ENABLED:
+        logging.info("Evicting unused commits from the cache...")
+        try:
+            evict_commits(settings)
+        except JensRepositoriesError, error:
+            logging.error("Unable to evict commits (%s)" % error)
 
     return (deltas, inventory)
 
+# Claims and refreshes shards of the existing repositories until there
+# are none left (see jens.shards). Returns the generation they belong
+# to, so the caller can try to finalize it.
+@timed
+def refresh_shards(settings, lock, coordinator):
+    generation = coordinator.get_generation()
+    logging.info("Refreshing shards (generation %d)..." % generation)
+    for shard in range(settings.SHARDS_COUNT):
+        if not coordinator.claim_shard(generation, shard):
+            continue
+        done = False
+        try:
+            results = _refresh_shard(settings, lock, coordinator,
+                generation, shard)
+            store_shard_results(settings, generation, shard, results)
+            done = True
+        finally:
+            coordinator.release_shard(generation, shard, done)
+    return generation
+
+# The inventory and the overrides are the ones left by the last run, as
+# only the node finalizing a generation can change them.
+def _refresh_shard(settings, lock, coordinator, generation, shard):
+    logging.info("Refreshing shard %d..." % shard)
+    results = {}
+    inventory = get_inventory(settings, generate=False)
+    if inventory is None:
+        return results
+    desired = read_refs_index(settings).get_overrides(settings)
+    for partition in ("common", "modules", "hostgroups"):
+        names = [name for name in inventory[partition].keys()
+            if shard_of(settings, partition, name) == shard]
+        logging.debug("Repositories of shard %d (%s): %s" % \
+            (shard, partition, names))
+        lock.renew(max(len(names), 1) * GIT_FETCH_TIMEOUT)
+        with JensLockFactory.makePartitionLock(settings, partition,
+                tries=PARTITION_LOCK_TRIES, waittime=10, shared=True):
+            refreshed = _refresh_repositories(settings, names, partition,
+                inventory[partition], desired[partition], lambda name: None)
+        results[partition] = dict([(name, {'updated': updated,
+            'record': record,
+            'desired': desired[partition].get(name, [])})
+            for name, (updated, record) in refreshed.iteritems()])
+        coordinator.renew(generation, shard)
+    return results
+
+# The URL in the definition changed, the bare is kept and fetches from
+# the new one from now on. Returns the repositories whose remote
+# couldn't be updated.
+def _update_remotes(settings, partition, moved):
+    failed = []
+    for repository, url in moved.iteritems():
+        bare_path = _compose_bare_repository_path(settings,
+            repository, partition)
+        logging.info("Remote of %s/%s is now %s" % (partition, repository, url))
+        try:
+            git.set_config(bare_path, "remote.origin.url", [url], bare=True)
+        except JensGitError, error:
+            logging.error("Unable to update remote of '%s' (%s)" % \
+                (repository, error))
+            failed.append(repository)
+    return failed
+
+def _notify_processed(listener, partition, names, inventory):
+    if listener is not None:
+        for name in names:
+            listener(partition, name, inventory)
+
 def _create_new_repositories(settings, new_repositories, partition,
             definition, inventory, desired):
     created = []
+    rejections = _read_rejections(settings)
+    journal = JensJournalFactory.makeJournal(settings, "repositories")
     for repository in new_repositories:
-        logging.info("Cloning and expanding %s/%s..." % (partition, repository))
-        bare_path = _compose_bare_repository_path(settings,
-            repository, partition) 
         bare_url = definition['repositories'][partition][repository]
         try:
-            git.clone(bare_path, bare_url, bare=True)
-        except JensGitError, error:
-            logging.error("Unable to clone '%s' (%s). Skipping." % (repository, error))
-            if os.path.exists(bare_path):
-                shutil.rmtree(bare_path)
-            continue
-        try:
-            refs = git.get_refs(bare_path).keys()
-        except JensGitError, error:
-            logging.error("Unable to get refs of '%s' (%s). Skipping." % (repository, error))
-            shutil.rmtree(bare_path)
-            logging.debug("Bare repository %s has been removed" % bare_path)
-            continue
-        # Check if the repository has the mandatory branches
-        if all([ref in refs for ref in settings.MANDATORY_BRANCHES]):
-            # Expand only the mandatory and available requested branches
-            # commits will always be attempted to be expanded
-            new = set(settings.MANDATORY_BRANCHES)
-            new = new.union(filter(lambda x: ref_is_commit(settings, x) or x in refs,
-                desired.get(repository, [])))
-            inventory[repository] = []
-            _expand_clones(settings, partition, repository, inventory, None, new, [], [])
-            created.append(repository)
+            with JensLockFactory.makeRepositoryLock(settings, partition,
+                    repository):
+                if _create_new_repository(settings, partition, repository,
+                        bare_url, inventory, desired, rejections, journal):
+                    created.append(repository)
+        except JensLockError, error:
+            logging.warn("Unable to lock '%s' (%s). Skipping." % \
+                (repository, error))
+    # Forget about the ones that aren't declared anymore
+    for key in rejections.keys():
+        rejected_partition, name = key.split("/", 1)
+        if rejected_partition == partition and \
+                name not in definition['repositories'][partition]:
+            del rejections[key]
+    _write_rejections(settings, rejections)
+    return created
+
+def _create_new_repository(settings, partition, repository, bare_url,
+        inventory, desired, rejections, journal):
+    logging.info("Cloning and expanding %s/%s..." % (partition, repository))
+    bare_path = _compose_bare_repository_path(settings,
+        repository, partition) 
+    # Nothing is downloaded unless the mandatory branches are there
+    try:
+        available = git.ls_remote(None, bare_url)
+    except JensGitError, error:
+        logging.error("Unable to list refs of %s for '%s' (%s). Skipping." % \
+            (bare_url, repository, error))
+        return False
+    if not _has_mandatory_branches(settings, partition, repository,
+            available, rejections):
+        return False
+    try:
+        entry = journal.begin('clone', partition=partition,
+            name=repository)
+    except JensJournalError, error:
+        logging.error("Unable to clone '%s' (%s). Skipping." % (repository, error))
+        return False
+    try:
+        if settings.GIT_BOOTSTRAPSTEP:
+            _bootstrap_bare(settings, partition, repository, bare_url,
+                desired.get(repository, []), available)
+        elif settings.GIT_NARROWREFSPECS:
+            _create_narrow_bare(settings, partition, bare_path, bare_url,
+                desired.get(repository, []), available)
         else:
-            logging.error("Repository '%s' lacks some of the mandatory branches. Skipping." %
-                repository)
+            reference = None
+            if settings.GIT_OBJECTPOOLS:
+                reference = ensure_pool(settings, partition)
+            git.clone(bare_path, bare_url, bare=True,
+                depth=settings.GIT_DEPTH or None, reference=reference)
+    except JensGitError, error:
+        logging.error("Unable to clone '%s' (%s). Skipping." % (repository, error))
+        if os.path.exists(bare_path):
             shutil.rmtree(bare_path)
-            logging.debug("Bare repository %s has been removed" % bare_path)
-    return created
+        return False
+    try:
+        refs = git.get_refs(bare_path).keys()
+    except JensGitError, error:
+        logging.error("Unable to get refs of '%s' (%s). Skipping." % (repository, error))
+        shutil.rmtree(bare_path)
+        logging.debug("Bare repository %s has been removed" % bare_path)
+        return False
+    # Check if the repository has the mandatory branches
+    if all([ref in refs for ref in settings.MANDATORY_BRANCHES]):
+        # Expand only the mandatory and available requested branches
+        # commits will always be attempted to be expanded
+        new = set(settings.MANDATORY_BRANCHES)
+        new = new.union(filter(lambda x: ref_is_commit(settings, x) or x in refs,
+            desired.get(repository, [])))
+        if settings.GIT_OBJECTPOOLS:
+            _sync_object_pool(settings, partition, repository)
+        record = inventory.add(repository)
+        journal.commit(entry)
+        _expand_clones(settings, partition, repository, record, new, [], [])
+        return True
+    else:
+        logging.error("Repository '%s' lacks some of the mandatory branches. Skipping." %
+            repository)
+        shutil.rmtree(bare_path)
+        logging.debug("Bare repository %s has been removed" % bare_path)
+        return False
+
+# Rejected repositories are remembered together with a fingerprint of
+# the refs advertised by the remote, so they're not reported again
+# until something changes.
+def _has_mandatory_branches(settings, partition, repository, available,
+        rejections):
+    key = "%s/%s" % (partition, repository)
+    if all([ref in available for ref in settings.MANDATORY_BRANCHES]):
+        rejections.pop(key, None)
+        return True
+    fingerprint = _fingerprint_refs(available)
+    if rejections.get(key, None) == fingerprint:
+        logging.warn("Repository '%s' still lacks some of the mandatory branches. Skipping." %
+            repository)
+    else:
+        logging.error("Repository '%s' lacks some of the mandatory branches. Skipping." %
+            repository)
+        rejections[key] = fingerprint
+    return False
+
+def _fingerprint_refs(refs):
+    return hashlib.sha1("\n".join(["%s %s" % (name, refs[name])
+        for name in sorted(refs)])).hexdigest()
+
+def _read_rejections(settings):
+    try:
+        with open(settings.CACHEDIR + "/rejections", "rb") as rejections_file:
+            return pickle.load(rejections_file)
+    except (IOError, EOFError, pickle.PickleError):
+        return {}
+
+def _write_rejections(settings, rejections):
+    try:
+        fd, temporary_path = tempfile.mkstemp(dir=settings.CACHEDIR,
+            prefix=".rejections-")
+        with os.fdopen(fd, "wb") as rejections_file:
+            pickle.dump(rejections, rejections_file)
+        os.rename(temporary_path, settings.CACHEDIR + "/rejections")
+    except (IOError, OSError, pickle.PickleError), error:
+        logging.error("Unable to write rejected repositories to disk (%s)" % \
+            error)
 
 # This is the most common operation Jens has to do, git-fetch
 # over all bare repos and the expansion of clones.
-def _refresh_repositories(settings, existing_repositories, partition, inventory, desired):
-    if not existing_repositories:
-        return # Seems that passing [] to pool.map makes .join never return
-    manager = Manager()
-    # The inventory is the only parameter that has to be r/w
-    # so we need a common object and a remote controller :)
-    inventory_proxy = manager.dict(inventory)
-    inventory_lock = manager.Lock()
+# Returns the refs whose clones have been created, updated or deleted
+# and the record of every repository that was refreshed. The ones in
+# prefetched were already refreshed by some node (see refresh_shards)
+# and, unless the refs needed changed meanwhile, aren't touched again.
+# Otherwise what was updated then is reported too. The ones in unknown
+# were refreshed as well, but what changed was lost, so all their refs
+# are reported.
+def _refresh_repositories(settings, existing_repositories, partition, inventory,
+        desired, processed, prefetched=None, unknown=()):
+    prefetched = prefetched or {}
+    results = {}
+    for repository in existing_repositories:
+        result = prefetched.get(repository, None)
+        if result is not None and \
+                result['desired'] == desired.get(repository, []):
+            inventory.update(repository, result['record'])
+            results[repository] = (result['updated'], result['record'])
+            processed(repository)
+    pending = [repository for repository in existing_repositories
+        if repository not in results]
+    if not pending:
+        return results # Seems that passing [] to pool.map makes .join never return
+    # Every worker gets a copy of the record of its repository and
+    # sends it back with the changes, which are merged here.
     data = [{'settings': settings, 'partition': partition,
-        'repository': repository, 'inventory': inventory_proxy,
-        'inventory_lock': inventory_lock, 'desired': desired}
-        for repository in existing_repositories]
+        'repository': repository, 'record': inventory[repository],
+        'desired': desired} for repository in pending]
     pool = Pool(processes=int(math.ceil(cpu_count()*1.5)))
-    pool.map(_refresh_repository, data)
+    # Results are handled as they come, whatever the order
+    for repository, updated, record in \
+            pool.imap_unordered(_refresh_repository, data):
+        if record is not None:
+            if repository in unknown:
+                updated = sorted(record)
+            elif repository in prefetched:
+                updated = sorted(set(updated or []).union(
+                    prefetched[repository]['updated'] or []))
+            inventory.update(repository, record)
+            results[repository] = (updated, record)
+        processed(repository)
     pool.close()
     pool.join()
-    inventory.update(inventory_proxy)
+    return results
 
+# Repositories being GC'ed are left alone, they'll be refreshed by the
+# next run.
 def _refresh_repository(data):
+    try:
+        with JensLockFactory.makeRepositoryLock(data['settings'],
+                data['partition'], data['repository']):
+            return _refresh_locked_repository(data)
+    except JensLockError, error:
+        logging.warn("Unable to lock '%s' (%s). Skipping." % \
+            (data['repository'], error))
+        return (data['repository'], None, None)
+
+def _refresh_locked_repository(data):
     settings = data['settings']
     repository = data['repository']
     partition = data['partition']
-    inventory = data['inventory']
-    inventory_lock = data['inventory_lock']
+    record = data['record']
     desired = data['desired']
     logging.debug("Expanding %s/%s..." % (partition, repository))
     bare_path = _compose_bare_repository_path(settings,
@@ -145,12 +419,29 @@ def _refresh_repository(data):
         old_refs = git.get_refs(bare_path)
     except JensGitError, error:
         logging.error("Unable to get old refs of '%s' (%s)" % (repository, error))
-        return
+        return (repository, None, None)
+    listed = True
+    if settings.GIT_NARROWREFSPECS:
+        try:
+            listed = _narrow_bare(settings, bare_path,
+                desired.get(repository, []))
+        except JensGitError, error:
+            logging.error("Unable to narrow refspecs of '%s' (%s)" % \
+                (repository, error))
+            return (repository, None, None)
     try:
-        git.fetch(bare_path, prune=True, bare=True)
+        try:
+            git.fetch(bare_path, prune=True, bare=True)
+        except JensGitError:
+            if listed:
+                raise
+            # Some of the branches may be gone from the remote
+            _narrow_bare(settings, bare_path, desired.get(repository, []),
+                git.ls_remote(bare_path, bare=True))
+            git.fetch(bare_path, prune=True, bare=True)
     except JensGitError, error:
         logging.error("Unable to fetch '%s' from remote (%s)" % (repository, error))
-        return
+        return (repository, None, None)
     try:
         # TODO: Found a corner case where git fetch wiped all
         # all the branches in the bare repository. That led 
@@ -162,28 +453,215 @@ def _refresh_repository(data):
         new_refs = git.get_refs(bare_path)
     except JensGitError, error:
         logging.error("Unable to get new refs of '%s' (%s)" % (repository, error))
-        return
+        return (repository, None, None)
+    if settings.GIT_OBJECTPOOLS:
+        _sync_object_pool(settings, partition, repository,
+            new_refs != old_refs)
     new, moved, deleted = _compare_refs(settings, old_refs, new_refs,
-        inventory[repository],
-        desired.get(repository, []))
-    _expand_clones(settings, partition, repository, inventory, inventory_lock,
-            new, moved, deleted)
+        record, desired.get(repository, []))
+    moved.extend(_find_stale_clones(settings, partition, repository,
+        new_refs, record, new + moved + deleted))
+    updated = _expand_clones(settings, partition, repository, record,
+        new, moved, deleted, tips=new_refs)
+    return (repository, updated, record)
+
+# Instead of mirroring everything, narrowed bares only fetch the
+# mandatory branches and the ones needed by overrides that exist in
+# the remote. The remote is only listed again when the overrides
+# change or some of the branches were missing the last time. Commits
+# pinned by overrides are kept in PINS_PREFIX, as their clones share
+# the objects of the bare and would break if these were pruned.
+def _create_narrow_bare(settings, partition, bare_path, bare_url, desired,
+        available):
+    git.init(bare_path, bare=True)
+    git.set_config(bare_path, "remote.origin.url", [bare_url], bare=True)
+    if settings.GIT_OBJECTPOOLS:
+        join_pool(settings, partition, bare_path)
+    _narrow_bare(settings, bare_path, desired, available)
+    git.fetch(bare_path, prune=True, bare=True,
+        depth=settings.GIT_DEPTH or None)
+
+# Returns whether the remote was listed
+def _narrow_bare(settings, bare_path, desired, available=None):
+    requested = sorted(set(settings.MANDATORY_BRANCHES).union(desired))
+    if available is None:
+        narrowed = git.get_config(bare_path, NARROWED_KEY, bare=True)
+        if narrowed == requested:
+            return False
+        branches = filter(lambda x: not ref_is_commit(settings, x), requested)
+        if narrowed and branches == \
+                filter(lambda x: not ref_is_commit(settings, x), narrowed):
+            _prune_refs(settings, bare_path, desired, None)
+            git.set_config(bare_path, NARROWED_KEY, requested, bare=True)
+            return False
+        available = git.ls_remote(bare_path, bare=True)
+    wanted = sorted(set(filter(lambda x: not ref_is_commit(settings, x),
+        requested)).intersection(available))
+    logging.debug("Narrowing %s to %s" % (bare_path, wanted))
+    git.set_config(bare_path, "remote.origin.fetch",
+        ["+refs/heads/%s:refs/heads/%s" % (branch, branch)
+        for branch in wanted], bare=True)
+    _prune_refs(settings, bare_path, desired, wanted)
+    # Missing branches are looked for again in the next run
+    missing = [branch for branch in requested
+        if not ref_is_commit(settings, branch) and branch not in wanted]
+    git.set_config(bare_path, NARROWED_KEY, [] if missing else requested,
+        bare=True)
+    return True
+
+# Leftovers of mirroring or of overrides that are gone are deleted,
+# leaving branches alone if wanted is None. Commits pinned before they
+# were kept in PINS_PREFIX are added there first.
+def _prune_refs(settings, bare_path, desired, wanted):
+    commits = [refname[len(settings.HASHPREFIX):] for refname in desired
+        if ref_is_commit(settings, refname)]
+    refnames = git.get_all_refs(bare_path, bare=True)
+    pinned = [refname[len(PINS_PREFIX):] for refname in refnames
+        if refname.startswith(PINS_PREFIX)]
+    for commit_id in commits:
+        if any([sha.startswith(commit_id) for sha in pinned]):
+            continue
+        try:
+            sha = git.rev_parse(bare_path, commit_id, bare=True)
+        except JensGitError:
+            continue # Not fetched yet
+        git.update_ref(bare_path, PINS_PREFIX + sha, sha, bare=True)
+    for refname in refnames:
+        if refname.startswith(PINS_PREFIX):
+            sha = refname[len(PINS_PREFIX):]
+            if any([sha.startswith(commit_id) for commit_id in commits]):
+                continue
+        elif wanted is None or refname in ["refs/heads/%s" % branch
+                for branch in wanted]:
+            continue
+        git.delete_ref(bare_path, refname, bare=True)
+
+# Big repositories on slow links may never be cloned in one go, so
+# they're bootstrapped in a staging area fetching GIT_BOOTSTRAPSTEP
+# commits of history at a time. What has been fetched is kept if a
+# step fails and the next run resumes from there. Bares are only moved
+# to BAREDIR once they're complete and validated.
+def _bootstrap_bare(settings, partition, repository, bare_url, desired,
+        available):
+    staging_path = _compose_staging_repository_path(settings,
+        repository, partition)
+    if not os.path.isdir(staging_path):
+        logging.info("Bootstrapping '%s' in %s" % (repository, staging_path))
+        git.init(staging_path, bare=True)
+        git.set_config(staging_path, "remote.origin.url", [bare_url], bare=True)
+        if settings.GIT_OBJECTPOOLS:
+            join_pool(settings, partition, staging_path)
+        if not settings.GIT_NARROWREFSPECS:
+            git.set_config(staging_path, "remote.origin.fetch",
+                ["+refs/*:refs/*"], bare=True)
+            git.set_config(staging_path, "remote.origin.mirror",
+                ["true"], bare=True)
+    else:
+        logging.info("Resuming bootstrap of '%s' in %s" % \
+            (repository, staging_path))
+        # The repository may have moved since the bootstrap started
+        git.set_config(staging_path, "remote.origin.url", [bare_url], bare=True)
+    if settings.GIT_NARROWREFSPECS:
+        _narrow_bare(settings, staging_path, desired, available)
+
+    try:
+        if git.get_all_refs(staging_path, bare=True):
+            git.fetch(staging_path, prune=True, bare=True)
+        else:
+            git.fetch(staging_path, prune=True, bare=True,
+                depth=settings.GIT_DEPTH or settings.GIT_BOOTSTRAPSTEP)
+        while not settings.GIT_DEPTH and \
+                git.is_shallow(staging_path, bare=True):
+            git.deepen(staging_path, settings.GIT_BOOTSTRAPSTEP, bare=True)
+    except JensGitError, error:
+        logging.info("Partial clone of '%s' kept in %s" % \
+            (repository, staging_path))
+        raise error
+
+    refs = git.get_refs(staging_path)
+    if not all([ref in refs for ref in settings.MANDATORY_BRANCHES]):
+        shutil.rmtree(staging_path)
+        raise JensGitError("Bootstrapped bare lacks some of the mandatory branches")
+    bare_path = _compose_bare_repository_path(settings, repository, partition)
+    logging.info("Promoting %s to %s" % (staging_path, bare_path))
+    try:
+        os.rename(staging_path, bare_path)
+    except OSError, error:
+        raise JensGitError("Unable to promote %s to %s (%s)" % \
+            (staging_path, bare_path, error))
+
+def _purge_staging_repositories(settings, partition, definition):
+    staging_path = _compose_staging_repository_path(settings, None, partition)
+    if not os.path.isdir(staging_path):
+        return
+    for repository in os.listdir(staging_path):
+        if repository not in definition:
+            logging.info("Removing partial clone of %s/%s..." % \
+                (partition, repository))
+            shutil.rmtree("%s/%s" % (staging_path, repository))
 
 def _purge_repositories(settings, deleted_repositories, partition, inventory):
+    journal = JensJournalFactory.makeJournal(settings, "repositories")
+    purged = []
     for repository in deleted_repositories:
-        logging.info("Deleting %s/%s..." % (partition, repository))
-        bare_path = _compose_bare_repository_path(settings,
-            repository, partition) 
-        # Pass a copy as it will be used as interation set
-        refs = inventory[repository][:]
-        _expand_clones(settings, partition, repository, inventory, None, [], [], refs)
-        clone_path = _compose_clone_repository_path(settings, repository,
-            partition)
-        shutil.rmtree(clone_path)
-        logging.debug("Clone repository parent %s has been removed" % clone_path)
-        shutil.rmtree(bare_path)
-        logging.debug("Bare repository %s has been removed" % bare_path)
-        inventory.pop(repository, None)
+        try:
+            with JensLockFactory.makeRepositoryLock(settings, partition,
+                    repository):
+                _purge_repository(settings, partition, repository,
+                    inventory, journal)
+                purged.append(repository)
+        except JensLockError, error:
+            logging.warn("Unable to lock '%s' (%s). Skipping." % \
+                (repository, error))
+    return purged
+
+def _purge_repository(settings, partition, repository, inventory, journal):
+    logging.info("Deleting %s/%s..." % (partition, repository))
+    bare_path = _compose_bare_repository_path(settings,
+        repository, partition) 
+    # Pass a copy as it will be used as interation set
+    refs = list(inventory[repository])
+    _expand_clones(settings, partition, repository, inventory[repository],
+        [], [], refs)
+    entry = journal.begin('purge', partition=partition, name=repository)
+    clone_path = _compose_clone_repository_path(settings, repository,
+        partition)
+    shutil.rmtree(clone_path)
+    logging.debug("Clone repository parent %s has been removed" % clone_path)
+    if settings.GIT_OBJECTPOOLS:
+        try:
+            leave_pool(settings, partition, repository)
+        except JensGitError, error:
+            logging.error("Unable to remove '%s' from the object pool (%s)" % \
+                (repository, error))
+    shutil.rmtree(bare_path)
+    logging.debug("Bare repository %s has been removed" % bare_path)
+    inventory.remove(repository)
+    journal.commit(entry)
+
+# The refs of the members are copied to the object pool only when they
+# change. Bares created before enabling the pools join it here, their
+# objects are moved to the pool and dropped from the bare by the next
+# git-gc.
+# Workers take turns, as concurrent fetches into the pool would race on
+# its refs. If it's busy for too long, the objects stay in the bare
+# until the next change or jens-gc, that synchronizes all the members.
+def _sync_object_pool(settings, partition, repository, changed=True):
+    bare_path = _compose_bare_repository_path(settings,
+        repository, partition)
+    if not changed and is_pool_member(settings, partition, bare_path):
+        return
+    try:
+        with JensLockFactory.makePoolLock(settings, partition,
+                tries=POOL_LOCK_TRIES, waittime=1):
+            join_pool(settings, partition, bare_path)
+            sync_pool(settings, partition, repository, bare_path)
+    except JensLockError, error:
+        logging.warn("Unable to lock the object pool of %s (%s)" % \
+            (partition, error))
+    except JensGitError, error:
+        logging.error("Unable to synchronize '%s' with the object pool (%s)" % \
+            (repository, error))
 
 # This function computes the list of refs to be expanded, refreshed or
 # removed based on what is available (new_refs), what was available
@@ -229,10 +707,13 @@ def _compare_refs(settings, old_refs, new_refs, inventory, desired):
 
     return new, moved, deleted
 
-def _expand_clones(settings, partition, name, inventory, inventory_lock,
-        new_refs, moved_refs, deleted_refs):
+def _expand_clones(settings, partition, name, record,
+        new_refs, moved_refs, deleted_refs, tips=None):
+    tips = tips or {}
     bare_path = _compose_bare_repository_path(settings,
                 name, partition) 
+    journal = JensJournalFactory.makeJournal(settings, "repositories")
+    updated = []
     if new_refs:
         logging.debug("Processing new refs of %s/%s (%s)..." % \
             (partition, name, new_refs))
@@ -241,25 +722,18 @@ def _expand_clones(settings, partition, name, inventory, inventory_lock,
                 name, partition, refname)
         logging.info("Populating new ref '%s'" % clone_path)
         try:
+            entry = journal.begin('expand', partition=partition, name=name,
+                ref=refname)
             if ref_is_commit(settings, refname):
-                commit_id = refname.replace(settings.HASHPREFIX, '')
-                logging.debug("Will create a clone pointing to '%s'" % commit_id)
-                git.clone(clone_path, "%s" % bare_path, shared=True)
-                git.reset(clone_path, commit_id, hard=True)
+                _expand_commit(settings, partition, name, refname)
             else:
-                git.clone(clone_path, "%s" % bare_path, branch=refname)
-            # Needs reset so the proxy notices about the change on the mutable
-            # http://docs.python.org/2.7/library/multiprocessing.html#managers
-            # Locking on the assignment is guarateed by the library, but
-            # additional locking is needed as A = A + 1 is a critical section.
-            if inventory_lock:
-                inventory_lock.acquire()
-            inventory[name] += [refname]
-            if inventory_lock:
-                inventory_lock.release()
-        except JensGitError, error:
-            if os.path.isdir(clone_path):
-                shutil.rmtree(clone_path)
+                _expand_branch(settings, partition, name, list(record),
+                    refname)
+            record.add(refname)
+            journal.commit(entry)
+            updated.append(refname)
+        except (JensGitError, JensRepositoriesError, JensJournalError), error:
+            _remove_partial_clone(settings, clone_path)
             logging.error("Unable to create clone '%s' (%s)" % \
                 (clone_path, error))
 
@@ -271,13 +745,9 @@ def _expand_clones(settings, partition, name, inventory, inventory_lock,
                 name, partition, refname)
         logging.info("Updating ref '%s'" % clone_path)
         try:
-            # If this fails, the bare would have the correct HEADs
-            # but the clone will be out of date and won't ever be
-            # updated until a new commit arrives to the bare.
-            # Reason: a lock file left behind because Git was killed
-            # mid-flight.
-            git.fetch(clone_path)
-            git.reset(clone_path, "origin/%s" % refname, hard=True)
+            _refresh_branch(bare_path, clone_path, refname,
+                tips.get(refname, None))
+            updated.append(refname)
         except JensGitError, error:
             logging.error("Unable to refresh clone '%s' (%s)" % \
                 (clone_path, error))
@@ -290,22 +760,277 @@ def _expand_clones(settings, partition, name, inventory, inventory_lock,
                 name, partition, refname)
         logging.info("Removing %s" % clone_path)
         try:
-            if os.path.isdir(clone_path):
-                shutil.rmtree(clone_path)
-            if refname in inventory[name]:
-                if inventory_lock:
-                    inventory_lock.acquire()
-                t = inventory[name]; t.remove(refname); inventory[name] = t
-                if inventory_lock:
-                    inventory_lock.release()
+            entry = journal.begin('remove', partition=partition, name=name,
+                ref=refname)
+            _remove_clone(settings, partition, name, refname,
+                [ref for ref in record if ref != refname])
+            if refname in record:
+                record.discard(refname)
                 logging.info("%s/%s deleted from inventory" % (name, refname))
-        except OSError, error:
+            journal.commit(entry)
+            updated.append(refname)
+        except (OSError, JensRepositoriesError, JensJournalError), error:
             logging.error("Couldn't delete %s/%s/%s (%s)" %
                 (partition, name, refname, error))
 
+    return updated
+
+# Links to the clone of a commit are removed, the clone itself only if
+# there are no other pins to it left.
+def _remove_clone(settings, partition, name, refname, remaining):
+    clone_path = _compose_clone_repository_path(settings,
+        name, partition, refname)
+    if is_cached_commit(settings, clone_path):
+        release_commit(settings, clone_path)
+        os.remove(clone_path)
+        return
+    elif os.path.islink(clone_path):
+        target_path = os.path.realpath(clone_path)
+        os.remove(clone_path)
+    else:
+        target_path = clone_path
+    if os.path.isdir(target_path) and \
+            not _is_clone_pinned(settings, partition, name,
+                remaining, target_path):
+        shutil.rmtree(target_path)
+
+def _remove_partial_clone(settings, clone_path):
+    if is_cached_commit(settings, clone_path):
+        release_commit(settings, clone_path)
+    if os.path.islink(clone_path):
+        os.remove(clone_path)
+    elif os.path.isdir(clone_path):
+        shutil.rmtree(clone_path)
+
+# Operations of an interrupted run that didn't finish are rolled back
+# (creations) or completed (removals). The ones that did finish are
+# replayed on the inventory, as it was not persisted.
+def _recover_journal(settings, journal, inventory):
+    entries = journal.pending()
+    if not entries:
+        return
+    logging.info("Recovering %d operation(s) of an interrupted run..." % \
+        len(entries))
+    for entry in entries:
+        partition = inventory[entry['partition']]
+        name = entry['name']
+        operation = entry['operation']
+        logging.debug("Recovering %s of %s/%s (%s)" % (operation,
+            entry['partition'], name, entry.get('ref', None)))
+        try:
+            if operation == 'clone':
+                if entry['committed']:
+                    partition.add(name)
+                else:
+                    bare_path = _compose_bare_repository_path(settings,
+                        name, entry['partition'])
+                    if os.path.isdir(bare_path) and name not in partition:
+                        shutil.rmtree(bare_path)
+            elif operation == 'expand':
+                if entry['committed']:
+                    if name in partition:
+                        partition[name].add(entry['ref'])
+                elif name not in partition or \
+                        entry['ref'] not in partition[name]:
+                    _remove_partial_clone(settings,
+                        _compose_clone_repository_path(settings, name,
+                            entry['partition'], entry['ref']))
+            elif operation == 'remove':
+                refs = [ref for ref in partition[name]
+                    if ref != entry['ref']] if name in partition else []
+                _remove_clone(settings, entry['partition'], name,
+                    entry['ref'], refs)
+                if name in partition:
+                    partition[name].discard(entry['ref'])
+            elif operation == 'purge':
+                for path in (_compose_clone_repository_path(settings,
+                        name, entry['partition']),
+                        _compose_bare_repository_path(settings,
+                        name, entry['partition'])):
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                partition.remove(name)
+        except (OSError, JensRepositoriesError), error:
+            logging.error("Unable to recover %s of %s/%s (%s)" % \
+                (operation, entry['partition'], name, error))
+    persist_inventory(settings, inventory)
+    journal.checkpoint()
+
+# Clones borrow the objects of the bare, so they're reset straight to
+# the new tip without fetching and only the paths that differ are
+# rewritten. If Git was killed while updating a clone, the lock files
+# left behind would make all the following updates fail, so they're
+# removed (nothing else touches clones while Jens runs) and it's retried.
+def _refresh_branch(bare_path, clone_path, refname, sha):
+    if sha is None:
+        sha = git.rev_parse(bare_path, "refs/heads/%s" % refname, bare=True)
+    git.add_alternate(clone_path, "%s/objects" % bare_path)
+    try:
+        git.reset(clone_path, sha, hard=True)
+    except JensGitError, error:
+        removed = git.remove_stale_locks(clone_path)
+        if not removed:
+            raise error
+        logging.warn("Removed stale lock files from '%s' (%s)" % \
+            (clone_path, ", ".join(removed)))
+        git.reset(clone_path, sha, hard=True)
+
+# Clones that failed to be updated in previous runs are behind the bare
+# even if the ref hasn't moved since, so they're refreshed as well.
+def _find_stale_clones(settings, partition, name, tips, refs, processed):
+    stale = []
+    for refname in refs:
+        if refname in processed or refname not in tips:
+            continue
+        clone_path = _compose_clone_repository_path(settings,
+            name, partition, refname)
+        try:
+            head = git.get_head(clone_path)
+        except JensGitError:
+            continue
+        if head != tips[refname]:
+            logging.info("Clone '%s' is behind the bare" % clone_path)
+            stale.append(refname)
+    return stale
+
+# If the filesystem supports reflinks, new branches are expanded by
+# copying an existing checkout of the same repository (no data is
+# written until files change) and checking out the branch on it, so
+# only the files that differ are written. Otherwise, they're cloned.
+def _expand_branch(settings, partition, name, refs, refname):
+    bare_path = _compose_bare_repository_path(settings, name, partition)
+    clone_path = _compose_clone_repository_path(settings,
+        name, partition, refname)
+    if settings.GIT_REFLINKS:
+        source_path = _find_checkout_to_copy(settings, partition, name, refs)
+        if source_path is not None:
+            logging.debug("Reflinking %s to %s" % (source_path, clone_path))
+            try:
+                reflink_tree(source_path, clone_path)
+            except (IOError, OSError), error:
+                logging.debug("Unable to reflink %s (%s), cloning instead" % \
+                    (source_path, error))
+                if os.path.isdir(clone_path):
+                    shutil.rmtree(clone_path)
+            else:
+                # Inodes and ctimes change when copying
+                git.set_config(clone_path, "core.checkStat", ["minimal"])
+                git.set_config(clone_path, "core.trustctime", ["false"])
+                git.fetch(clone_path)
+                git.checkout(clone_path, refname, "origin/%s" % refname)
+                return
+    git.clone(clone_path, "%s" % bare_path, branch=refname)
+
+def _find_checkout_to_copy(settings, partition, name, refs):
+    for refname in settings.MANDATORY_BRANCHES + list(refs):
+        if ref_is_commit(settings, refname):
+            continue
+        path = _compose_clone_repository_path(settings, name,
+            partition, refname)
+        if os.path.isdir("%s/.git" % path):
+            return path
+    return None
+
+# Commits are expanded once under their full hash, no matter how
+# abbreviated the override is, and every abbreviation is a relative
+# link to it, so environments pinning the same commit share a clone.
+# If the commit cache is enabled, all of them link to the cache instead.
+def _expand_commit(settings, partition, name, refname):
+    bare_path = _compose_bare_repository_path(settings, name, partition)
+    clone_path = _compose_clone_repository_path(settings,
+        name, partition, refname)
+    commit_id = refname[len(settings.HASHPREFIX):]
+    sha = _resolve_commit(settings, bare_path, commit_id)
+    if settings.GIT_NARROWREFSPECS:
+        git.update_ref(bare_path, PINS_PREFIX + sha, sha, bare=True)
+    if settings.COMMITCACHE_ENABLED:
+        _link_commit(clone_path,
+            acquire_commit(settings, bare_path, sha, clone_path))
+        return
+    canonical_path = _compose_clone_repository_path(settings,
+        name, partition, settings.HASHPREFIX + sha)
+    if _is_commit_expanded(canonical_path, sha):
+        logging.debug("Commit '%s' is already expanded in '%s'" % \
+            (commit_id, canonical_path))
+    else:
+        # Leftovers of an interrupted run
+        if os.path.isdir(canonical_path):
+            shutil.rmtree(canonical_path)
+        logging.debug("Will create a clone pointing to '%s'" % sha)
+        try:
+            git.clone(canonical_path, "%s" % bare_path, shared=True)
+            git.reset(canonical_path, sha, hard=True)
+        except JensGitError:
+            if os.path.isdir(canonical_path):
+                shutil.rmtree(canonical_path)
+            raise
+    if canonical_path != clone_path:
+        _link_commit(clone_path, os.path.basename(canonical_path))
+
+def _is_commit_expanded(clone_path, sha):
+    try:
+        return git.get_head(clone_path) == sha
+    except JensGitError:
+        return False
+
+# Bares cloned with limited history are deepened, doubling the
+# number of commits fetched every time, until the commit shows up. It
+# isn't looked for any further, so a wrong commit in an override
+# doesn't undo GIT_DEPTH for good.
+def _resolve_commit(settings, bare_path, commit_id):
+    # Narrowed bares may not have the branches it's in
+    if settings.GIT_NARROWREFSPECS and len(commit_id) == 40:
+        try:
+            return git.rev_parse(bare_path, commit_id, bare=True)
+        except JensGitError:
+            logging.info("Commit '%s' not found, fetching it..." % commit_id)
+        try:
+            git.fetch(bare_path, bare=True, depth=settings.GIT_DEPTH or None,
+                refspecs=["+%s:%s%s" % (commit_id, PINS_PREFIX, commit_id)])
+        except JensGitError, error:
+            logging.debug("Unable to fetch '%s' (%s)" % (commit_id, error))
+    step = max(settings.GIT_DEPTH, 1)
+    for attempt in range(0, MAX_DEEPEN_ATTEMPTS + 1):
+        try:
+            return git.rev_parse(bare_path, commit_id, bare=True)
+        except JensGitError:
+            if not git.is_shallow(bare_path, bare=True):
+                raise
+        if attempt < MAX_DEEPEN_ATTEMPTS:
+            logging.info("Commit '%s' not found, deepening %s by %d..." % \
+                (commit_id, bare_path, step))
+            git.deepen(bare_path, step, bare=True)
+            step *= 2
+    raise JensGitError("Commit '%s' not found in %s after deepening it %d times" % \
+        (commit_id, bare_path, MAX_DEEPEN_ATTEMPTS))
+
+def _link_commit(clone_path, target):
+    logging.debug("Linking '%s' to '%s'" % (clone_path, target))
+    if os.path.lexists(clone_path):
+        os.remove(clone_path)
+    try:
+        os.symlink(target, clone_path)
+    except OSError, error:
+        raise JensGitError("Unable to link %s (%s)" % (clone_path, error))
+
+def _is_clone_pinned(settings, partition, name, refs, clone_path):
+    for refname in refs:
+        if not ref_is_commit(settings, refname):
+            continue
+        path = _compose_clone_repository_path(settings, name, partition, refname)
+        if os.path.realpath(path) == os.path.realpath(clone_path):
+            return True
+    return False
+
 def _compose_bare_repository_path(settings, name, partition):
     return settings.BAREDIR + "/%s/%s" % (partition, name)
 
+def _compose_staging_repository_path(settings, name, partition):
+    path = settings.BAREDIR + "/.staging/%s" % partition
+    if name is not None:
+        path = "%s/%s" % (path, name)
+    return path
+
 def _compose_clone_repository_path(settings, name, partition, refname=None):
     path = settings.CLONEDIR + "/%s/%s" % (partition, name)
     if refname is not None:
@@ -8,26 +8,173 @@
 import os
 import logging
 import re
+import math
+import time
+import shutil
 import pickle
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+import jens.git as git
 
 from jens.errors import JensRepositoriesError
-from jens.errors import JensEnvironmentsError
-from jens.environments import read_environment_definition
-from jens.environments import get_names_of_declared_environments
-from jens.tools import ref_is_commit
+from jens.errors import JensGitError
+from jens.environments import update_refs_index
 from jens.tools import dirname_to_refname
 
-def get_inventory(settings):
+PARTITIONS = ("modules", "hostgroups", "common")
+
+# Refs of a repository that have a clone. Records are small enough to
+# be shipped to and back from the workers, which modify them locally.
+class RepositoryRecord(object):
+    __slots__ = ('refs', 'dirty')
+
+    def __init__(self, refs=(), dirty=False):
+        self.refs = set(refs)
+        self.dirty = dirty
+
+    def add(self, refname):
+        if refname not in self.refs:
+            self.refs.add(refname)
+            self.dirty = True
+
+    def discard(self, refname):
+        if refname in self.refs:
+            self.refs.discard(refname)
+            self.dirty = True
+
+    def __contains__(self, refname):
+        return refname in self.refs
+
+    def __iter__(self):
+        return iter(sorted(self.refs))
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __getstate__(self):
+        return (self.refs, self.dirty)
+
+    def __setstate__(self, state):
+        self.refs, self.dirty = state
+
+    def __repr__(self):
+        return repr(sorted(self.refs))
+
+class PartitionInventory(object):
+    def __init__(self, records=None):
+        self.records = dict(records or {})
+        self.removed = set()
+
+    def add(self, name):
+        if name not in self.records:
+            self.records[name] = RepositoryRecord(dirty=True)
+            self.removed.discard(name)
+        return self.records[name]
+
+    def remove(self, name):
+        if self.records.pop(name, None) is not None:
+            self.removed.add(name)
+
+    # Takes a record modified somewhere else (i.e. by a worker)
+    def update(self, name, record):
+        self.records[name] = record
+
+    def dirty(self):
+        return set([name for name, record in self.records.iteritems()
+            if record.dirty]).union(self.removed)
+
+    def keys(self):
+        return self.records.keys()
+
+    def iteritems(self):
+        return self.records.iteritems()
+
+    def __getitem__(self, name):
+        return self.records[name]
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self):
+        return repr(self.records)
+
+class Inventory(object):
+    def __init__(self, partitions):
+        self.partitions = partitions
+
+    # Repositories added, removed or whose clones changed, per partition
+    def dirty(self):
+        return dict([(partition, self.partitions[partition].dirty())
+            for partition in PARTITIONS
+            if self.partitions[partition].dirty()])
+
+    def is_dirty(self):
+        return bool(self.dirty())
+
+    def mark_clean(self):
+        for partition in self.partitions.itervalues():
+            partition.removed.clear()
+            for record in partition.records.itervalues():
+                record.dirty = False
+
+    def to_dict(self):
+        return dict([(partition, dict([(name, list(record))
+            for name, record in self.partitions[partition].iteritems()]))
+            for partition in PARTITIONS])
+
+    @staticmethod
+    def from_dict(data, dirty=False):
+        return Inventory(dict([(partition, PartitionInventory(
+            [(name, RepositoryRecord(refs, dirty))
+                for name, refs in data.get(partition, {}).iteritems()]))
+            for partition in PARTITIONS]))
+
+    def __getitem__(self, partition):
+        return self.partitions[partition]
+
+    def __contains__(self, partition):
+        return partition in self.partitions
+
+    def __repr__(self):
+        return repr(self.partitions)
+
+# Without generate, returns None if there's no usable inventory on
+# disk. Generating it may quarantine entries, so it's only allowed while
+# holding the update lock. Everybody else passes generate=False.
+def get_inventory(settings, generate=True):
     logging.info("Fetching repositories inventory...")
     try:
-        return _read_inventory_from_disk(settings)
-    except (IOError, pickle.PickleError):
+        return Inventory.from_dict(_read_inventory_from_disk(settings))
+    except (IOError, EOFError, pickle.PickleError):
+        if not generate:
+            logging.warn("Inventory on disk not found or corrupt")
+            return None
         logging.warn("Inventory on disk not found or corrupt, generating...")
-        return _generate_inventory(settings)
+        return Inventory.from_dict(_generate_inventory(settings), dirty=True)
 
+# Nothing is written if the inventory didn't change during the run
 def persist_inventory(settings, inventory):
+    if not inventory.is_dirty():
+        logging.info("Repositories inventory didn't change")
+        return
     logging.info("Persisting repositories inventory...")
-    _write_inventory_to_disk(settings, inventory)
+    _write_inventory_to_disk(settings, inventory.to_dict())
+    inventory.mark_clean()
 
 def get_desired_inventory(settings):
     return _read_desired_inventory(settings)
@@ -50,56 +197,152 @@ def _write_inventory_to_disk(settings, inventory):
         raise JensRepositoriesError("Unable to write inventory to disk (%s)" % \
             error)
 
+# The inventory is rebuilt by crawling BAREDIR and CLONEDIR. As most
+# of the time is spent waiting for the filesystem, partitions and then
+# repositories are scanned concurrently by a pool of threads. Entries
+# that can't be trusted are moved aside (see _quarantine) so they're
+# created again instead of breaking the run.
 def _generate_inventory(settings):
     logging.info("Generating inventory of bares and clones...")
-    inventory = {}
-    for partition in ("modules", "hostgroups", "common"):
-        inventory[partition] = {}
-        baredir = settings.BAREDIR + "/%s" % partition
-        try:
-            names = os.listdir(baredir)
-        except OSError, error:
-            raise JensRepositoriesError("Unable to list %s (%s)" % \
-                (baredir, error))
-        for name in names:
-            inventory[partition][name] = \
-                _read_list_of_clones(settings, partition, name)
+    pool = ThreadPool(processes=int(math.ceil(cpu_count()*1.5)))
+    try:
+        listings = pool.map(lambda partition: (partition,
+            _scan_partition(settings, partition)), PARTITIONS)
+        data = [(partition, name) for partition, names in listings
+            for name in names]
+        results = pool.map(lambda (partition, name): (partition, name,
+            _read_list_of_clones(settings, partition, name)), data)
+    finally:
+        pool.close()
+        pool.join()
+    inventory = dict([(partition, {}) for partition in PARTITIONS])
+    for partition, name, clones in results:
+        if clones is not None:
+            inventory[partition][name] = clones
     return inventory
 
-def _read_list_of_clones(settings, partition, name):
+def _scan_partition(settings, partition):
+    baredir = settings.BAREDIR + "/%s" % partition
     try:
-        clones = os.listdir(settings.CLONEDIR + "/%s/%s" %
-            (partition, name))
+        return [name for name, is_link in _scan_directory(baredir)]
     except OSError, error:
-        raise JensRepositoriesError("Unable to list clones of %s/%s (%s)" % \
+        raise JensRepositoriesError("Unable to list %s (%s)" % \
+            (baredir, error))
+
+# Returns None if the repository had to be quarantined
+def _read_list_of_clones(settings, partition, name):
+    clones_path = settings.CLONEDIR + "/%s/%s" % (partition, name)
+    try:
+        entries = _scan_directory(clones_path)
+        tips = git.get_refs(settings.BAREDIR + "/%s/%s" % (partition, name))
+    except (OSError, JensGitError), error:
+        logging.warn("Unable to list clones of %s/%s (%s)" % \
             (partition, name, error))
-    return [dirname_to_refname(settings, clone) for clone in clones]
+        if _quarantine(settings, settings.BAREDIR, partition, name) and \
+                os.path.isdir(clones_path):
+            _quarantine(settings, settings.CLONEDIR, partition, name)
+        return None
+    # Links are checked once what they may point to has been verified
+    clones = []
+    for clone, is_link in sorted(entries, key=lambda entry: entry[1]):
+        if _is_consistent_clone(settings, clones_path, clone, is_link,
+                tips):
+            clones.append((clone, is_link))
+        else:
+            _quarantine(settings, settings.CLONEDIR, partition,
+                "%s/%s" % (name, clone))
+    # Clones of commits are kept under the full hash and abbreviated
+    # pins are links to them. Only what the links point to is skipped.
+    targets = [os.readlink("%s/%s" % (clones_path, clone))
+        for clone, is_link in clones if is_link]
+    return [dirname_to_refname(settings, clone) for clone, is_link in clones
+        if clone not in targets]
+
+# A clone is trusted if what's checked out can be read and it's the
+# commit the directory is named after or, for branches, the tip of the
+# branch in the bare (tips). Branches gone from the bare are left
+# alone, the refresh takes care of them.
+def _is_consistent_clone(settings, clones_path, clone, is_link, tips):
+    clone_path = "%s/%s" % (clones_path, clone)
+    if is_link:
+        return os.path.isdir(clone_path)
+    try:
+        head = git.get_head(clone_path)
+    except JensGitError:
+        return False
+    if head is None or re.match(r"^[0-9a-f]{40}$", head) is None:
+        return False
+    match = re.match(r"^\.([0-9a-f]+)$", clone)
+    if match is not None:
+        return head.startswith(match.group(1))
+    return tips.get(clone, head) == head
+
+# Returns whether the entry could be moved aside. If it couldn't, it's
+# left out of the inventory anyway.
+def _quarantine(settings, root, partition, relative_path):
+    path = "%s/%s/%s" % (root, partition, relative_path)
+    quarantine_path = "%s/.quarantine/%s/%s.%d" % (root, partition,
+        relative_path, time.time())
+    logging.warn("Quarantining inconsistent entry %s in %s" % \
+        (path, quarantine_path))
+    try:
+        if not os.path.isdir(os.path.dirname(quarantine_path)):
+            os.makedirs(os.path.dirname(quarantine_path))
+        os.rename(path, quarantine_path)
+    except OSError, error:
+        logging.error("Unable to quarantine %s (%s). Skipping." % \
+            (path, error))
+        return False
+    return True
+
+# Removes what was quarantined more than max_age seconds ago, as
+# nothing reads it back. Returns how many entries were removed.
+def purge_quarantine(settings, max_age):
+    removed = 0
+    deadline = time.time() - max_age
+    for root in (settings.BAREDIR, settings.CLONEDIR):
+        for partition in PARTITIONS:
+            removed = removed + _purge_quarantined(
+                "%s/.quarantine/%s" % (root, partition), deadline, 1)
+    return removed
+
+# Repositories are quarantined right under the partition and clones
+# one level below, in a directory named after their repository.
+def _purge_quarantined(path, deadline, depth):
+    removed = 0
+    try:
+        entries = os.listdir(path)
+    except OSError:
+        return 0
+    for entry in entries:
+        entry_path = "%s/%s" % (path, entry)
+        match = re.match(r"^.+\.(\d+)$", entry)
+        if match is not None and int(match.group(1)) <= deadline:
+            logging.debug("Removing quarantined %s" % entry_path)
+            try:
+                shutil.rmtree(entry_path)
+                removed = removed + 1
+            except OSError, error:
+                logging.error("Unable to remove %s (%s)" % \
+                    (entry_path, error))
+        elif depth > 0 and os.path.isdir(entry_path) and \
+                not os.path.islink(entry_path):
+            removed = removed + _purge_quarantined(entry_path, deadline,
+                depth - 1)
+            try:
+                os.rmdir(entry_path)
+            except OSError:
+                pass
+    return removed
+
+# Returns (name, is_link) for every entry in the directory, saving a
+# stat per entry when scandir is available.
+def _scan_directory(path):
+    if scandir is None:
+        return [(name, os.path.islink("%s/%s" % (path, name)))
+            for name in os.listdir(path)]
+    return [(entry.name, entry.is_symlink()) for entry in scandir(path)]
 
 # This is basically the 'look-ahead' bit
 def _read_desired_inventory(settings):
-    desired = {'modules': {}, 'hostgroups': {}, 'common': {}}
-    environments = get_names_of_declared_environments(settings)
-    for environmentname in environments:
-        try:
-            environment = read_environment_definition(
-                settings, environmentname)
-            # TODO: what if overrides empty? what if overrides,partition empty?
-            if 'overrides' in environment:
-                for partition in environment['overrides'].iterkeys():
-                    if partition in ("modules", "hostgroups", "common"):
-                        for name, override in \
-                                environment['overrides'][partition].iteritems():
-                            # prefixhash is equivalent to PREFIXhash, contrary to
-                            # refs (branches, sic) which as case-sensitiive
-                            if ref_is_commit(settings, override):
-                                override = override.lower()
-                            if name not in desired[partition]:
-                                desired[partition][name] = [override]
-                            else:
-                                if override not in desired[partition][name]:
-                                    desired[partition][name].append(override)
-        except JensEnvironmentsError, error:
-            logging.error("Unable to process '%s' definition. Skipping" % \
-                environmentname)
-            continue # Just ignore, as won't be generated later on either.
-    return desired
+    return update_refs_index(settings).get_overrides(settings)
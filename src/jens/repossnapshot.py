@@ -0,0 +1,95 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+import os
+import logging
+import pickle
+import hashlib
+import yaml
+
+from jens.errors import JensRepositoriesError
+
+# The definition of the repositories is kept parsed in
+# CACHEDIR/repositories.snapshot along with the hash of the file it came
+# from, so it's only parsed again when the file changes. When that
+# happens the new definition is compared to the snapshot to find out
+# which repositories were added, removed or moved to a different URL.
+
+def get_repositories_definition(settings):
+    try:
+        with open(settings.REPO_METADATA, "rb") as metadata_file:
+            content = metadata_file.read()
+    except IOError, error:
+        raise JensRepositoriesError("Unable to read %s (%s)" % \
+            (settings.REPO_METADATA, error))
+    digest = hashlib.sha1(content).hexdigest()
+    snapshot = _read_snapshot(settings)
+    if snapshot is not None and snapshot['hash'] == digest:
+        logging.debug("Repositories definition didn't change (%s)" % digest)
+        return snapshot, _diff(snapshot['definition'], snapshot['definition'])
+    logging.debug("Reading metadata from %s" % settings.REPO_METADATA)
+    try:
+        definition = yaml.load(content)
+        repositories = definition['repositories']
+        for partition in ("modules", "hostgroups", "common"):
+            repositories[partition] = repositories[partition] or {}
+    except Exception, error:
+        raise JensRepositoriesError("Unable to parse %s" % \
+            settings.REPO_METADATA)
+    previous = snapshot['definition'] if snapshot is not None else repositories
+    return ({'hash': digest, 'definition': repositories},
+        _diff(previous, repositories))
+
+# Repositories in unsettled (per partition) are stored without URL and
+# the hash is dropped, so they're seen as moved again by the next run.
+def persist_repositories_snapshot(settings, snapshot, unsettled=None):
+    if unsettled and any(unsettled.values()):
+        definition = dict([(partition, dict(urls))
+            for partition, urls in snapshot['definition'].iteritems()])
+        for partition, names in unsettled.iteritems():
+            for name in names:
+                definition[partition][name] = None
+        snapshot = {'hash': None, 'definition': definition}
+    snapshot_path = _get_snapshot_path(settings)
+    temporary_path = "%s.tmp" % snapshot_path
+    try:
+        with open(temporary_path, "wb") as snapshot_file:
+            pickle.dump(snapshot, snapshot_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary_path, snapshot_path)
+    except (IOError, OSError, pickle.PickleError), error:
+        raise JensRepositoriesError("Unable to write repositories snapshot (%s)" % \
+            error)
+
+def remove_repositories_snapshot(settings):
+    snapshot_path = _get_snapshot_path(settings)
+    if os.path.exists(snapshot_path):
+        os.remove(snapshot_path)
+
+# Names added and removed and, for the ones in both, those whose URL
+# changed (with the new one), per partition
+def _diff(old, new):
+    diff = {}
+    for partition in ("modules", "hostgroups", "common"):
+        old_urls = old.get(partition, {})
+        new_urls = new.get(partition, {})
+        old_names, new_names = set(old_urls), set(new_urls)
+        diff[partition] = {'added': new_names.difference(old_names),
+            'removed': old_names.difference(new_names),
+            'moved': dict([(name, new_urls[name])
+                for name in old_names.intersection(new_names)
+                if old_urls[name] != new_urls[name]])}
+    return diff
+
+def _read_snapshot(settings):
+    try:
+        with open(_get_snapshot_path(settings), "rb") as snapshot_file:
+            return pickle.load(snapshot_file)
+    except (IOError, EOFError, pickle.PickleError):
+        return None
+
+def _get_snapshot_path(settings):
+    return settings.CACHEDIR + "/repositories.snapshot"
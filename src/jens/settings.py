@@ -54,6 +54,20 @@ class Settings():
         self.ENV_METADATADIR = config["main"]["environmentsmetadatadir"]
         self.HASHPREFIX = config["main"]["hashprefix"]
         self.DIRECTORY_ENVIRONMENTS = config["main"]["directory_environments"]
+        self.SHARED_LAYERS = config["main"]["shared_layers"]
+        self.LAYERSDIR = config["main"]["layersdir"]
+        self.CODE_IDS = config["main"]["code_ids"]
+        self.JOURNAL = config["main"]["journal"]
+        self.PIPELINE = config["main"]["pipeline"]
+        self.FASTPATH = config["main"]["fastpath"]
+        self.COALESCE = config["main"]["coalesce"]
+
+        # [git]
+        self.GIT_DEPTH = config["git"]["depth"]
+        self.GIT_NARROWREFSPECS = config["git"]["narrowrefspecs"]
+        self.GIT_BOOTSTRAPSTEP = config["git"]["bootstrapstep"]
+        self.GIT_OBJECTPOOLS = config["git"]["objectpools"]
+        self.GIT_REFLINKS = config["git"]["reflinks"]
 
         # [lock]
         self.LOCK_TYPE = config["lock"]["type"]
@@ -67,6 +81,27 @@ class Settings():
         self.ETCD_ACQTIMEOUT = config["etcd"]["acqtimeout"]
         self.ETCD_INITIALTTL = config["etcd"]["initialttl"]
 
+        # [shards]
+        self.SHARDS_TYPE = config["shards"]["type"]
+        self.SHARDS_COUNT = config["shards"]["count"]
+        self.SHARDS_LOCALDIR = config["shards"]["localdir"]
+        self.SHARDS_TTL = config["shards"]["ttl"]
+
+        # [notifications]
+        self.NOTIFICATIONS_TYPE = config["notifications"]["type"]
+
+        # [commitcache]
+        self.COMMITCACHE_ENABLED = config["commitcache"]["enabled"]
+        self.COMMITCACHE_DIR = config["commitcache"]["dir"]
+        self.COMMITCACHE_BUDGET = config["commitcache"]["budget"]
+
+        # [puppetserver]
+        self.PUPPETSERVER_URL = config["puppetserver"]["url"]
+        self.PUPPETSERVER_SSLCERT = config["puppetserver"]["sslcert"]
+        self.PUPPETSERVER_SSLKEY = config["puppetserver"]["sslkey"]
+        self.PUPPETSERVER_CACERT = config["puppetserver"]["cacert"]
+        self.PUPPETSERVER_TIMEOUT = config["puppetserver"]["timeout"]
+
         if self.logfile:
             logging.basicConfig(
                 level = getattr(logging, self.DEBUG_LEVEL),
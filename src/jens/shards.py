@@ -0,0 +1,285 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+import os
+import errno
+import fcntl
+import socket
+import shutil
+import logging
+import pickle
+import hashlib
+
+from jens.errors import JensShardsError
+from jens.locks import make_etcd_client
+
+# Several nodes sharing the storage (BAREDIR, CLONEDIR and CACHEDIR) can
+# split the refresh of the existing repositories among them. These are
+# spread over SHARDS_COUNT shards by a hash of their names and runs are
+# numbered (generations). In every generation each node claims as many
+# shards as it can, refreshes them and marks them as done, leaving what
+# happened in CACHEDIR/shards/<generation>/<shard>. The node that finds
+# all the shards done claims the finalizer: a regular run that reuses
+# those results and takes care of everything else (new and deleted
+# repositories, the inventory and the environments). Once it's over the
+# next generation starts.
+#
+# Claims are leases: if the node holding one dies the shard, or the
+# finalizer, can be claimed again. They're keys with a TTL in etcd or,
+# as a stand-in for a single host (i.e. the tests), flocks on files in
+# SHARDS_LOCALDIR.
+
+class JensCoordinatorFactory(object):
+    @staticmethod
+    def makeCoordinator(settings):
+        if settings.SHARDS_TYPE == 'LOCAL':
+            return JensLocalCoordinator(settings)
+        elif settings.SHARDS_TYPE == 'ETCD':
+            return JensEtcdCoordinator(settings)
+        else: # Shouldn't ever happen, config is validated
+            raise JensShardsError("Unknown coordinator type '%s'" % \
+                settings.SHARDS_TYPE)
+
+class JensCoordinator(object):
+    def __init__(self, settings):
+        self.settings = settings
+        self.node = "%s:%d" % (socket.gethostname(), os.getpid())
+
+    # The finalizer can only be claimed once all the shards are done
+    def claim_finalizer(self, generation):
+        if not self.is_finished(generation):
+            return False
+        return self.claim(generation, "finalizer")
+
+    def claim_shard(self, generation, shard):
+        if self.is_done(generation, shard):
+            return False
+        if not self.claim(generation, "shard.%d" % shard):
+            return False
+        # It may have been finished, or the generation finalized, while
+        # the claim was being made
+        if self.is_done(generation, shard) or \
+                self.get_generation() != generation:
+            self.release(generation, "shard.%d" % shard)
+            return False
+        return True
+
+    def release_shard(self, generation, shard, done):
+        if done:
+            self.mark_done(generation, shard)
+        self.release(generation, "shard.%d" % shard)
+
+    def is_finished(self, generation):
+        return all([self.is_done(generation, shard)
+            for shard in range(self.settings.SHARDS_COUNT)])
+
+    def renew(self, generation, shard):
+        pass
+
+class JensLocalCoordinator(JensCoordinator):
+    def __init__(self, settings):
+        super(JensLocalCoordinator, self).__init__(settings)
+        self.claims = {}
+
+    def get_generation(self):
+        try:
+            with open(self.__get_path("generation"), "r") as generation_file:
+                return int(generation_file.read())
+        except IOError:
+            return 0
+        except ValueError, error:
+            raise JensShardsError("Corrupt generation counter (%s)" % error)
+
+    def claim(self, generation, name):
+        path = self.__get_path(str(generation), name)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            claim_file = open(path, "w")
+        except (IOError, OSError), error:
+            if getattr(error, 'errno', None) == errno.EEXIST:
+                return self.claim(generation, name)
+            raise JensShardsError("Unable to claim %s (%s)" % (name, error))
+        try:
+            fcntl.flock(claim_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            claim_file.close()
+            return False
+        self.claims[(generation, name)] = claim_file
+        return True
+
+    def release(self, generation, name):
+        claim_file = self.claims.pop((generation, name), None)
+        if claim_file is not None:
+            fcntl.flock(claim_file, fcntl.LOCK_UN)
+            claim_file.close()
+
+    def mark_done(self, generation, shard):
+        try:
+            open(self.__get_path(str(generation), "shard.%d.done" % shard),
+                "w").close()
+        except IOError, error:
+            raise JensShardsError("Unable to mark shard %d as done (%s)" % \
+                (shard, error))
+
+    def is_done(self, generation, shard):
+        return os.path.exists(self.__get_path(str(generation),
+            "shard.%d.done" % shard))
+
+    def finish_generation(self, generation):
+        if self.get_generation() == generation:
+            generation_path = self.__get_path("generation")
+            try:
+                with open("%s.tmp" % generation_path, "w") as generation_file:
+                    generation_file.write(str(generation + 1))
+                os.rename("%s.tmp" % generation_path, generation_path)
+            except (IOError, OSError), error:
+                raise JensShardsError("Unable to start generation %d (%s)" % \
+                    (generation + 1, error))
+        self.release(generation, "finalizer")
+        # Including the leftovers of nodes that were late
+        for name in os.listdir(self.settings.SHARDS_LOCALDIR):
+            if name.isdigit() and int(name) <= generation:
+                shutil.rmtree(self.__get_path(name), ignore_errors=True)
+
+    def __get_path(self, *names):
+        return os.path.join(self.settings.SHARDS_LOCALDIR, *names)
+
+class JensEtcdCoordinator(JensCoordinator):
+    def __init__(self, settings):
+        super(JensEtcdCoordinator, self).__init__(settings)
+        try:
+            import etcd
+            self.etcd = etcd
+        except ImportError:
+            raise JensShardsError("python-etcd not installed")
+        try:
+            self.client = make_etcd_client(settings, etcd)
+        except Exception, error:
+            raise JensShardsError("Unable to connect to etcd (%s)" % error)
+        self.base = "/%s/shards" % settings.LOCK_NAME
+
+    def get_generation(self):
+        try:
+            return int(self.client.read("%s/generation" % self.base).value)
+        except self.etcd.EtcdKeyNotFound:
+            return 0
+        except self.etcd.EtcdException, error:
+            raise JensShardsError("Unable to read generation (%s)" % error)
+
+    def claim(self, generation, name):
+        try:
+            self.client.write(self.__get_key(generation, name), self.node,
+                prevExist=False, ttl=self.settings.SHARDS_TTL)
+            return True
+        except self.etcd.EtcdAlreadyExist:
+            return False
+        except self.etcd.EtcdException, error:
+            raise JensShardsError("Unable to claim %s (%s)" % (name, error))
+
+    # Claims are renewed so they don't expire while being worked on
+    def renew(self, generation, shard):
+        try:
+            self.client.write(self.__get_key(generation, "shard.%d" % shard),
+                self.node, prevValue=self.node, ttl=self.settings.SHARDS_TTL)
+        except self.etcd.EtcdException, error:
+            raise JensShardsError("Unable to renew claim of shard %d (%s)" % \
+                (shard, error))
+
+    def release(self, generation, name):
+        try:
+            self.client.delete(self.__get_key(generation, name),
+                prevValue=self.node)
+        except (self.etcd.EtcdKeyNotFound, self.etcd.EtcdCompareFailed):
+            pass # Expired, nothing to release
+        except self.etcd.EtcdException, error:
+            raise JensShardsError("Unable to release %s (%s)" % (name, error))
+
+    def mark_done(self, generation, shard):
+        try:
+            self.client.write(self.__get_key(generation,
+                "shard.%d.done" % shard), self.node)
+        except self.etcd.EtcdException, error:
+            raise JensShardsError("Unable to mark shard %d as done (%s)" % \
+                (shard, error))
+
+    def is_done(self, generation, shard):
+        try:
+            self.client.read(self.__get_key(generation, "shard.%d.done" % shard))
+            return True
+        except self.etcd.EtcdKeyNotFound:
+            return False
+        except self.etcd.EtcdException, error:
+            raise JensShardsError("Unable to read shard %d (%s)" % \
+                (shard, error))
+
+    def finish_generation(self, generation):
+        key = "%s/generation" % self.base
+        try:
+            try:
+                self.client.write(key, generation + 1, prevValue=generation)
+            except self.etcd.EtcdKeyNotFound:
+                self.client.write(key, generation + 1, prevExist=False)
+            self.client.delete("%s/%d" % (self.base, generation),
+                recursive=True)
+        except (self.etcd.EtcdCompareFailed, self.etcd.EtcdAlreadyExist):
+            logging.warn("Generation %d was already finished" % generation)
+        except self.etcd.EtcdException, error:
+            raise JensShardsError("Unable to start generation %d (%s)" % \
+                (generation + 1, error))
+
+    def __get_key(self, generation, name):
+        return "%s/%d/%s" % (self.base, generation, name)
+
+# Stable across nodes, unlike hash()
+def shard_of(settings, partition, name):
+    digest = hashlib.sha1("%s/%s" % (partition, name)).hexdigest()
+    return int(digest, 16) % settings.SHARDS_COUNT
+
+def store_shard_results(settings, generation, shard, results):
+    results_path = _get_results_path(settings, generation)
+    temporary_path = "%s/.%d.tmp" % (results_path, shard)
+    try:
+        if not os.path.isdir(results_path):
+            os.makedirs(results_path)
+        with open(temporary_path, "wb") as results_file:
+            pickle.dump(results, results_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary_path, "%s/%d" % (results_path, shard))
+    except (IOError, OSError, pickle.PickleError), error:
+        raise JensShardsError("Unable to store results of shard %d (%s)" % \
+            (shard, error))
+
+# What happened to every repository refreshed in the generation, per
+# partition. The shards whose results can't be read are listed in
+# 'unread': their repositories were refreshed anyway, so the finalizer
+# can't tell what changed from its own fetch.
+def read_shards_results(settings, generation):
+    results = {'modules': {}, 'hostgroups': {}, 'common': {}, 'unread': []}
+    for shard in range(settings.SHARDS_COUNT):
+        try:
+            with open("%s/%d" % (_get_results_path(settings, generation),
+                    shard), "rb") as results_file:
+                shard_results = pickle.load(results_file)
+        except (IOError, EOFError, pickle.PickleError), error:
+            logging.error("Unable to read results of shard %d (%s)" % \
+                (shard, error))
+            results['unread'].append(shard)
+            continue
+        for partition, repositories in shard_results.iteritems():
+            results[partition].update(repositories)
+    return results
+
+def remove_shards_results(settings, generation):
+    base_path = settings.CACHEDIR + "/shards"
+    if not os.path.isdir(base_path):
+        return
+    for name in os.listdir(base_path):
+        if name.isdigit() and int(name) <= generation:
+            shutil.rmtree("%s/%s" % (base_path, name), ignore_errors=True)
+
+def _get_results_path(settings, generation):
+    return settings.CACHEDIR + "/shards/%d" % generation
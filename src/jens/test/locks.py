@@ -0,0 +1,119 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+import os
+
+from jens.locks import JensLockFactory, JensEtcdResourceLock
+from jens.errors import JensLockExistsError
+from jens.triggers import request_run, consume_run_request
+from jens.triggers import is_run_requested
+
+from jens.test.tools import install_fake_etcd, remove_fake_etcd
+from jens.test.testcases import JensTestCase
+
+class LocksTest(JensTestCase):
+    def setUp(self):
+        super(LocksTest, self).setUp()
+
+        self.settings.LOCK_TYPE = 'FILE'
+        self.settings.FILELOCK_LOCKDIR = "%s/lock" % self.sandbox_path
+        os.mkdir(self.settings.FILELOCK_LOCKDIR)
+
+    def _assertLockIsTaken(self, **kwargs):
+        lock = JensLockFactory.makeLock(self.settings, **kwargs)
+        self.assertRaises(JensLockExistsError, lock.__enter__)
+
+    def _assertLockIsFree(self, **kwargs):
+        with JensLockFactory.makeLock(self.settings, **kwargs):
+            pass
+
+    #### TESTS ####
+
+    def test_shared_locks_are_compatible(self):
+        with JensLockFactory.makeLock(self.settings, shared=True):
+            self._assertLockIsFree(shared=True)
+            self._assertLockIsTaken()
+
+    def test_exclusive_lock_keeps_everybody_else_out(self):
+        with JensLockFactory.makeLock(self.settings):
+            self._assertLockIsTaken()
+            self._assertLockIsTaken(shared=True)
+
+    def test_locks_are_released(self):
+        with JensLockFactory.makeLock(self.settings):
+            pass
+        self._assertLockIsFree()
+        with JensLockFactory.makeLock(self.settings, shared=True):
+            pass
+        self._assertLockIsFree()
+
+    def test_locks_below_the_global_one_are_independent(self):
+        with JensLockFactory.makeLock(self.settings, shared=True):
+            with JensLockFactory.makePartitionLock(self.settings, 'modules',
+                    shared=True):
+                with JensLockFactory.makeRepositoryLock(self.settings,
+                        'modules', 'foo'):
+                    self._assertLockIsTaken(resource=('modules', 'foo'))
+                    self._assertLockIsFree(resource=('modules', 'bar'))
+                    self._assertLockIsFree(resource=('hostgroups', 'foo'))
+                    self._assertLockIsTaken(resource=('modules',))
+                    self._assertLockIsFree(resource=('hostgroups',))
+                    self._assertLockIsFree(resource=('update',))
+        self._assertLockIsFree(resource=('modules', 'foo'))
+
+    def test_etcd_locks_are_shared_and_hierarchical(self):
+        etcd = install_fake_etcd()
+        try:
+            self.settings.LOCK_TYPE = 'ETCD'
+            self.settings.ETCD_ACQTIMEOUT = 0
+            # jens-update and jens-gc at the same time
+            with JensLockFactory.makeLock(self.settings, shared=True):
+                self._assertLockIsFree(shared=True)
+                self._assertLockIsTaken()
+                with JensLockFactory.makePartitionLock(self.settings,
+                        'modules', shared=True):
+                    self._assertLockIsFree(resource=('modules',),
+                        shared=True)
+                    self._assertLockIsTaken(resource=('modules',))
+                    with JensLockFactory.makeRepositoryLock(self.settings,
+                            'modules', 'foo'):
+                        self._assertLockIsTaken(resource=('modules', 'foo'))
+                        self._assertLockIsTaken(resource=('modules', 'foo'),
+                            shared=True)
+                        self._assertLockIsFree(resource=('modules', 'bar'))
+                        self._assertLockIsFree(resource=('hostgroups', 'foo'))
+            # Nothing left behind
+            self.assertEquals(etcd.store, {})
+            self.assertEquals(JensEtcdResourceLock.held, set())
+            self._assertLockIsFree()
+        finally:
+            remove_fake_etcd()
+
+    def test_etcd_locks_below_the_global_one_are_renewed_with_it(self):
+        etcd = install_fake_etcd()
+        try:
+            self.settings.LOCK_TYPE = 'ETCD'
+            self.settings.ETCD_ACQTIMEOUT = 0
+            with JensLockFactory.makeLock(self.settings, shared=True) as lock:
+                with JensLockFactory.makeLock(self.settings,
+                        resource=('update',)):
+                    lock.renew(600)
+                    self.assertEquals(
+                        etcd.store["/%s.update/owner" % \
+                            self.settings.LOCK_NAME][1], 600)
+        finally:
+            JensEtcdResourceLock.ttl = None
+            remove_fake_etcd()
+
+    def test_run_requests_are_coalesced(self):
+        self.assertFalse(consume_run_request(self.settings))
+        request_run(self.settings)
+        request_run(self.settings)
+        self.assertTrue(is_run_requested(self.settings))
+        self.assertTrue(consume_run_request(self.settings))
+        self.assertFalse(is_run_requested(self.settings))
+        self.assertFalse(consume_run_request(self.settings))
@@ -8,10 +8,14 @@
 import shutil
 
 from jens.maintenance import refresh_metadata
-from jens.git import clone
+from jens.environments import update_refs_index
+from jens.git import clone, fetch
+from jens.fingerprint import take_fingerprint, matches_last_run
+from jens.fingerprint import record_fingerprint
 from jens.errors import JensError
 
 from jens.test.tools import create_fake_repository
+from jens.test.tools import init_repositories, add_repository
 from jens.test.tools import add_commit_to_branch, reset_branch_to
 from jens.test.tools import get_repository_head
 
@@ -57,6 +61,85 @@ class MetadataTest(JensTestCase):
         self.assertEquals(get_repository_head(self.settings,\
             self.settings.REPO_METADATADIR), new_commit)
 
+    def test_heads_before_and_after_are_returned(self):
+        initial = get_repository_head(self.settings, self.environments)
+        heads = refresh_metadata(self.settings, self.lock)
+        self.assertEquals(heads['environments'], (initial, initial))
+
+        new_commit = add_commit_to_branch(self.settings, \
+            self.repositories, 'master')
+        heads = refresh_metadata(self.settings, self.lock)
+        self.assertEquals(heads['environments'], (initial, initial))
+        self.assertNotEquals(heads['repositories'][0], new_commit)
+        self.assertEquals(heads['repositories'][1], new_commit)
+
+        self.assertEquals(update_refs_index(self.settings).head, initial)
+
+    def test_fingerprint_matches_until_something_changes(self):
+        self._jens_refresh_metadata()
+        (module_bare, module) = create_fake_repository(self.settings,
+            self.sandbox_path, ['qa'])
+        bare_path = "%s/modules/foo" % self.settings.BAREDIR
+        clone(bare_path, module_bare, bare=True)
+        init_repositories(self.settings)
+        add_repository(self.settings, 'modules', 'foo', module_bare)
+
+        fingerprint = take_fingerprint(self.settings, self.config_file_path)
+        self.assertFalse(matches_last_run(self.settings, fingerprint))
+        record_fingerprint(self.settings, fingerprint)
+        self.assertTrue(matches_last_run(self.settings,
+            take_fingerprint(self.settings, self.config_file_path)))
+
+        # -- The remote of a bare moves
+
+        add_commit_to_branch(self.settings, module, 'qa')
+        fingerprint = take_fingerprint(self.settings, self.config_file_path)
+        self.assertFalse(matches_last_run(self.settings, fingerprint))
+
+        # -- The bare didn't catch up, so it's not recorded
+
+        record_fingerprint(self.settings, fingerprint)
+        self.assertFalse(matches_last_run(self.settings, fingerprint))
+
+        # -- Metadata moves
+
+        fetch(bare_path, prune=True, bare=True)
+        record_fingerprint(self.settings, fingerprint)
+        self.assertTrue(matches_last_run(self.settings, fingerprint))
+        add_commit_to_branch(self.settings, self.environments, 'master')
+        self.assertFalse(matches_last_run(self.settings,
+            take_fingerprint(self.settings, self.config_file_path)))
+
+    def test_fingerprint_covers_missing_repositories_and_clones(self):
+        self._jens_refresh_metadata()
+        init_repositories(self.settings)
+        (bar_bare, bar) = create_fake_repository(self.settings,
+            self.sandbox_path, ['qa'])
+        add_repository(self.settings, 'modules', 'bar', bar_bare)
+        (baz_bare, baz) = create_fake_repository(self.settings,
+            self.sandbox_path)
+        clone_path = "%s/modules/baz/master" % self.settings.CLONEDIR
+        clone(clone_path, baz_bare, branch='master')
+
+        fingerprint = take_fingerprint(self.settings, self.config_file_path)
+        self.assertTrue('modules/bar' in fingerprint['missing'])
+        record_fingerprint(self.settings, fingerprint)
+        self.assertTrue(matches_last_run(self.settings,
+            take_fingerprint(self.settings, self.config_file_path)))
+
+        # -- The remote of a declared repository without bare moves
+
+        add_commit_to_branch(self.settings, bar, 'qa')
+        fingerprint = take_fingerprint(self.settings, self.config_file_path)
+        self.assertFalse(matches_last_run(self.settings, fingerprint))
+        record_fingerprint(self.settings, fingerprint)
+
+        # -- A clone goes away
+
+        shutil.rmtree(clone_path)
+        self.assertFalse(matches_last_run(self.settings,
+            take_fingerprint(self.settings, self.config_file_path)))
+
     def test_fails_if_remote_repositories_unavailable(self):
         initial = get_repository_head(self.settings, self.repositories)
         self.assertEquals(get_repository_head(self.settings,\
@@ -0,0 +1,73 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from jens.shards import JensCoordinatorFactory, shard_of
+
+from jens.test.testcases import JensTestCase
+
+class ShardsTest(JensTestCase):
+    def setUp(self):
+        super(ShardsTest, self).setUp()
+
+        self.settings.SHARDS_TYPE = 'LOCAL'
+        self.settings.SHARDS_COUNT = 2
+        self.settings.SHARDS_LOCALDIR = "%s/shards" % self.sandbox_path
+        # Two nodes
+        self.first = JensCoordinatorFactory.makeCoordinator(self.settings)
+        self.second = JensCoordinatorFactory.makeCoordinator(self.settings)
+
+    #### TESTS ####
+
+    def test_shards_are_claimed_once(self):
+        self.assertEquals(self.first.get_generation(), 0)
+        self.assertTrue(self.first.claim_shard(0, 0))
+        self.assertFalse(self.second.claim_shard(0, 0))
+        self.assertTrue(self.second.claim_shard(0, 1))
+
+        # -- Released without finishing, as if the node died
+
+        self.first.release_shard(0, 0, False)
+        self.assertTrue(self.second.claim_shard(0, 0))
+        self.second.release_shard(0, 0, True)
+        self.assertFalse(self.first.claim_shard(0, 0))
+
+    def test_generation_is_finalized_once_all_shards_are_done(self):
+        self.assertTrue(self.first.claim_shard(0, 0))
+        self.first.release_shard(0, 0, True)
+        self.assertFalse(self.first.claim_finalizer(0))
+
+        self.assertTrue(self.second.claim_shard(0, 1))
+        self.second.release_shard(0, 1, True)
+        self.assertTrue(self.first.is_finished(0))
+        self.assertTrue(self.second.claim_finalizer(0))
+        self.assertFalse(self.first.claim_finalizer(0))
+
+        self.second.finish_generation(0)
+
+        self.assertEquals(self.first.get_generation(), 1)
+        self.assertFalse(self.first.is_finished(1))
+        self.assertFalse(self.first.claim_shard(0, 0))
+        self.assertTrue(self.first.claim_shard(1, 0))
+
+    def test_finalizer_is_claimable_again_if_finalizing_fails(self):
+        for shard in range(self.settings.SHARDS_COUNT):
+            self.assertTrue(self.first.claim_shard(0, shard))
+            self.first.release_shard(0, shard, True)
+        self.assertTrue(self.first.claim_finalizer(0))
+        self.assertFalse(self.second.claim_finalizer(0))
+
+        self.first.release(0, "finalizer")
+
+        self.assertEquals(self.second.get_generation(), 0)
+        self.assertTrue(self.second.claim_finalizer(0))
+
+    def test_repositories_are_always_in_the_same_shard(self):
+        shards = set([shard_of(self.settings, 'modules', "module%d" % index)
+            for index in range(20)])
+        self.assertEquals(shards, set([0, 1]))
+        self.assertEquals(shard_of(self.settings, 'modules', 'foo'),
+            shard_of(self.settings, 'modules', 'foo'))
@@ -28,6 +28,7 @@ baredir = $sandbox/lib/bare
 clonedir = $sandbox/lib/clone
 cachedir = $sandbox/lib/cache
 environmentsdir = $sandbox/lib/environments
+layersdir = $sandbox/lib/layers
 debuglevel = $debuglevel
 logdir = $sandbox/log
 mandatorybranches = $mandatory_branches
@@ -36,6 +37,9 @@ repositorymetadatadir = $sandbox/lib/metadata/repositories
 repositorymetadata = $sandbox/lib/metadata/repositories/repositories.yaml
 hashprefix = $hashprefix
 
+[commitcache]
+dir = $sandbox/lib/commits
+
 [lock]
 type = DISABLED
 """)
@@ -81,6 +85,8 @@ class JensTestCase(unittest.TestCase):
             self.log
         except AttributeError:
             self.log = open("%s/jens-test.log" % self.settings.LOGDIR)
+        # Drops what was buffered when EOF was hit last time
+        self.log.seek(self.log.tell())
         for line in self.log.readlines():
             if re.match(r'.+ERROR.+', line):
                 raise AssertionError(line)
@@ -90,6 +96,7 @@ class JensTestCase(unittest.TestCase):
             self.log
         except AttributeError:
             self.log = open("%s/jens-test.log" % self.settings.LOGDIR)
+        self.log.seek(self.log.tell())
         found = False
         regexp = r'.+ERROR.+'
         if errorRegexp is not None:
@@ -110,7 +117,8 @@ class JensTestCase(unittest.TestCase):
             raise AssertionError("Clone '%s' does not have code dir" % path)
         if not os.path.isdir("%s/data" % path):
             raise AssertionError("Clone '%s' does not have data dir" % path)
-        inventory = get_inventory(self.settings)
+        inventory = get_inventory(self.settings, generate=False)
+        self.assertTrue(inventory is not None)
         self.assertTrue(partition in inventory)
         self.assertTrue(element in inventory[partition])
         refname = dirname_to_refname(self.settings, dirname)
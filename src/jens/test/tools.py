@@ -6,10 +6,15 @@
 # or submit itself to any jurisdiction.
 
 import os
+import sys
+import types
 import yaml
 import tempfile
 import shutil
 import time
+import threading
+import urlparse
+import BaseHTTPServer
 
 from jens.git import _git
 
@@ -21,8 +26,10 @@ def init_sandbox(path):
         "%s/lib/clone/common" % path,
         "%s/lib/clone/modules" % path,
         "%s/lib/clone/hostgroups" % path,
-        "%s/lib/cache/environments" % path,
+        "%s/lib/cache" % path,
+        "%s/lib/commits" % path,
         "%s/lib/environments" % path,
+        "%s/lib/layers" % path,
         "%s/lib/metadata/environments" % path,
         "%s/lib/metadata/repositories" % path,
         "%s/log" % path,
@@ -32,6 +39,9 @@ def init_sandbox(path):
     map(os.makedirs, dirs)
 
 def destroy_sandbox(path):
+    # Entries of the commit cache are read-only
+    for root, dirs, files in os.walk(path):
+        os.chmod(root, 0755)
     shutil.rmtree(path)
 
 def ensure_environment(settings, envname, default,
@@ -151,6 +161,17 @@ def get_repository_head(settings, repo_path):
     (out, code) =_git(args, gitdir=gitdir, gitworkingtree=repo_path)
     return out.strip()
 
+def get_repository_remote(settings, repo_path):
+    args = ["config", "remote.origin.url"]
+    gitdir = "%s/.git" % repo_path
+    (out, code) =_git(args, gitdir=gitdir, gitworkingtree=repo_path)
+    return out.strip()
+
+def create_partial_clone(settings, path, url):
+    args = ["clone", "--bare", "--mirror", "--depth", "1",
+        "--no-single-branch", "file://%s" % url, path]
+    _git(args)
+
 def add_branch_to_repo(settings, repo_path, branch):
     gitdir = "%s/.git" % repo_path
     args = ["checkout", "-b", branch]
@@ -191,3 +212,141 @@ def reset_branch_to(settings, repo_path, branch, commit_id):
     _git(args, gitdir=gitdir, gitworkingtree=repo_path)
     args = ["reset", "--hard", commit_id]
     _git(args, gitdir=gitdir, gitworkingtree=repo_path)
+
+# Unlike jens-gc, gets rid of unreachable objects straight away
+def prune_repository(settings, repo_path):
+    _git(["gc", "--quiet", "--prune=now"], gitdir=repo_path)
+
+# Stand-in for Puppet Server's environment-cache admin endpoint
+class FakeEnvironmentCacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_DELETE(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        self.server.flushed.extend(query.get('environment', []))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_environment_cache(settings):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+        FakeEnvironmentCacheHandler)
+    server.flushed = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    settings.NOTIFICATIONS_TYPE = 'PUPPETSERVER'
+    settings.PUPPETSERVER_URL = \
+        "http://127.0.0.1:%d/puppet-admin-api/v1/environment-cache" % \
+        server.server_address[1]
+    return server
+
+def stop_fake_environment_cache(server):
+    server.shutdown()
+    server.server_close()
+
+# Stand-in for python-etcd, keeping the keys in memory. TTLs are
+# recorded but keys never expire.
+class FakeEtcdException(Exception):
+    pass
+
+class FakeEtcdKeyNotFound(FakeEtcdException):
+    pass
+
+class FakeEtcdAlreadyExist(FakeEtcdException):
+    pass
+
+class FakeEtcdCompareFailed(FakeEtcdException):
+    pass
+
+class FakeEtcdResult(object):
+    def __init__(self, key, value=None, children=None):
+        self.key = key
+        self.value = value
+        self.dir = children is not None
+        self.children = children or []
+
+    @property
+    def leaves(self):
+        if not self.children:
+            yield self
+        for child in self.children:
+            yield child
+
+class FakeEtcdLock(object):
+    def __init__(self, client, name, ttl):
+        self.client = client
+        self.key = "/_locks%s" % name
+        self.ttl = ttl
+
+    def acquire(self, timeout=None):
+        from urllib3.exceptions import TimeoutError
+        try:
+            self.client.write(self.key, "held", ttl=self.ttl, prevExist=False)
+        except FakeEtcdAlreadyExist:
+            raise TimeoutError("Lock already taken")
+
+    def release(self):
+        self.client.delete(self.key)
+
+    def renew(self, ttl, timeout=None):
+        self.client.write(self.key, "held", ttl=ttl, prevExist=True)
+
+class FakeEtcdClient(object):
+    def __init__(self, store, **kwargs):
+        self.store = store
+        self.leader = "fake"
+        self.machines = ["fake"]
+
+    def write(self, key, value, ttl=None, prevExist=None, prevValue=None):
+        current = self.store.get(key)
+        if prevExist is False and current is not None:
+            raise FakeEtcdAlreadyExist(key)
+        if (prevExist or prevValue is not None) and current is None:
+            raise FakeEtcdKeyNotFound(key)
+        if prevValue is not None and current[0] != str(prevValue):
+            raise FakeEtcdCompareFailed(key)
+        self.store[key] = (str(value), ttl)
+        return FakeEtcdResult(key, str(value))
+
+    def read(self, key, recursive=False):
+        if key in self.store:
+            return FakeEtcdResult(key, self.store[key][0])
+        children = [FakeEtcdResult(name, value)
+            for name, (value, ttl) in sorted(self.store.iteritems())
+            if name.startswith(key + "/")]
+        if not children:
+            raise FakeEtcdKeyNotFound(key)
+        return FakeEtcdResult(key, children=children)
+
+    def delete(self, key, prevValue=None, recursive=False):
+        if key not in self.store:
+            names = [name for name in self.store.keys()
+                if name.startswith(key + "/")]
+            if not names or not recursive:
+                raise FakeEtcdKeyNotFound(key)
+            for name in names:
+                del self.store[name]
+            return
+        if prevValue is not None and self.store[key][0] != str(prevValue):
+            raise FakeEtcdCompareFailed(key)
+        del self.store[key]
+
+    def get_lock(self, name, ttl=None):
+        return FakeEtcdLock(self, name, ttl)
+
+# All the clients made while it's installed share the same keys, which
+# are available in the 'store' attribute of the module returned
+def install_fake_etcd():
+    module = types.ModuleType("etcd")
+    module.store = {}
+    module.Client = lambda **kwargs: FakeEtcdClient(module.store, **kwargs)
+    module.EtcdException = FakeEtcdException
+    module.EtcdKeyNotFound = FakeEtcdKeyNotFound
+    module.EtcdAlreadyExist = FakeEtcdAlreadyExist
+    module.EtcdCompareFailed = FakeEtcdCompareFailed
+    sys.modules['etcd'] = module
+    return module
+
+def remove_fake_etcd():
+    sys.modules.pop('etcd', None)
@@ -6,13 +6,33 @@
 # or submit itself to any jurisdiction.
 
 import os
+import stat
+import time
 import yaml
 import shutil
+import socket
+import subprocess
 
-from jens.repos import refresh_repositories
+import jens.git
+import jens.journal
+import jens.reflinks
+import jens.repos
+import jens.shards
+
+from jens.repos import refresh_repositories, refresh_shards
 from jens.locks import JensLockFactory
+from jens.errors import JensLockExistsError
+from jens.reposinventory import get_inventory, purge_quarantine
 from jens.environments import refresh_environments
-from jens.git import get_refs
+from jens.environments import read_code_id
+from jens.environments import EnvironmentsPipeline
+from jens.environmentscache import read_environments_cache
+from jens.refsindex import read_refs_index
+from jens.git import get_refs, get_all_refs, gc, clone, rev_parse
+from jens.objectpools import gc_pool
+from jens.journal import JensJournalFactory
+from jens.shards import JensCoordinatorFactory, read_shards_results
+from jens.shards import shard_of
 
 from jens.test.tools import ensure_environment, destroy_environment
 from jens.test.tools import init_repositories
@@ -20,6 +40,11 @@ from jens.test.tools import add_repository, del_repository
 from jens.test.tools import create_fake_repository
 from jens.test.tools import add_branch_to_repo, remove_branch_from_repo
 from jens.test.tools import add_commit_to_branch, reset_branch_to
+from jens.test.tools import create_partial_clone, prune_repository
+from jens.test.tools import get_repository_head
+from jens.test.tools import get_repository_remote
+from jens.test.tools import start_fake_environment_cache
+from jens.test.tools import stop_fake_environment_cache
 
 from jens.test.testcases import JensTestCase
 
@@ -51,9 +76,16 @@ class UpdateTest(JensTestCase):
         add_repository(self.settings, 'hostgroups', hostgroup, bare)
         return user
 
-    def _jens_update(self, errorsExpected=False, errorRegexp=None):
-        repositories_deltas, inventory = refresh_repositories(self.settings, self.lock)
-        refresh_environments(self.settings, self.lock, repositories_deltas, inventory)
+    def _jens_update(self, errorsExpected=False, errorRegexp=None,
+            prefetched=None):
+        pipeline = None
+        if self.settings.PIPELINE:
+            pipeline = EnvironmentsPipeline(self.settings)
+        repositories_deltas, inventory = refresh_repositories(self.settings,
+            self.lock, pipeline.repository_processed if pipeline else None,
+            prefetched)
+        self.changed_environments = refresh_environments(self.settings,
+            self.lock, repositories_deltas, inventory, pipeline)
         if errorsExpected:
             self.assertLogErrors(errorRegexp)
         else:
@@ -93,6 +125,80 @@ class UpdateTest(JensTestCase):
         self.assertEnvironmentLinks("qa")
         self.assertEnvironmentDoesNotHaveAConfigFile("qa")
 
+    def test_shared_layers_with_directory_environments(self):
+        self.settings.DIRECTORY_ENVIRONMENTS = True
+        self.settings.SHARED_LAYERS = True
+        self._create_fake_module('electron', ['qa'])
+        self._create_fake_module('neutron', ['qa'])
+        self._create_fake_hostgroup('aisusie', ['qa'])
+        ensure_environment(self.settings, 'test', 'master',
+            modules=['electron:qa'])
+
+        self._jens_update()
+
+        layer_path = "%s/master" % self.settings.LAYERSDIR
+        self.assertTrue(os.path.islink("%s/modules/electron" % layer_path))
+        self.assertTrue(os.path.islink("%s/hostgroups/hg_aisusie" % layer_path))
+        self.assertTrue(os.path.isdir("%s/qa" % self.settings.LAYERSDIR))
+        self.assertEnvironmentLinks("production")
+        self.assertEnvironmentHasAConfigFile("production")
+        self.assertEnvironmentNumberOf("production", "modules", 0)
+        self.assertEnvironmentNumberOf("production", "hostgroups", 0)
+        self.assertTrue(os.path.islink("%s/production/hieradata/module_names" % \
+            self.settings.ENVIRONMENTSDIR))
+        self.assertTrue(os.path.isdir("%s/production/hieradata/module_names/electron" % \
+            self.settings.ENVIRONMENTSDIR))
+        self.assertEnvironmentLinks("test")
+        self.assertEnvironmentNumberOf("test", "modules", 1)
+        self.assertEnvironmentOverride("test", 'modules/electron', 'qa')
+        # Only what's overridden is linked to its clone
+        data_path = "%s/test/hieradata/module_names" % \
+            self.settings.ENVIRONMENTSDIR
+        self.assertFalse(os.path.islink(data_path))
+        self.assertTrue("/clone/modules/electron/qa/" in
+            os.readlink("%s/electron" % data_path))
+        self.assertTrue("/layers/master/hieradata/module_names/" in
+            os.readlink("%s/neutron" % data_path))
+        self.assertTrue(os.path.islink("%s/test/hieradata/hostgroups" % \
+            self.settings.ENVIRONMENTSDIR))
+        conf = open("%s/test/environment.conf" % \
+            self.settings.ENVIRONMENTSDIR).read()
+        self.assertTrue("modulepath = modules:hostgroups:" \
+            "../../layers/master/modules:../../layers/master/hostgroups" in conf)
+
+        # -- New module, goes to the layers only
+
+        self._create_fake_module('proton', ['qa'])
+
+        self._jens_update()
+
+        self.assertTrue(os.path.islink("%s/modules/proton" % layer_path))
+        self.assertEnvironmentNumberOf("production", "modules", 0)
+        self.assertEnvironmentNumberOf("test", "modules", 1)
+        self.assertTrue("/layers/master/hieradata/module_names/proton" in
+            os.readlink("%s/proton" % data_path))
+        self.assertEnvironmentLinks("test")
+
+        # -- Module deleted, the layers shrink
+
+        del_repository(self.settings, 'modules', 'proton')
+
+        self._jens_update()
+
+        self.assertFalse(os.path.lexists("%s/modules/proton" % layer_path))
+        self.assertFalse(os.path.lexists("%s/test/hieradata/module_names/proton" % \
+            self.settings.ENVIRONMENTSDIR))
+        self.assertEnvironmentLinks("production")
+        self.assertEnvironmentLinks("test")
+
+        # -- Nobody uses the layer anymore
+
+        destroy_environment(self.settings, 'qa')
+
+        self._jens_update()
+
+        self.assertFalse(os.path.isdir("%s/qa" % self.settings.LAYERSDIR))
+
     def test_repositories_add_and_remove_mandatory_expanded_and_cleanup(self):
         self._jens_update()
 
@@ -189,6 +295,172 @@ class UpdateTest(JensTestCase):
         self.assertEnvironmentLinks("qa")
         self.assertEnvironmentLinks("production")
 
+    def test_bootstrap_resumes_from_partial_clone(self):
+        self.settings.GIT_BOOTSTRAPSTEP = 1
+        electron_path = self._create_fake_module('electron', ['qa'])
+        for x in range(0, 3):
+            new_qa = add_commit_to_branch(self.settings, electron_path, 'qa')
+        staging_path = "%s/.staging/modules/electron" % self.settings.BAREDIR
+        bare_path = "%s/modules/electron" % self.settings.BAREDIR
+
+        # -- A previous run only got the tip of the branches
+
+        create_partial_clone(self.settings, staging_path,
+            electron_path.replace('/user/', '/bare/'))
+        self.assertTrue(os.path.isfile("%s/shallow" % staging_path))
+        inode = os.stat(staging_path).st_ino
+
+        self._jens_update()
+
+        self.assertFalse(os.path.exists(staging_path))
+        self.assertEquals(os.stat(bare_path).st_ino, inode)
+        self.assertFalse(os.path.isfile("%s/shallow" % bare_path))
+        self.assertBare('modules/electron')
+        self.assertClone('modules/electron/qa', pointsto=new_qa)
+
+        # -- From scratch
+
+        self._create_fake_module('proton', ['qa'])
+
+        self._jens_update()
+
+        self.assertBare('modules/proton')
+        self.assertClone('modules/proton/qa')
+
+        # -- Partial clones of repositories no longer declared are removed
+
+        create_partial_clone(self.settings,
+            "%s/.staging/modules/neutron" % self.settings.BAREDIR,
+            electron_path.replace('/user/', '/bare/'))
+
+        self._jens_update()
+
+        self.assertFalse(os.path.exists(
+            "%s/.staging/modules/neutron" % self.settings.BAREDIR))
+
+        # -- Partial clones follow the repository if it moves
+
+        positron_path = self._create_fake_module('positron', ['qa'])
+        for x in range(0, 3):
+            new_qa = add_commit_to_branch(self.settings, positron_path, 'qa')
+        old_url = "%s/positron-old" % self.sandbox_path
+        shutil.copytree(positron_path.replace('/user/', '/bare/'), old_url)
+        create_partial_clone(self.settings,
+            "%s/.staging/modules/positron" % self.settings.BAREDIR, old_url)
+        shutil.rmtree(old_url)
+
+        self._jens_update()
+
+        config = open("%s/modules/positron/config" % \
+            self.settings.BAREDIR).read()
+        self.assertTrue("url = file://%s\n" % \
+            positron_path.replace('/user/', '/bare/') in config)
+        self.assertClone('modules/positron/qa', pointsto=new_qa)
+
+        # -- Leftovers in the way of the promotion are reported
+
+        muon_path = self._create_fake_module('muon', ['qa'])
+        staging_path = "%s/.staging/modules/muon" % self.settings.BAREDIR
+        bare_path = "%s/modules/muon" % self.settings.BAREDIR
+        os.mkdir(bare_path)
+        open("%s/leftover" % bare_path, "w").close()
+
+        self._jens_update(errorsExpected=True, errorRegexp="promote.+muon")
+
+        self.assertTrue(os.path.isdir(staging_path))
+        self.assertFalse(os.path.exists(bare_path))
+
+        self._jens_update()
+
+        self.assertFalse(os.path.exists(staging_path))
+        self.assertBare('modules/muon')
+        self.assertClone('modules/muon/qa')
+
+    def test_forks_share_objects_through_the_pool(self):
+        self.settings.GIT_OBJECTPOOLS = True
+        (bare, user) = create_fake_repository(self.settings,
+            self.sandbox_path, ['qa'])
+        add_repository(self.settings, 'modules', 'foo', bare)
+        add_repository(self.settings, 'modules', 'foofork', bare)
+
+        self._jens_update()
+
+        pool_path = "%s/.pools/modules" % self.settings.BAREDIR
+        self.assertBare('modules/foo')
+        self.assertBare('modules/foofork')
+        for name in ('foo', 'foofork'):
+            alternates = open("%s/modules/%s/objects/info/alternates" % \
+                (self.settings.BAREDIR, name)).read().split()
+            self.assertEquals(alternates, ["%s/objects" % pool_path])
+        self.assertEquals(sorted(get_all_refs(pool_path, bare=True)),
+            ['refs/members/foo/heads/master', 'refs/members/foo/heads/qa',
+            'refs/members/foofork/heads/master',
+            'refs/members/foofork/heads/qa'])
+        self.assertClone('modules/foofork/qa')
+
+        # -- Objects needed by members survive garbage collection
+
+        new_qa = add_commit_to_branch(self.settings, user, 'qa')
+
+        self._jens_update()
+
+        for name in ('foo', 'foofork'):
+            self.assertEquals(rev_parse(pool_path,
+                'refs/members/%s/heads/qa' % name, bare=True), new_qa)
+        gc_pool(self.settings, 'modules')
+        for name in ('foo', 'foofork'):
+            gc("%s/modules/%s" % (self.settings.BAREDIR, name), bare=True)
+            self.assertEquals(get_refs("%s/modules/%s" % \
+                (self.settings.BAREDIR, name))['qa'], new_qa)
+        self.assertClone('modules/foo/qa', pointsto=new_qa)
+        self.assertClone('modules/foofork/qa', pointsto=new_qa)
+
+        # -- Members leave the pool when removed
+
+        del_repository(self.settings, 'modules', 'foofork')
+
+        self._jens_update()
+
+        self.assertEquals(sorted(get_all_refs(pool_path, bare=True)),
+            ['refs/members/foo/heads/master', 'refs/members/foo/heads/qa'])
+
+    def test_forks_refreshed_in_the_same_run_take_turns_on_the_pool(self):
+        self.settings.GIT_OBJECTPOOLS = True
+        self.settings.LOCK_TYPE = 'FILE'
+        self.settings.FILELOCK_LOCKDIR = "%s/lock" % self.sandbox_path
+        os.mkdir(self.settings.FILELOCK_LOCKDIR)
+        (bare, user) = create_fake_repository(self.settings,
+            self.sandbox_path, ['qa'])
+        forks = ['foo', 'foofork', 'foofork2']
+        for name in forks:
+            add_repository(self.settings, 'modules', name, bare)
+
+        self._jens_update()
+
+        # Workers are forked, so they see it
+        overlaps_path = "%s/overlaps" % self.sandbox_path
+        syncing_path = "%s/syncing" % self.sandbox_path
+        sync_pool = jens.repos.sync_pool
+        def slow_sync_pool(*args):
+            try:
+                os.mkdir(syncing_path)
+            except OSError:
+                open(overlaps_path, "a").close()
+            time.sleep(0.5)
+            sync_pool(*args)
+            shutil.rmtree(syncing_path, ignore_errors=True)
+        self.addCleanup(setattr, jens.repos, 'sync_pool', sync_pool)
+        jens.repos.sync_pool = slow_sync_pool
+        new_qa = add_commit_to_branch(self.settings, user, 'qa')
+
+        self._jens_update()
+
+        self.assertFalse(os.path.exists(overlaps_path))
+        pool_path = "%s/.pools/modules" % self.settings.BAREDIR
+        for name in forks:
+            self.assertEquals(rev_parse(pool_path,
+                'refs/members/%s/heads/qa' % name, bare=True), new_qa)
+
     def test_clone_is_updated_if_remote_changes(self):
         h1_path = self._create_fake_hostgroup('h1', ['qa', 'boom'])
         m1_path = self._create_fake_module('m1', ['qa', 'boom'])
@@ -216,6 +488,311 @@ class UpdateTest(JensTestCase):
         self.assertClone('hostgroups/h1/boom', pointsto=h1_boom_commit_id)
         self.assertClone('modules/m1/boom', pointsto=m1_boom_commit_id)
 
+    def test_clone_is_updated_despite_stale_locks(self):
+        h1_path = self._create_fake_hostgroup('h1', ['qa'])
+
+        self._jens_update()
+
+        clone_path = "%s/hostgroups/h1/qa" % self.settings.CLONEDIR
+        old_commit_id = get_repository_head(self.settings, clone_path)
+        open("%s/.git/index.lock" % clone_path, 'w').close()
+        h1_commit_id = add_commit_to_branch(self.settings, h1_path, 'qa')
+
+        self._jens_update()
+
+        self.assertFalse(os.path.exists("%s/.git/index.lock" % clone_path))
+        self.assertClone('hostgroups/h1/qa', pointsto=h1_commit_id)
+
+        # -- Clones left behind by a previous run catch up
+
+        reset_branch_to(self.settings, clone_path, 'qa', old_commit_id)
+
+        self._jens_update()
+
+        self.assertClone('hostgroups/h1/qa', pointsto=h1_commit_id)
+
+    def test_interrupted_operations_are_recovered_from_journal(self):
+        self.settings.JOURNAL = True
+        m1_path = self._create_fake_module('electron', ['qa', 'boom'])
+
+        self._jens_update()
+
+        # -- A clone and an environment that were being created
+
+        boom_path = "%s/modules/electron/boom" % self.settings.CLONEDIR
+        os.mkdir(boom_path)
+        open("%s/garbage" % boom_path, 'w').close()
+        journal = JensJournalFactory.makeJournal(self.settings, "repositories")
+        journal.begin('expand', partition='modules', name='electron',
+            ref='boom')
+        ghost_path = "%s/ghost" % self.settings.ENVIRONMENTSDIR
+        os.mkdir(ghost_path)
+        JensJournalFactory.makeJournal(self.settings, "environments").begin(
+            'create', environment='ghost')
+        ensure_environment(self.settings, 'test', None,
+            modules=['electron:boom'])
+
+        self._jens_update()
+
+        self.assertClone('modules/electron/boom')
+        self.assertEnvironmentOverride('test', 'modules/electron', 'boom')
+        self.assertFalse(os.path.exists(ghost_path))
+
+        # -- A clone that was created but not added to the inventory
+
+        add_branch_to_repo(self.settings, m1_path, 'dev')
+
+        self._jens_update()
+
+        clone("%s/modules/electron/dev" % self.settings.CLONEDIR,
+            "%s/modules/electron" % self.settings.BAREDIR, branch='dev')
+        entry = journal.begin('expand', partition='modules', name='electron',
+            ref='dev')
+        journal.commit(entry)
+        ensure_environment(self.settings, 'test2', None,
+            modules=['electron:dev'])
+
+        self._jens_update()
+
+        self.assertClone('modules/electron/dev')
+        self.assertEnvironmentOverride('test2', 'modules/electron', 'dev')
+        self.assertFalse(os.path.exists(journal.path))
+
+        # -- Only journals of dead runs of this host are recovered
+
+        zombie_path = "%s/modules/electron/zombie" % self.settings.CLONEDIR
+        os.mkdir(zombie_path)
+        dead = subprocess.Popen(["true"])
+        dead.wait()
+        self.addCleanup(setattr, jens.journal, 'PID', jens.journal.PID)
+        jens.journal.PID = dead.pid
+        JensJournalFactory.makeJournal(self.settings, "repositories").begin(
+            'expand', partition='modules', name='electron', ref='zombie')
+        self.addCleanup(setattr, jens.journal, 'HOSTNAME',
+            jens.journal.HOSTNAME)
+        jens.journal.HOSTNAME = "elsewhere.example.org"
+        other = JensJournalFactory.makeJournal(self.settings, "repositories")
+        other.begin('purge', partition='modules', name='electron')
+        jens.journal.PID = os.getpid()
+        jens.journal.HOSTNAME = socket.gethostname()
+
+        self._jens_update()
+
+        self.assertFalse(os.path.exists(zombie_path))
+        self.assertClone('modules/electron/qa')
+        self.assertClone('modules/electron/dev')
+        self.assertTrue(os.path.exists(other.path))
+
+    def test_refs_index_knows_which_environments_use_a_ref(self):
+        m1_path = self._create_fake_module('m1', ['qa', 'boom'])
+        ensure_environment(self.settings, 'test', None,
+            modules=['m1:boom'])
+        ensure_environment(self.settings, 'test2', 'qa')
+
+        self._jens_update()
+
+        index = read_refs_index(self.settings)
+        self.assertEquals(index.users_of(self.settings,
+            'modules', 'm1', 'boom'), set(['test']))
+        self.assertEquals(index.users_of(self.settings,
+            'modules', 'm1', 'qa'), set(['qa', 'test2']))
+        self.assertEquals(index.refs_of('test'),
+            {'default': None, 'overrides': {'modules': {'m1': 'boom'}}})
+
+        # -- The definition changes
+
+        ensure_environment(self.settings, 'test', None,
+            modules=['m1:qa'])
+
+        self._jens_update()
+
+        index = read_refs_index(self.settings)
+        self.assertEquals(index.users_of(self.settings,
+            'modules', 'm1', 'boom'), set())
+        self.assertEquals(index.users_of(self.settings,
+            'modules', 'm1', 'qa'), set(['qa', 'test', 'test2']))
+
+        # -- Only the users of a ref that moves are refreshed
+
+        add_commit_to_branch(self.settings, m1_path, 'qa')
+
+        self._jens_update()
+
+        self.assertEquals(self.changed_environments,
+            set(['qa', 'test', 'test2']))
+
+    def test_environments_are_generated_while_repositories_refresh(self):
+        self.settings.PIPELINE = True
+        self._create_fake_module('m1', ['qa', 'boom'])
+        self._create_fake_hostgroup('h1', ['qa'])
+        ensure_environment(self.settings, 'test', None,
+            modules=['m1:boom'])
+
+        self._jens_update()
+
+        self.assertEnvironmentOverride('test', 'modules/m1', 'boom')
+        self.assertEnvironmentOverrideDoesntExist('test', 'hostgroups/hg_h1')
+        self.assertEnvironmentLinks('qa')
+
+        # -- Changed and deleted environments
+
+        ensure_environment(self.settings, 'test', None,
+            modules=['m1:qa'], hostgroups=['h1:qa'])
+        destroy_environment(self.settings, 'qa')
+
+        self._jens_update()
+
+        self.assertEnvironmentOverride('test', 'modules/m1', 'qa')
+        self.assertEnvironmentOverride('test', 'hostgroups/hg_h1', 'qa')
+        self.assertEnvironmentDoesntExist('qa')
+        self.assertEquals(sorted(read_environments_cache(self.settings).keys()),
+            ['production', 'test'])
+        self.assertEquals(self.changed_environments, set(['qa', 'test']))
+
+    def test_bare_follows_the_new_url_of_a_repository(self):
+        self._create_fake_module('foo', ['qa'])
+
+        self._jens_update()
+
+        # -- Same module, somewhere else
+
+        (bare, user) = create_fake_repository(self.settings,
+            self.sandbox_path, ['qa'])
+        qa_commit_id = add_commit_to_branch(self.settings, user, 'qa')
+        add_repository(self.settings, 'modules', 'foo', bare)
+
+        self._jens_update()
+
+        config = open("%s/modules/foo/config" % self.settings.BAREDIR).read()
+        self.assertTrue("url = file://%s\n" % bare in config)
+        self.assertClone('modules/foo/qa', pointsto=qa_commit_id)
+        self.assertEnvironmentOverride('qa', 'modules/foo', 'qa')
+
+        # -- Somewhere else again, but the remote can't be updated
+
+        (bare, user) = create_fake_repository(self.settings,
+            self.sandbox_path, ['qa'])
+        add_repository(self.settings, 'modules', 'foo', bare)
+        config_path = "%s/modules/foo/config" % self.settings.BAREDIR
+        open("%s.lock" % config_path, 'w').close()
+
+        self._jens_update(errorsExpected=True,
+            errorRegexp="Unable to update remote of 'foo'")
+
+        self.assertFalse("url = file://%s\n" % bare in open(config_path).read())
+
+        # -- Retried even if the definition didn't change since
+
+        os.remove("%s.lock" % config_path)
+
+        self._jens_update()
+
+        self.assertTrue("url = file://%s\n" % bare in open(config_path).read())
+
+    def test_busy_repositories_are_skipped_until_released(self):
+        self.settings.LOCK_TYPE = 'FILE'
+        self.settings.FILELOCK_LOCKDIR = "%s/lock" % self.sandbox_path
+        os.mkdir(self.settings.FILELOCK_LOCKDIR)
+        foo_path = self._create_fake_module('foo', ['qa'])
+        bar_path = self._create_fake_module('bar', ['qa'])
+
+        self._jens_update()
+
+        foo_commit_id = add_commit_to_branch(self.settings, foo_path, 'qa')
+        bar_commit_id = add_commit_to_branch(self.settings, bar_path, 'qa')
+        old_foo_commit_id = get_repository_head(self.settings,
+            "%s/modules/foo/qa" % self.settings.CLONEDIR)
+
+        # -- Something (jens-gc) is working on foo
+
+        with JensLockFactory.makeRepositoryLock(self.settings,
+                'modules', 'foo'):
+            self._jens_update()
+
+        self.assertClone('modules/foo/qa', pointsto=old_foo_commit_id)
+        self.assertClone('modules/bar/qa', pointsto=bar_commit_id)
+
+        self._jens_update()
+
+        self.assertClone('modules/foo/qa', pointsto=foo_commit_id)
+
+    def test_inventory_is_kept_if_a_partition_is_busy(self):
+        self.settings.LOCK_TYPE = 'FILE'
+        self.settings.FILELOCK_LOCKDIR = "%s/lock" % self.sandbox_path
+        os.mkdir(self.settings.FILELOCK_LOCKDIR)
+        self.addCleanup(setattr, jens.repos, 'PARTITION_LOCK_TRIES',
+            jens.repos.PARTITION_LOCK_TRIES)
+        jens.repos.PARTITION_LOCK_TRIES = 1
+        self._create_fake_module('foo', ['qa'])
+        self._create_fake_hostgroup('murdock', ['qa'])
+
+        # -- Something (jens-gc) is working on the hostgroups
+
+        with JensLockFactory.makePartitionLock(self.settings, 'hostgroups'):
+            self.assertRaises(JensLockExistsError, refresh_repositories,
+                self.settings, self.lock)
+
+        inventory = get_inventory(self.settings, generate=False)
+        self.assertTrue('foo' in inventory['modules'])
+        self.assertFalse('murdock' in inventory['hostgroups'])
+
+        self._jens_update()
+
+        self.assertClone('modules/foo/qa')
+        self.assertClone('hostgroups/murdock/qa')
+
+    def test_shards_are_reused_when_finalizing(self):
+        self.settings.SHARDS_TYPE = 'LOCAL'
+        self.settings.SHARDS_COUNT = 2
+        self.settings.SHARDS_LOCALDIR = "%s/shards" % self.sandbox_path
+        foo_path = self._create_fake_module('foo', ['qa'])
+        self._create_fake_hostgroup('murdock', ['qa'])
+
+        self._jens_update()
+
+        foo_commit_id = add_commit_to_branch(self.settings, foo_path, 'qa')
+        coordinator = JensCoordinatorFactory.makeCoordinator(self.settings)
+        generation = refresh_shards(self.settings, self.lock, coordinator)
+
+        # Done by whoever refreshed the shard
+        self.assertClone('modules/foo/qa', pointsto=foo_commit_id)
+        self.assertTrue(coordinator.is_finished(generation))
+
+        # -- Not fetched again by the finalizer
+
+        add_commit_to_branch(self.settings, foo_path, 'qa')
+        self.assertTrue(coordinator.claim_finalizer(generation))
+        prefetched = read_shards_results(self.settings, generation)
+        self.assertTrue('foo' in prefetched['modules'])
+        self.assertTrue('murdock' in prefetched['hostgroups'])
+        self.assertTrue('site' in prefetched['common'])
+
+        self._jens_update(prefetched=prefetched)
+        coordinator.finish_generation(generation)
+
+        self.assertClone('modules/foo/qa', pointsto=foo_commit_id)
+        self.assertEquals(coordinator.get_generation(), generation + 1)
+
+        # -- The results of a shard are lost, what it updated isn't
+
+        foo_commit_id = add_commit_to_branch(self.settings, foo_path, 'qa')
+        generation = refresh_shards(self.settings, self.lock, coordinator)
+        self.assertClone('modules/foo/qa', pointsto=foo_commit_id)
+        shard = shard_of(self.settings, 'modules', 'foo')
+        os.remove("%s/%d" % (jens.shards._get_results_path(self.settings,
+            generation), shard))
+        self.assertTrue(coordinator.claim_finalizer(generation))
+        prefetched = read_shards_results(self.settings, generation)
+        self.assertEquals(prefetched['unread'], [shard])
+        self.assertFalse('foo' in prefetched['modules'])
+
+        self._jens_update(prefetched=prefetched, errorsExpected=True,
+            errorRegexp="results of shard %d" % shard)
+        coordinator.finish_generation(generation)
+
+        self.assertClone('modules/foo/qa', pointsto=foo_commit_id)
+        self.assertTrue('qa' in self.changed_environments)
+
     def test_all_is_added_to_new_environments(self):
         self._create_fake_module('electron', ['qa'])
         self._create_fake_hostgroup('aisusie', ['qa'])
@@ -237,8 +814,289 @@ class UpdateTest(JensTestCase):
         self.assertEnvironmentOverride('test', 'modules/electron', 'qa')
         self.assertEnvironmentOverride('test', 'hostgroups/hg_aisusie', 'qa')
 
+    def test_many_environments_are_created_and_refreshed(self):
+        self._create_fake_module('electron', ['qa'])
+        for index in range(0, 12):
+            ensure_environment(self.settings, 'test%d' % index, 'qa')
+
+        self._jens_update()
+
+        for index in range(0, 12):
+            self.assertEnvironmentLinks("test%d" % index)
+            self.assertEnvironmentOverride("test%d" % index,
+                'modules/electron', 'qa')
+
+        # -- New module, all of them get it
+
+        self._create_fake_module('proton', ['qa'])
+
+        self._jens_update()
+
+        for index in range(0, 12):
+            self.assertEnvironmentLinks("test%d" % index)
+            self.assertEnvironmentOverride("test%d" % index,
+                'modules/proton', 'qa')
+
+    def test_only_changed_environments_are_notified(self):
+        server = start_fake_environment_cache(self.settings)
+        try:
+            m1_path = self._create_fake_module('m1', ['qa', 'boom'])
+            h1_path = self._create_fake_hostgroup('h1', ['qa'])
+            ensure_environment(self.settings, 'test', None,
+                modules=['m1:boom'])
+
+            self._jens_update()
+
+            self.assertEquals(sorted(server.flushed),
+                ['production', 'qa', 'test'])
+
+            # -- Nothing changes
+
+            del server.flushed[:]
+            self._jens_update()
+
+            self.assertEquals(self.changed_environments, set())
+            self.assertEquals(server.flushed, [])
+
+            # -- A ref only used by some of them moves
+
+            add_commit_to_branch(self.settings, m1_path, 'qa')
+            self._jens_update()
+
+            self.assertEquals(server.flushed, ['qa'])
+
+            del server.flushed[:]
+            add_commit_to_branch(self.settings, m1_path, 'boom')
+            self._jens_update()
+
+            self.assertEquals(server.flushed, ['test'])
+
+            # -- New hostgroup, only envs with default get it
+
+            del server.flushed[:]
+            self._create_fake_hostgroup('h2', ['qa'])
+            self._jens_update()
+
+            self.assertEquals(sorted(server.flushed), ['production', 'qa'])
+
+            # -- Recreated and deleted environments
+
+            del server.flushed[:]
+            ensure_environment(self.settings, 'test', None,
+                modules=['m1:qa'])
+            destroy_environment(self.settings, 'qa')
+            self._jens_update()
+
+            self.assertEquals(sorted(server.flushed), ['qa', 'test'])
+        finally:
+            stop_fake_environment_cache(server)
+
+    def test_environments_are_refreshed_even_if_notifications_fail(self):
+        server = start_fake_environment_cache(self.settings)
+        stop_fake_environment_cache(server)
+
+        self._jens_update(errorsExpected=True,
+            errorRegexp="notify changed environments")
+
+        self.assertEnvironmentLinks("production")
+        self.assertEnvironmentLinks("qa")
+
+    def test_code_ids_change_only_if_code_changes(self):
+        self.settings.CODE_IDS = True
+        m1_path = self._create_fake_module('m1', ['qa'])
+        ensure_environment(self.settings, 'test', 'master',
+            modules=['m1:qa'])
+
+        self._jens_update()
+
+        production = read_code_id(self.settings, 'production')
+        qa = read_code_id(self.settings, 'qa')
+        test = read_code_id(self.settings, 'test')
+        self.assertEquals(len(production), 40)
+        self.assertNotEquals(production, qa)
+        self.assertNotEquals(production, test)
+
+        self._jens_update()
+
+        self.assertEquals(read_code_id(self.settings, 'production'), production)
+        self.assertEquals(read_code_id(self.settings, 'qa'), qa)
+        self.assertEquals(read_code_id(self.settings, 'test'), test)
+
+        add_commit_to_branch(self.settings, m1_path, 'qa')
+
+        self._jens_update()
+
+        self.assertEquals(read_code_id(self.settings, 'production'), production)
+        self.assertNotEquals(read_code_id(self.settings, 'qa'), qa)
+        self.assertNotEquals(read_code_id(self.settings, 'test'), test)
+        self.assertFalse(os.path.exists("%s/test/.code_id.tmp" % \
+            self.settings.ENVIRONMENTSDIR))
+
+        # -- Same content, same code ID
+
+        ensure_environment(self.settings, 'production2', 'master')
+
+        self._jens_update()
+
+        self.assertEquals(read_code_id(self.settings, 'production2'), production)
+
+    def test_environments_cache_is_migrated_from_legacy_layout(self):
+        self._create_fake_module('electron', ['qa'])
+        ensure_environment(self.settings, 'test', 'master',
+            modules=['electron:qa'])
+
+        self._jens_update()
+
+        cache = read_environments_cache(self.settings)
+        self.assertEquals(sorted(cache.keys()), ['production', 'qa', 'test'])
+        self.assertEquals(cache['test']['refs']['default'], 'master')
+        self.assertEquals(cache['test']['refs']['overrides'],
+            {'modules': {'electron': 'qa'}})
+
+        # -- Go back to one file per environment
+
+        legacy_path = "%s/environments" % self.settings.CACHEDIR
+        os.mkdir(legacy_path)
+        for environment, entry in cache.iteritems():
+            with open("%s/%s" % (legacy_path, environment), 'w') as legacy:
+                legacy.write(entry['hash'])
+        os.remove("%s/environments.cache" % self.settings.CACHEDIR)
+        self.assertEquals(sorted(read_environments_cache(self.settings).keys()),
+            ['production', 'qa', 'test'])
+
+        self._jens_update()
+
+        self.assertEquals(self.changed_environments, set())
+        self.assertFalse(os.path.exists(legacy_path))
+        cache = read_environments_cache(self.settings)
+        self.assertEquals(sorted(cache.keys()), ['production', 'qa', 'test'])
+        self.assertEnvironmentOverride('test', 'modules/electron', 'qa')
+
+        # -- Refs are filled in when the environment is rebuilt
+
+        self.assertEquals(cache['test']['refs'], None)
+        ensure_environment(self.settings, 'test', 'master',
+            modules=['electron:master'])
+
+        self._jens_update()
+
+        cache = read_environments_cache(self.settings)
+        self.assertEquals(cache['test']['refs']['overrides'],
+            {'modules': {'electron': 'master'}})
+
+    def test_narrowed_bares_only_have_needed_branches(self):
+        self._create_fake_module('foo', ['qa', 'bar', 'baz'])
+        ensure_environment(self.settings, 'test', 'master',
+            modules=['foo:bar'])
+
+        self._jens_update()
+
+        bare_path = "%s/modules/foo" % self.settings.BAREDIR
+        self.assertEquals(sorted(get_refs(bare_path).keys()),
+            ['bar', 'baz', 'master', 'qa'])
+
+        # -- Existing mirrors are narrowed
+
+        self.settings.GIT_NARROWREFSPECS = True
+
+        self._jens_update()
+
+        self.assertEquals(sorted(get_refs(bare_path).keys()),
+            ['bar', 'master', 'qa'])
+        self.assertClone('modules/foo/bar')
+        self.assertEnvironmentOverride("test", 'modules/foo', 'bar')
+
+        # -- New overrides are expanded in the same run
+
+        ensure_environment(self.settings, 'test', 'master',
+            modules=['foo:baz'])
+        self._create_fake_module('bar', ['qa', 'boom', 'bang'])
+        ensure_environment(self.settings, 'test2', 'master',
+            modules=['bar:boom', 'foo:nonexistent'])
+
+        self._jens_update()
+
+        self.assertEquals(sorted(get_refs(bare_path).keys()),
+            ['baz', 'master', 'qa'])
+        self.assertEquals(sorted(get_refs(
+            "%s/modules/bar" % self.settings.BAREDIR).keys()),
+            ['boom', 'master', 'qa'])
+        self.assertClone('modules/foo/baz')
+        self.assertNotClone('modules/foo/bar')
+        self.assertClone('modules/bar/boom')
+        self.assertEnvironmentLinks("test")
+        self.assertEnvironmentOverride("test", 'modules/foo', 'baz')
+        self.assertEnvironmentOverride("test2", 'modules/bar', 'boom')
+
+    def test_narrowed_bares_keep_pinned_commits(self):
+        self.settings.GIT_NARROWREFSPECS = True
+        foo_path = self._create_fake_module('foo', ['qa', 'bar', 'baz'])
+        bar_commit_id = add_commit_to_branch(self.settings, foo_path, 'bar')
+        ensure_environment(self.settings, 'test', 'master',
+            modules=['foo:bar'])
+        ensure_environment(self.settings, 'test2', 'master',
+            modules=['foo:%s%s' % (COMMIT_PREFIX, bar_commit_id)])
+
+        self._jens_update()
+
+        clone_path = "%s/modules/foo/.%s" % (self.settings.CLONEDIR,
+            bar_commit_id)
+        self.assertClone('modules/foo/.%s' % bar_commit_id,
+            pointsto=bar_commit_id)
+
+        # -- The branch isn't fetched anymore, the commit is kept
+
+        destroy_environment(self.settings, 'test')
+
+        self._jens_update()
+
+        bare_path = "%s/modules/foo" % self.settings.BAREDIR
+        self.assertEquals(sorted(get_refs(bare_path).keys()),
+            ['master', 'qa'])
+        prune_repository(self.settings, bare_path)
+        self.assertEquals(rev_parse(clone_path, bar_commit_id), bar_commit_id)
+        self.assertClone('modules/foo/.%s' % bar_commit_id,
+            pointsto=bar_commit_id)
+
+        # -- Commits in branches that aren't fetched are fetched
+
+        baz_commit_id = add_commit_to_branch(self.settings, foo_path, 'baz')
+        ensure_environment(self.settings, 'test3', 'master',
+            modules=['foo:%s%s' % (COMMIT_PREFIX, baz_commit_id)])
+
+        self._jens_update()
+
+        self.assertClone('modules/foo/.%s' % baz_commit_id,
+            pointsto=baz_commit_id)
+        self.assertEnvironmentOverride('test3', 'modules/foo',
+            COMMIT_PREFIX + baz_commit_id)
+
+        # -- The remote isn't listed again if nothing changed
+
+        listed = []
+        self.addCleanup(setattr, jens.git, 'ls_remote', jens.git.ls_remote)
+        ls_remote = jens.git.ls_remote
+        jens.git.ls_remote = lambda *args, **kwargs: \
+            listed.append(args) or ls_remote(*args, **kwargs)
+
+        self._jens_update()
+
+        self.assertEquals(listed, [])
+
+        # -- Pins of overrides that are gone are dropped
+
+        destroy_environment(self.settings, 'test2')
+
+        self._jens_update()
+
+        self.assertEquals(listed, [])
+        self.assertEquals(sorted([refname for refname
+            in get_all_refs(bare_path, bare=True)
+            if refname.startswith("refs/pins/")]),
+            ["refs/pins/%s" % baz_commit_id])
+
     def test_bare_not_created_if_missing_mandatory_branches(self):
-        self._create_fake_module('electron')
+        electron_path = self._create_fake_module('electron')
 
         self._jens_update(errorsExpected=True,
             errorRegexp="electron.+mandatory branches")
@@ -246,6 +1104,36 @@ class UpdateTest(JensTestCase):
         self.assertNotBare('modules/electron')
         self.assertNotClone('modules/electron/master')
 
+        # -- Nothing has changed, not reported as an error again
+
+        self._jens_update()
+
+        self.assertNotBare('modules/electron')
+
+        # -- Forgotten once it's not declared anymore
+
+        with open(self.settings.REPO_METADATA, 'r') as metadata:
+            electron_url = yaml.load(metadata)['repositories']['modules']['electron']
+        del_repository(self.settings, 'modules', 'electron')
+
+        self._jens_update()
+
+        add_repository(self.settings, 'modules', 'electron',
+            electron_url.replace('file://', ''))
+
+        self._jens_update(errorsExpected=True,
+            errorRegexp="electron.+mandatory branches")
+
+        # -- Refs have changed, so it's checked again
+
+        add_branch_to_repo(self.settings, electron_path, 'qa')
+
+        self._jens_update()
+
+        self.assertBare('modules/electron')
+        self.assertClone('modules/electron/master')
+        self.assertClone('modules/electron/qa')
+
     def test_branch_not_expanded_if_not_needed(self):
         self._create_fake_hostgroup('murdock', ['qa', 'aijens_etcd'])
 
@@ -275,6 +1163,64 @@ class UpdateTest(JensTestCase):
         self.assertEnvironmentOverride("test", 'hostgroups/hg_murdock', 'aijens_etcd')
         self.assertEnvironmentOverride("test", 'modules/foo', 'bar')
 
+    def test_override_to_branch_with_reflinks(self):
+        self.settings.GIT_REFLINKS = True
+        foo_path = self._create_fake_module('foo', ['qa', 'bar'])
+        new_bar = add_commit_to_branch(self.settings, foo_path, 'bar')
+
+        self._jens_update()
+
+        ensure_environment(self.settings, 'test', 'master',
+            modules=['foo:bar'])
+
+        # Falls back to cloning if reflinks are not supported
+        self._jens_update()
+
+        self.assertClone('modules/foo/bar', pointsto=new_bar)
+        self.assertClone('modules/foo/qa')
+        self.assertEnvironmentLinks("test")
+        self.assertEnvironmentOverride("test", 'modules/foo', 'bar')
+
+        new_bar = add_commit_to_branch(self.settings, foo_path, 'bar')
+
+        self._jens_update()
+
+        self.assertClone('modules/foo/bar', pointsto=new_bar)
+
+    def test_override_to_branch_reflinked_from_existing_checkout(self):
+        self.settings.GIT_REFLINKS = True
+        # Plain copies stand in for reflinks, not supported everywhere
+        copied = []
+        def fake_reflink(source, destination):
+            copied.append(destination)
+            shutil.copy2(source, destination)
+        self.addCleanup(setattr, jens.reflinks, 'reflink',
+            jens.reflinks.reflink)
+        jens.reflinks.reflink = fake_reflink
+        foo_path = self._create_fake_module('foo', ['qa', 'bar'])
+        new_bar = add_commit_to_branch(self.settings, foo_path, 'bar')
+
+        self._jens_update()
+
+        ensure_environment(self.settings, 'test', 'master',
+            modules=['foo:bar'])
+
+        self._jens_update()
+
+        clone_path = "%s/modules/foo/bar" % self.settings.CLONEDIR
+        self.assertTrue(copied)
+        self.assertClone('modules/foo/bar', pointsto=new_bar)
+        self.assertEquals(get_repository_remote(self.settings, clone_path),
+            "%s/modules/foo" % self.settings.BAREDIR)
+        self.assertEnvironmentLinks("test")
+        self.assertEnvironmentOverride("test", 'modules/foo', 'bar')
+
+        new_bar = add_commit_to_branch(self.settings, foo_path, 'bar')
+
+        self._jens_update()
+
+        self.assertClone('modules/foo/bar', pointsto=new_bar)
+
     def test_override_to_branch_malformed_override_wrong_partition_name(self):
         environment = {'notifications': 'higgs@example.org',
             'default': 'master', 'overrides': {}}
@@ -353,9 +1299,6 @@ class UpdateTest(JensTestCase):
         yaml.dump(environment, environment_file, default_flow_style=False)
         environment_file.close()
 
-        self._create_fake_hostgroup('murdock', ['qa'])
-        self._create_fake_module('foo', ['qa'])
-
         self._jens_update(errorsExpected=True,
             errorRegexp="test")
 
@@ -426,6 +1369,158 @@ class UpdateTest(JensTestCase):
         self.assertClone('hostgroups/murdock/.%s' % commit_id, pointsto=commit_id)
         self.assertEnvironmentOverride("test", 'hostgroups/hg_murdock', override)
 
+    def test_overrides_to_the_same_commit_share_the_clone(self):
+        murdock_path = self._create_fake_hostgroup('murdock', ['qa'])
+        commit_id = get_refs(murdock_path + '/.git')['qa']
+        short = "{0}{1}".format(COMMIT_PREFIX, commit_id[0:7])
+        longer = "{0}{1}".format(COMMIT_PREFIX, commit_id[0:12])
+        ensure_environment(self.settings, 'test', 'master',
+            hostgroups=["murdock:%s" % short])
+        ensure_environment(self.settings, 'test2', 'master',
+            hostgroups=["murdock:%s" % longer])
+
+        self._jens_update()
+
+        clones_path = "%s/hostgroups/murdock" % self.settings.CLONEDIR
+        canonical_path = "%s/.%s" % (clones_path, commit_id)
+        self.assertTrue(os.path.isdir(canonical_path))
+        self.assertFalse(os.path.islink(canonical_path))
+        for abbreviation in (commit_id[0:7], commit_id[0:12]):
+            self.assertEquals(os.readlink("%s/.%s" % (clones_path, abbreviation)),
+                ".%s" % commit_id)
+            self.assertClone('hostgroups/murdock/.%s' % abbreviation,
+                pointsto=commit_id)
+        self.assertEnvironmentLinks("test")
+        self.assertEnvironmentLinks("test2")
+        self.assertEnvironmentOverride("test", 'hostgroups/hg_murdock', short)
+        self.assertEnvironmentOverride("test2", 'hostgroups/hg_murdock', longer)
+
+        # -- The clone stays while there's somebody pinning it
+
+        destroy_environment(self.settings, 'test')
+
+        self._jens_update()
+
+        self.assertFalse(os.path.lexists("%s/.%s" % (clones_path, commit_id[0:7])))
+        self.assertTrue(os.path.isdir(canonical_path))
+        self.assertEnvironmentLinks("test2")
+
+        destroy_environment(self.settings, 'test2')
+
+        self._jens_update()
+
+        self.assertFalse(os.path.lexists("%s/.%s" % (clones_path, commit_id[0:12])))
+        self.assertFalse(os.path.exists(canonical_path))
+
+    def test_commit_cache_is_shared_and_evicts_unused_commits(self):
+        self.settings.COMMITCACHE_ENABLED = True
+        self.settings.COMMITCACHE_BUDGET = 0
+        murdock_path = self._create_fake_hostgroup('murdock', ['qa'])
+        commit_id = get_refs(murdock_path + '/.git')['qa']
+        short = "{0}{1}".format(COMMIT_PREFIX, commit_id[0:7])
+        ensure_environment(self.settings, 'test', 'master',
+            hostgroups=["murdock:%s" % short])
+        ensure_environment(self.settings, 'test2', 'master',
+            hostgroups=["murdock:{0}{1}".format(COMMIT_PREFIX, commit_id)])
+
+        self._jens_update()
+
+        entry_path = "%s/%s" % (self.settings.COMMITCACHE_DIR, commit_id)
+        clones_path = "%s/hostgroups/murdock" % self.settings.CLONEDIR
+        self.assertTrue(os.path.isdir("%s/code" % entry_path))
+        self.assertFalse(os.stat(entry_path).st_mode & stat.S_IWUSR)
+        self.assertEquals([name for name in
+            os.listdir(self.settings.COMMITCACHE_DIR)
+            if name.startswith(".%s" % commit_id)], [])
+        for abbreviation in (commit_id[0:7], commit_id):
+            self.assertEquals(os.readlink("%s/.%s" % (clones_path, abbreviation)),
+                entry_path)
+        self.assertEnvironmentLinks("test")
+        self.assertEnvironmentLinks("test2")
+        self.assertEnvironmentOverride("test", 'hostgroups/hg_murdock', short)
+
+        # -- Still referenced, so it's kept even if over budget
+
+        destroy_environment(self.settings, 'test')
+
+        self._jens_update()
+
+        self.assertFalse(os.path.lexists("%s/.%s" % (clones_path, commit_id[0:7])))
+        self.assertTrue(os.path.isdir(entry_path))
+        self.assertEnvironmentLinks("test2")
+
+        # -- Not referenced anymore, kept while there's room for it
+
+        self.settings.COMMITCACHE_BUDGET = 1024
+        destroy_environment(self.settings, 'test2')
+
+        self._jens_update()
+
+        self.assertTrue(os.path.isdir(entry_path))
+        inode = os.stat(entry_path).st_ino
+        ensure_environment(self.settings, 'test', 'master',
+            hostgroups=["murdock:%s" % short])
+
+        self._jens_update()
+
+        self.assertEquals(os.stat(entry_path).st_ino, inode)
+        self.assertEnvironmentLinks("test")
+
+        # -- Evicted when over budget
+
+        self.settings.COMMITCACHE_BUDGET = 0
+        destroy_environment(self.settings, 'test')
+
+        self._jens_update()
+
+        self.assertFalse(os.path.exists(entry_path))
+
+    def test_shallow_bare_is_deepened_for_old_commits(self):
+        self.settings.GIT_DEPTH = 1
+        murdock_path = self._create_fake_hostgroup('murdock', ['qa'])
+        old_commit_id = get_refs(murdock_path + '/.git')['qa']
+        for x in range(0, 5):
+            new_qa = add_commit_to_branch(self.settings, murdock_path, 'qa')
+
+        self._jens_update()
+
+        bare_path = "%s/hostgroups/murdock" % self.settings.BAREDIR
+        self.assertTrue(os.path.isfile("%s/shallow" % bare_path))
+        self.assertClone('hostgroups/murdock/qa', pointsto=new_qa)
+        self.assertClone('hostgroups/murdock/master')
+
+        override = "{0}{1}".format(COMMIT_PREFIX, old_commit_id)
+        ensure_environment(self.settings, 'test', 'master',
+            hostgroups=["murdock:%s" % override])
+
+        self._jens_update()
+
+        self.assertClone('hostgroups/murdock/.%s' % old_commit_id,
+            pointsto=old_commit_id)
+        self.assertEnvironmentLinks("test")
+        self.assertEnvironmentOverride("test", 'hostgroups/hg_murdock', override)
+
+        new_qa = add_commit_to_branch(self.settings, murdock_path, 'qa')
+
+        self._jens_update()
+
+        self.assertClone('hostgroups/murdock/qa', pointsto=new_qa)
+
+        # -- Commits that don't exist don't unshallow the bare
+
+        hannibal_path = self._create_fake_hostgroup('hannibal', ['qa'])
+        for x in range(0, 20):
+            add_commit_to_branch(self.settings, hannibal_path, 'qa')
+        override = "{0}{1}".format(COMMIT_PREFIX, "f" * 40)
+        ensure_environment(self.settings, 'test2', 'master',
+            hostgroups=["hannibal:%s" % override])
+
+        self._jens_update(errorsExpected=True, errorRegexp="f{40}")
+
+        bare_path = "%s/hostgroups/hannibal" % self.settings.BAREDIR
+        self.assertTrue(os.path.isfile("%s/shallow" % bare_path))
+        self.assertNotClone('hostgroups/hannibal/.%s' % ("f" * 40))
+
     def test_override_to_branch_and_commit_combined(self):
         self._jens_update()
 
@@ -885,6 +1980,82 @@ class UpdateTest(JensTestCase):
 
         self.assertClone('modules/foo/qa')
 
+    def test_inconsistent_entries_are_quarantined_when_regenerating_inventory(self):
+        foo_path = self._create_fake_module('foo', ['qa', 'boom'])
+        new_qa = add_commit_to_branch(self.settings, foo_path, 'qa')
+        self._create_fake_module('bar', ['qa'])
+        ensure_environment(self.settings, 'test', None,
+            modules=['foo:boom'])
+
+        self._jens_update()
+
+        with open("%s/modules/foo/boom/.git/HEAD" % self.settings.CLONEDIR,
+                'w') as head_file:
+            head_file.write("garbage\n")
+        # Readable but not where the bare says the branch is
+        qa_path = "%s/modules/foo/qa" % self.settings.CLONEDIR
+        master = get_repository_head(self.settings,
+            "%s/modules/foo/master" % self.settings.CLONEDIR)
+        with open("%s/.git/HEAD" % qa_path, 'w') as head_file:
+            head_file.write("%s\n" % master)
+        shutil.rmtree("%s/modules/bar" % self.settings.CLONEDIR)
+        os.remove("%s/repositories" % self.settings.CACHEDIR)
+
+        self._jens_update()
+
+        self.assertClone('modules/foo/qa', pointsto=new_qa)
+        self.assertClone('modules/foo/boom')
+        self.assertBare('modules/bar')
+        self.assertClone('modules/bar/qa')
+        self.assertEnvironmentOverride('test', 'modules/foo', 'boom')
+        self.assertEquals(len(os.listdir("%s/.quarantine/modules/foo" % \
+            self.settings.CLONEDIR)), 2)
+        self.assertEquals(len(os.listdir("%s/.quarantine/modules" % \
+            self.settings.BAREDIR)), 1)
+
+        # -- Entries that can't be moved aside are skipped
+
+        self.assertEquals(purge_quarantine(self.settings, 3600), 0)
+        self.assertEquals(purge_quarantine(self.settings, 0), 3)
+        self.assertEquals(os.listdir("%s/.quarantine/modules" % \
+            self.settings.CLONEDIR), [])
+        self.assertEquals(os.listdir("%s/.quarantine/modules" % \
+            self.settings.BAREDIR), [])
+        open("%s/.quarantine/modules/foo" % self.settings.CLONEDIR,
+            'w').close()
+        with open("%s/modules/foo/boom/.git/HEAD" % self.settings.CLONEDIR,
+                'w') as head_file:
+            head_file.write("garbage\n")
+        os.remove("%s/repositories" % self.settings.CACHEDIR)
+
+        self._jens_update(errorsExpected=True,
+            errorRegexp="quarantine.+foo/boom")
+
+        self.assertClone('modules/foo/qa', pointsto=new_qa)
+        self.assertClone('modules/bar/qa')
+
+    def test_inventory_is_only_persisted_if_it_changes(self):
+        self._create_fake_module('foo', ['qa', 'boom'])
+
+        self._jens_update()
+
+        inventory_path = "%s/repositories" % self.settings.CACHEDIR
+        os.utime(inventory_path, (0, 0))
+
+        self._jens_update()
+
+        self.assertEquals(os.stat(inventory_path).st_mtime, 0)
+
+        # -- A new clone is needed
+
+        ensure_environment(self.settings, 'test', None,
+            modules=['foo:boom'])
+
+        self._jens_update()
+
+        self.assertNotEquals(os.stat(inventory_path).st_mtime, 0)
+        self.assertClone('modules/foo/boom')
+
     def test_clone_is_updated_if_remotes_history_is_mangled(self):
         h1_path = self._create_fake_hostgroup('h1', ['qa', 'boom'])
 
@@ -0,0 +1,45 @@
+# Copyright (C) 2014, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+import os
+import errno
+import logging
+
+from jens.errors import JensError, JensLockError
+
+# When coalescing is enabled, an instance that can't get the lock leaves
+# a marker (CACHEDIR/pending) instead of just giving up. Whoever holds
+# the lock consumes it as soon as it gets it and, once the lock has been
+# released, checks whether it's there again to do another run. The check
+# happens after releasing so a request made while the lock was still
+# held is never missed: either it's seen there or its author gets the
+# lock itself. Any number of requests made during a run result in a
+# single follow-up run.
+
+def request_run(settings):
+    logging.info("Requesting a follow-up run...")
+    try:
+        open(_get_marker_path(settings), "a").close()
+    except IOError, error:
+        raise JensError("Unable to request a run (%s)" % error)
+
+def consume_run_request(settings):
+    try:
+        os.remove(_get_marker_path(settings))
+        logging.info("Serving a run requested meanwhile")
+        return True
+    except OSError, error:
+        if error.errno == errno.ENOENT:
+            return False
+        # Otherwise it'd be served over and over again
+        raise JensLockError("Unable to consume run request (%s)" % error)
+
+def is_run_requested(settings):
+    return os.path.exists(_get_marker_path(settings))
+
+def _get_marker_path(settings):
+    return settings.CACHEDIR + "/pending"